@@ -0,0 +1,323 @@
+# call this file to compare observed operations with the schedule. It reads
+# a scheduled GTFS feed and the columnar export of the retrospective one
+# (see export.py --format parquet) and measures, by route, stop and service
+# day:
+#
+#	lateness		observed minus scheduled arrival at the stop, of the
+#					scheduled trip the observed trip was assigned to
+#	headway deviation	observed minus scheduled time since the last vehicle
+#	missed trips		scheduled trips that no observed trip was assigned
+#					to, on routes observed that day
+#
+# Observed trips are assigned to scheduled trips one to one, closest first,
+# by the median difference of their times at the stops they share.
+# e.g.
+#
+#	python adherence.py schedule.zip --retro output/ttc.parquet --output output/adherence
+#
+# Stops are matched by stop_code and routes by route_short_name. Days are
+# processed one at a time, so memory use depends on the size of a day, not
+# of the whole period.
+
+import os, zipfile, argparse
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+# an observed trip is only compared with scheduled trips of its route that 
+# were at some of the same stops within this many seconds of it
+TOLERANCE = 30*60
+# and that share at least this many, and half, of its stops
+MIN_SHARED_STOPS = 2
+# running early is much less common than running late, so in assigning 
+# trips, an offset early counts as this many times as far as one late
+EARLY_WEIGHT = 3
+# arrivals this many seconds early to late count as on time
+ON_TIME = (-60,5*60)
+
+
+def to_seconds(times):
+	"""Convert a Series of GTFS HH:MM:SS times, which may pass 24:00:00, to
+		seconds after midnight of the service day."""
+	parts = times.str.split(':',expand=True).astype(float)
+	return parts[0]*3600 + parts[1]*60 + parts[2]
+
+
+class Schedule(object):
+	"""The stop events of a scheduled GTFS feed, and which services run on
+		which days."""
+
+	def __init__(self,path):
+		with zipfile.ZipFile(path) as feed:
+			def read(name,columns):
+				if name not in feed.namelist():
+					return None
+				table = pd.read_csv( feed.open(name), dtype=str )
+				return table[[ c for c in columns if c in table.columns ]]
+			routes = read('routes.txt',['route_id','route_short_name'])
+			trips = read('trips.txt',['route_id','service_id','trip_id'])
+			stops = read('stops.txt',['stop_id','stop_code'])
+			stop_times = read('stop_times.txt',['trip_id','arrival_time','stop_id'])
+			self.calendar = read('calendar.txt',[
+				'service_id','monday','tuesday','wednesday','thursday','friday',
+				'saturday','sunday','start_date','end_date'
+			])
+			self.calendar_dates = read('calendar_dates.txt',['service_id','date','exception_type'])
+		# routes are known by their short names where they have them
+		if 'route_short_name' not in routes.columns:
+			routes['route_short_name'] = routes['route_id']
+		routes['route'] = routes['route_short_name'].fillna(routes['route_id'])
+		if 'stop_code' not in stops.columns:
+			stops['stop_code'] = stops['stop_id']
+		stop_times = stop_times.dropna(subset=['arrival_time'])
+		events = stop_times.merge(trips,on='trip_id').merge(
+			routes[['route_id','route']], on='route_id'
+		).merge( stops[['stop_id','stop_code']], on='stop_id' )
+		self.events = pd.DataFrame({
+			'route': events['route'].astype('category'),
+			'stop': events['stop_code'].astype('category'),
+			'trip_id': events['trip_id'],
+			'service_id': events['service_id'],
+			'scheduled': to_seconds(events['arrival_time'])
+		})
+
+	def services(self,day):
+		"""Return the set of service_ids running on a date."""
+		running = set()
+		if self.calendar is not None:
+			c = self.calendar
+			weekday = day.strftime('%A').lower()
+			today = day.strftime('%Y%m%d')
+			running |= set( c.loc[
+				(c[weekday] == '1') & (c['start_date'] <= today) & (c['end_date'] >= today),
+				'service_id'
+			] )
+		if self.calendar_dates is not None:
+			cd = self.calendar_dates[ self.calendar_dates['date'] == day.strftime('%Y%m%d') ]
+			running |= set( cd.loc[ cd['exception_type'] == '1', 'service_id' ] )
+			running -= set( cd.loc[ cd['exception_type'] == '2', 'service_id' ] )
+		return running
+
+	def day(self,day,routes):
+		"""Scheduled arrivals on a date for the given routes, with the
+			scheduled headway at each stop."""
+		e = self.events
+		events = e[ e['service_id'].isin(self.services(day)) & e['route'].isin(routes) ]
+		events = events.sort_values(['route','stop','scheduled'])
+		events['scheduled_headway'] = events.groupby(
+			['route','stop'], observed=True
+		)['scheduled'].diff()
+		return events
+
+
+class Observations(object):
+	"""Observed stop times from the columnar export of the retro feed."""
+
+	def __init__(self,directory):
+		self.directory = directory
+		def dataset(name):
+			# export.py writes either Parquet or Arrow IPC files
+			path = os.path.join(directory,name)
+			arrow = any( f.endswith('.arrow') for d, s, files in os.walk(path) for f in files )
+			return ds.dataset( path, format='ipc' if arrow else 'parquet', partitioning='hive' )
+		self.stop_times = dataset('stop_times')
+		self.trips = dataset('trips')
+		self.stops = dataset('stops')
+
+	def service_ids(self):
+		return sorted( int(name.split('=')[1]) for name in
+			os.listdir(os.path.join(self.directory,'stop_times')) if name.startswith('service_id=') )
+
+	def day(self,service_id):
+		"""Observed arrivals on a service day, with the observed headway at
+			each stop."""
+		day = ds.field('service_id') == service_id
+		stop_times = self.stop_times.to_table(
+			filter=day, columns=['trip_id','stop_uid','arrival_time']
+		).to_pandas()
+		trips = self.trips.to_table(
+			filter=day & ~ds.field('ignore'), columns=['trip_id','route_id']
+		).to_pandas()
+		stops = self.stops.to_table(
+			filter=day, columns=['stop_uid','stop_code']
+		).to_pandas().drop_duplicates('stop_uid')
+		events = stop_times.merge(trips,on='trip_id').merge(stops,on='stop_uid')
+		events = pd.DataFrame({
+			'route': events['route_id'],
+			'stop': events['stop_code'],
+			'trip_id': events['trip_id'],
+			'observed': events['arrival_time'].astype(float)
+		}).sort_values(['route','stop','observed'])
+		events['observed_headway'] = events.groupby(['route','stop'])['observed'].diff()
+		return events
+
+
+def candidate_pairs(observed,scheduled,tolerance):
+	"""Pair each observed arrival with every scheduled arrival of the route 
+		at the stop within the tolerance. Returns the positions of the pairs 
+		in observed and scheduled."""
+	# code each route and stop, so that one sorted key finds them all
+	groups = pd.concat([ observed[['route','stop']], scheduled[['route','stop']] ])
+	codes = groups.groupby(['route','stop'],sort=False).ngroup().to_numpy()
+	start = min( scheduled['scheduled'].min(), observed['observed'].min() )
+	span = max( scheduled['scheduled'].max(), observed['observed'].max() ) - start + 2*tolerance + 1
+	obs_keys = codes[:len(observed)] * span + observed['observed'].to_numpy() - start
+	sched_keys = codes[len(observed):] * span + scheduled['scheduled'].to_numpy() - start
+	order = np.argsort(sched_keys,kind='stable')
+	sched_keys = sched_keys[order]
+	first = np.searchsorted(sched_keys, obs_keys - tolerance, side='left')
+	last = np.searchsorted(sched_keys, obs_keys + tolerance, side='right')
+	counts = last - first
+	obs_index = np.repeat( np.arange(len(observed)), counts )
+	# the position within each run of scheduled arrivals, added to its start
+	offsets = np.arange(counts.sum()) - np.repeat( np.cumsum(counts) - counts, counts )
+	sched_index = order[ np.repeat(first,counts) + offsets ]
+	return obs_index, sched_index
+
+
+def assign_trips(pairs,stops_per_trip):
+	"""Assign observed trips to scheduled trips one to one. Each pair of 
+		trips is scored by the median difference of their times at the stops 
+		they share (see EARLY_WEIGHT), and the closest pairs are taken first, 
+		so that a late bus isn't given the trip of the bus behind it if that 
+		bus was observed."""
+	trips = pairs.groupby(['trip_id','scheduled_trip_id']).agg(
+		shared=('stop','nunique'), offset=('difference','median')
+	).reset_index()
+	needed = np.maximum( MIN_SHARED_STOPS, np.ceil( trips['trip_id'].map(stops_per_trip) / 2 ) )
+	trips = trips[ trips['shared'] >= needed ]
+	trips = trips.assign( 
+		distance = trips['offset'].where( trips['offset'] >= 0, -EARLY_WEIGHT * trips['offset'] )
+	).sort_values(
+		['distance','shared'], ascending=[True,False]
+	)
+	assigned, taken = {}, set()
+	for trip_id, scheduled_trip_id in zip(trips['trip_id'],trips['scheduled_trip_id']):
+		if trip_id in assigned or scheduled_trip_id in taken:
+			continue
+		assigned[trip_id] = scheduled_trip_id
+		taken.add(scheduled_trip_id)
+	return assigned
+
+
+def compare_day(observed,scheduled,tolerance=TOLERANCE):
+	"""Match observed trips to scheduled trips of their route (see 
+		assign_trips) and compare each observed arrival with its scheduled 
+		trip's arrival at the stop. Returns the observations, with lateness 
+		where matched, and the number of scheduled and missed trips by route."""
+	for table in (observed,scheduled):
+		for column in ('route','stop'):
+			table[column] = table[column].astype(str)
+	observed = observed.reset_index(drop=True)
+	scheduled = scheduled.reset_index(drop=True)
+	obs_index, sched_index = candidate_pairs(observed,scheduled,tolerance)
+	pairs = pd.DataFrame({
+		'trip_id': observed['trip_id'].to_numpy()[obs_index],
+		'stop': observed['stop'].to_numpy()[obs_index],
+		'scheduled_trip_id': scheduled['trip_id'].to_numpy()[sched_index],
+		'difference': observed['observed'].to_numpy()[obs_index] - scheduled['scheduled'].to_numpy()[sched_index],
+		'obs_index': obs_index,
+		'sched_index': sched_index
+	})
+	assigned = assign_trips( pairs, observed.groupby('trip_id')['stop'].nunique() )
+	# the arrivals of each observed trip at the stops of its scheduled trip, 
+	# the closest in time where a stop is visited more than once
+	pairs = pairs[ pairs['trip_id'].map(assigned) == pairs['scheduled_trip_id'] ]
+	pairs = pairs.assign( distance = pairs['difference'].abs() ).sort_values('distance')
+	pairs = pairs.drop_duplicates('obs_index').drop_duplicates('sched_index')
+	matched = observed.assign( scheduled_trip_id = observed['trip_id'].map(assigned) )
+	matched['scheduled'] = pd.Series( scheduled['scheduled'].to_numpy()[pairs['sched_index']], index=pairs['obs_index'] )
+	matched['scheduled_headway'] = pd.Series( scheduled['scheduled_headway'].to_numpy()[pairs['sched_index']], index=pairs['obs_index'] )
+	matched['lateness'] = matched['observed'] - matched['scheduled']
+	matched['headway_deviation'] = matched['observed_headway'] - matched['scheduled_headway']
+	matched['on_time'] = matched['lateness'].between(*ON_TIME)
+	matched['early'] = matched['lateness'] < ON_TIME[0]
+	matched['late'] = matched['lateness'] > ON_TIME[1]
+	# scheduled trips that no observed trip was assigned to
+	trips = scheduled.drop_duplicates('trip_id')[['route','trip_id']]
+	trips = trips.assign( missed = ~trips['trip_id'].isin( set(assigned.values()) ) )
+	trips = trips.groupby('route').agg(
+		scheduled_trips=('trip_id','size'), missed_trips=('missed','sum')
+	)
+	return matched, trips
+
+
+def summarize_routes(matched,trips):
+	"""Summary by route for one day."""
+	matched = matched.assign( abs_headway_deviation = matched['headway_deviation'].abs() )
+	summary = matched.groupby('route').agg(
+		arrivals=('observed','size'),
+		matched=('lateness','count'),
+		mean_lateness=('lateness','mean'),
+		median_lateness=('lateness','median'),
+		p90_lateness=('lateness',lambda x: x.quantile(0.9)),
+		on_time=('on_time','mean'),
+		early=('early','mean'),
+		late=('late','mean'),
+		mean_abs_headway_deviation=('abs_headway_deviation','mean')
+	)
+	return summary.join(trips,how='left')
+
+
+def stop_sums(matched):
+	"""Sums by route and stop, which can be added up over days."""
+	matched = matched.assign(
+		abs_headway_deviation = matched['headway_deviation'].abs(),
+		headways = matched['headway_deviation'].notna()
+	)
+	return matched.groupby(['route','stop']).agg(
+		arrivals=('observed','size'),
+		matched=('lateness','count'),
+		lateness=('lateness','sum'),
+		on_time=('on_time','sum'),
+		headways=('headways','sum'),
+		abs_headway_deviation=('abs_headway_deviation','sum')
+	)
+
+
+def run(schedule_path,retro_directory,output,start=None,end=None):
+	schedule = Schedule(schedule_path)
+	observations = Observations(retro_directory)
+	route_days = []
+	stops = []
+	for service_id in observations.service_ids():
+		day = date(1970,1,1) + timedelta(days=service_id)
+		if (start and day < start) or (end and day > end):
+			continue
+		observed = observations.day(service_id)
+		scheduled = schedule.day( day, observed['route'].unique() )
+		if len(observed) == 0 or len(scheduled) == 0:
+			continue
+		matched, trips = compare_day(observed,scheduled)
+		route_days.append( summarize_routes(matched,trips).assign(date=day.isoformat()) )
+		stops.append( stop_sums(matched) )
+		print( day, len(observed), 'arrivals,', int(trips['missed_trips'].sum()), 'missed trips' )
+	if not route_days:
+		print( 'no days to compare' )
+		return
+	os.makedirs(output,exist_ok=True)
+	route_days = pd.concat(route_days).reset_index().set_index(['date','route'])
+	route_days.to_csv( os.path.join(output,'route_days.csv') )
+	# average over all days by stop
+	stops = pd.concat(stops).groupby(['route','stop']).sum()
+	stops = pd.DataFrame({
+		'arrivals': stops['arrivals'],
+		'matched': stops['matched'],
+		'mean_lateness': stops['lateness'] / stops['matched'],
+		'on_time': stops['on_time'] / stops['matched'],
+		'mean_abs_headway_deviation': stops['abs_headway_deviation'] / stops['headways'].replace(0,np.nan)
+	})
+	stops.to_csv( os.path.join(output,'route_stops.csv') )
+	print( 'wrote',output )
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare observed operations with the schedule')
+	parser.add_argument('schedule',help='scheduled GTFS zip file')
+	parser.add_argument('--retro',required=True,help='directory written by export.py --format parquet or arrow')
+	parser.add_argument('--output',default=os.path.join('output','adherence'))
+	parser.add_argument('--start',type=date.fromisoformat,help='first service day, YYYY-MM-DD')
+	parser.add_argument('--end',type=date.fromisoformat,help='last service day, YYYY-MM-DD')
+	args = parser.parse_args()
+	run(args.schedule,args.retro,args.output,args.start,args.end)
@@ -0,0 +1,36 @@
+# Links consecutive trips by the same vehicle into blocks as they end, for 
+# any of the feed adapters (nb_api, gtfsrt_api). Report times are in epoch 
+# seconds. Blocks made up here have negative ids (see db.new_block_id), 
+# apart from those the agency gives.
+
+import time, threading
+import db
+from conf import conf
+
+next_bid = None		# next block_id to be assigned, read on first use
+last_trips = {}	# block_id and last report of each vehicle's last trip ( vid -> (bid,time) )
+block_lock = threading.Lock()
+
+def load_last_trips():
+	"""Pick up the blocks of vehicles that ended a trip shortly before the 
+		collector (re)started, so they can carry on."""
+	since = time.time() - conf['block_gap']
+	last_trips.update( db.get_last_trips(since) )
+
+def link_block(trip):
+	"""Assign an ending trip to a block: that of the same vehicle's last trip 
+		if it ended no more than conf['block_gap'] seconds before this one 
+		began and was in a block made up here, or else a new one. Trips that 
+		have a block_id from the feed keep it."""
+	global next_bid
+	with block_lock:
+		last = last_trips.get(trip.vehicle_id)
+		if trip.block_id is None:
+			if last and last[0] < 0 and trip.vehicles[0].time - last[1] <= conf['block_gap']:
+				trip.block_id = last[0]
+			else:
+				if next_bid is None:
+					next_bid = db.new_block_id()
+				trip.block_id = next_bid
+				next_bid -= 1
+		last_trips[trip.vehicle_id] = ( trip.block_id, trip.last_seen )
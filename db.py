@@ -1,9 +1,14 @@
 # functions involving BD interaction
-import psycopg2, json, math
+import psycopg2, json, math, time
+from bisect import bisect_right
+from datetime import datetime, date
+from zoneinfo import ZoneInfo
 from psycopg2.extras import execute_values
 from conf import conf
 from shapely.wkb import loads as loadWKB
+from shapely.geometry import MultiLineString
 from minor_objects import Stop, Vehicle
+from geom import LinearReference
 
 
 # connect and establish a cursor, based on parameters in conf.py
@@ -79,19 +84,38 @@ def new_trip_id():
 
 
 def new_block_id():
-	"""Get a next block_id to start from, defaulting to 1. 
-		This is used to group sequential trips by the same vehicle."""
+	"""Get a next block_id to start from, defaulting to -1. 
+		This is used to group sequential trips by the same vehicle. Block 
+		ids we make up count down from -1 so that they can't collide with 
+		the agency's own, which are positive."""
 	c = cursor()
 	c.execute(
 		"""
-			SELECT MAX(block_id) FROM {trips};
+			SELECT MIN(block_id) FROM {trips} WHERE block_id < 0;
 		""".format(**conf['db']['tables'])
 	)
 	try:
 		(block_id,) = c.fetchone()
-		return block_id + 1
+		return block_id - 1
 	except:
-		return 1
+		return -1
+
+
+def get_last_trips(since):
+	"""Get the block_id and last report time of the last trip of each 
+		vehicle last heard from after the given time."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT DISTINCT ON (vehicle_id)
+				vehicle_id, block_id, times[array_upper(times,1)] AS last_seen
+			FROM {trips}
+			WHERE times[array_upper(times,1)] > %(since)s AND block_id IS NOT NULL
+			ORDER BY vehicle_id, last_seen DESC
+		""".format(**conf['db']['tables']),
+		{ 'since':since }
+	)
+	return { vehicle_id:(block_id,last_seen) for vehicle_id, block_id, last_seen in c.fetchall() }
 
 
 def empty_tables():
@@ -101,13 +125,20 @@ def empty_tables():
 	c.execute(
 		"""
 			TRUNCATE {stop_times};
+			TRUNCATE {shapes} RESTART IDENTITY;
 			UPDATE {trips} SET 
 				service_id = NULL,
 				match_confidence = NULL,
 				ignore = TRUE,
 				clean_geom = NULL,
 				problem = '',
-				match_geom = NULL;
+				match_geom = NULL,
+				fingerprint = NULL,
+				shape_id = NULL,
+				map_matched = NULL,
+				stops_made = NULL,
+				stops_scheduled = NULL;
+			TRUNCATE {route_quality};
 		""".format(**conf['db']['tables'])
 	)
 
@@ -117,7 +148,10 @@ def ignore_trip(trip_id,reason=None):
 	c = cursor()
 	c.execute(
 		"""
-			UPDATE {trips} SET ignore = TRUE WHERE trip_id = %(trip_id)s;
+			UPDATE {trips} SET 
+				ignore = TRUE, 
+				modified = EXTRACT(EPOCH FROM NOW())
+			WHERE trip_id = %(trip_id)s;
 			DELETE FROM {stop_times} WHERE trip_id = %(trip_id)s;
 		""".format(**conf['db']['tables']),
 		{ 'trip_id': trip_id } 
@@ -133,7 +167,9 @@ def flag_trip(trip_id,problem_description_string):
 	c = cursor()
 	c.execute(
 		"""
-			UPDATE {trips} SET problem = problem || %(description)s 
+			UPDATE {trips} SET 
+				problem = problem || %(description)s,
+				modified = EXTRACT(EPOCH FROM NOW())
 			WHERE trip_id = %(trip_id)s;
 		""".format(**conf['db']['tables']),
 		{
@@ -143,8 +179,9 @@ def flag_trip(trip_id,problem_description_string):
 	)
 
 
-def add_trip_match(trip_id,confidence,wkb_geometry_match):
-	"""update the trip record with it's matched geometry"""
+def add_trip_match(trip_id,confidence,wkb_geometry_match,map_matched):
+	"""update the trip record with it's matched geometry, and whether that 
+		came from map-matching rather than a default route or known shape"""
 	c = cursor()
 	# store the given values
 	c.execute(
@@ -152,18 +189,180 @@ def add_trip_match(trip_id,confidence,wkb_geometry_match):
 			UPDATE {trips}
 			SET  
 				match_confidence = %(confidence)s,
-				match_geom = ST_SetSRID(%(match)s::geometry,%(localEPSG)s)
+				match_geom = ST_SetSRID(%(match)s::geometry,%(localEPSG)s),
+				map_matched = %(map_matched)s,
+				modified = EXTRACT(EPOCH FROM NOW())
 			WHERE trip_id  = %(trip_id)s;
 		""".format(**conf['db']['tables']),
 		{
 			'localEPSG':conf['localEPSG'],
 			'confidence':confidence, 
 			'match':wkb_geometry_match, 
+			'map_matched':map_matched,
+			'trip_id':trip_id
+		}
+	)
+	assign_shape(trip_id)
+
+
+def assign_shape(trip_id):
+	"""Point the trip at a shared shape: the existing shape for its route and 
+		direction closest to its simplified match geometry, if that's within 
+		shape_cluster_distance (by Hausdorff distance), or else a new one."""
+	c = cursor()
+	c.execute(
+		"""
+			WITH trip AS (
+				SELECT route_id, direction_id, ST_Multi(ST_Simplify(match_geom,10)) AS geom
+				FROM {trips}
+				WHERE trip_id = %(trip_id)s AND NOT ST_IsEmpty(match_geom)
+			), existing AS (
+				SELECT s.shape_id
+				FROM {shapes} AS s, trip
+				WHERE 
+					s.route_id = trip.route_id AND 
+					s.direction_id = trip.direction_id AND
+					-- no points further apart than this, so some must be closer
+					ST_DWithin(s.the_geom,trip.geom,%(tolerance)s) AND
+					ST_HausdorffDistance(s.the_geom,trip.geom) <= %(tolerance)s
+				ORDER BY ST_HausdorffDistance(s.the_geom,trip.geom)
+				LIMIT 1
+			), new AS (
+				INSERT INTO {shapes} (route_id, direction_id, the_geom)
+				SELECT route_id, direction_id, geom FROM trip
+				WHERE NOT EXISTS (SELECT * FROM existing)
+				RETURNING shape_id
+			)
+			UPDATE {trips} SET shape_id = (
+				SELECT shape_id FROM existing UNION ALL SELECT shape_id FROM new
+			)
+			WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{
+			'tolerance':conf['shape_cluster_distance'],
+			'trip_id':trip_id
+		}
+	)
+
+
+def record_trip_quality(trip_id,stops_made,stops_scheduled):
+	"""Store how many of its scheduled stops a processed trip made and add 
+		it to the quality measures of its route direction. Trips with no 
+		scheduled stops aren't counted."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET 
+				stops_made = %(stops_made)s,
+				stops_scheduled = %(stops_scheduled)s
+			WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{
+			'stops_made':stops_made,
+			'stops_scheduled':stops_scheduled,
+			'trip_id':trip_id
+		}
+	)
+	count_trip_quality(trip_id,1)
+
+
+def count_trip_quality(trip_id,sign):
+	"""Add (sign=1) or remove (sign=-1) a trip's contribution to the 
+		route_quality counters of its route, direction and service day. 
+		Does nothing for trips whose quality wasn't recorded. The day is 
+		that of the first report, which, unlike the service_id, is known 
+		whether or not the trip was matched."""
+	c = cursor()
+	c.execute(
+		"""
+			INSERT INTO {route_quality} AS q (
+				route_id, direction_id, service_id, trips, matched_trips, 
+				confidence_sum, stops_made, stops_scheduled, too_few_stops, 
+				too_many_stops, coverage
+			)
+			SELECT 
+				route_id, 
+				direction_id, 
+				day,
+				%(sign)s,
+				%(sign)s * (match_confidence IS NOT NULL)::integer,
+				%(sign)s * COALESCE(match_confidence,0),
+				%(sign)s * stops_made,
+				%(sign)s * stops_scheduled,
+				%(sign)s * (stops_made < stops_scheduled / 2.0)::integer,
+				%(sign)s * (stops_made > stops_scheduled)::integer,
+				ARRAY(
+					SELECT CASE WHEN i = bucket THEN %(sign)s ELSE 0 END
+					FROM generate_series(1,12) AS i ORDER BY i
+				)
+			FROM (
+				SELECT *,
+					(to_timestamp(times[1]) AT TIME ZONE %(tz)s)::date - '1970-01-01'::date AS day,
+					-- tenths of the stops made, all of them, or more
+					CASE 
+						WHEN stops_made > stops_scheduled THEN 12
+						ELSE LEAST(FLOOR(10.0 * stops_made / stops_scheduled),10)::integer + 1
+					END AS bucket
+				FROM {trips}
+				WHERE trip_id = %(trip_id)s AND stops_scheduled > 0
+			) AS t
+			ON CONFLICT (route_id, direction_id, service_id) DO UPDATE SET
+				trips = q.trips + EXCLUDED.trips,
+				matched_trips = q.matched_trips + EXCLUDED.matched_trips,
+				confidence_sum = q.confidence_sum + EXCLUDED.confidence_sum,
+				stops_made = q.stops_made + EXCLUDED.stops_made,
+				stops_scheduled = q.stops_scheduled + EXCLUDED.stops_scheduled,
+				too_few_stops = q.too_few_stops + EXCLUDED.too_few_stops,
+				too_many_stops = q.too_many_stops + EXCLUDED.too_many_stops,
+				coverage = ARRAY(
+					SELECT a + b 
+					FROM unnest(q.coverage,EXCLUDED.coverage) WITH ORDINALITY AS u(a,b,i)
+					ORDER BY i
+				);
+		""".format(**conf['db']['tables']),
+		{
+			'sign':sign,
+			'tz':conf['timezone'],
 			'trip_id':trip_id
 		}
 	)
 
 
+def get_shapes(route_id,direction_id,limit):
+	"""Get the shared shapes of a route direction that recent map-matched 
+		trips (not those given a default route or a known shape) were 
+		assigned to, with the average confidence and number of those trips, 
+		most common first."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT s.shape_id, s.the_geom, AVG(recent.match_confidence), COUNT(*)
+			FROM (
+				SELECT shape_id, match_confidence
+				FROM {trips}
+				WHERE 
+					route_id = %(route_id)s AND 
+					direction_id = %(direction_id)s AND
+					NOT ignore AND 
+					map_matched AND
+					match_confidence >= %(min_quality)s
+				ORDER BY trip_id DESC
+				LIMIT %(limit)s
+			) AS recent JOIN {shapes} AS s USING (shape_id)
+			GROUP BY s.shape_id, s.the_geom
+			ORDER BY COUNT(*) DESC, s.shape_id
+		""".format(**conf['db']['tables']),
+		{
+			'route_id':route_id,
+			'direction_id':direction_id,
+			'min_quality':conf['min_OSRM_match_quality'],
+			'limit':limit
+		}
+	)
+	return [ (shape_id,loadWKB(geom,hex=True),confidence,trips) 
+		for shape_id, geom, confidence, trips in c.fetchall() ]
+
+
 def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geom):
 	"""Store the basics of the trip in the database."""
 	c = cursor()
@@ -183,6 +382,16 @@ def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geo
 	if c.rowcount > 0:
 		return True
 
+	# the collector stores timepoints while the trip is running, before the 
+	# trip itself, so its service_id can only be set now
+	c.execute(
+		"""
+			SELECT MIN(etime) FROM {stop_times} WHERE trip_id = %(trip_id)s
+		""".format(**conf['db']['tables']),
+		{ 'trip_id':trip_id }
+	)
+	(first_stop_time,) = c.fetchone()
+
 	# store the given values
 	c.execute(
 		"""
@@ -194,7 +403,9 @@ def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geo
 					direction_id, 
 					vehicle_id, 
 					times,
-					orig_geom
+					orig_geom,
+					service_id,
+					modified
 			) 
 			VALUES 
 				( 
@@ -204,7 +415,9 @@ def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geo
 					%(direction_id)s,
 					%(vehicle_id)s, 
 					%(times)s,
-					ST_SetSRID( %(orig_geom)s::geometry, %(localEPSG)s )
+					ST_SetSRID( %(orig_geom)s::geometry, %(localEPSG)s ),
+					%(service_id)s,
+					EXTRACT(EPOCH FROM NOW())
 				);
 		""".format(**conf['db']['tables']),
 		{
@@ -215,12 +428,14 @@ def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geo
 			'vehicle_id':vehicle_id,
 			'times':times,
 			'orig_geom':orig_geom,
-			'localEPSG':conf['localEPSG']
+			'localEPSG':conf['localEPSG'],
+			'service_id':service_id(first_stop_time) if first_stop_time is not None else None
 		}
 	)
  
 def remove_trip(trip_id):
 	"""Remove a trip from the database"""
+	count_trip_quality(trip_id,-1)
 	c = cursor()
 	c.execute(
 		"""
@@ -230,51 +445,92 @@ def remove_trip(trip_id):
 	)
 
 
-def get_direction_uid(direction_id,trip_time):
-	"""Find the correct direction entry based on the direction_id and the time
-		of the trip. Trip_time is an epoch value, direction_id is a string."""
+# Schedule reference data, cached in each process by direction_id. Every 
+# stored version of a direction is loaded at once, along with every version 
+# of its stops. An entry is dropped when this process stores a new version 
+# (see try_storing_direction) and reloaded after conf['direction_cache_ttl'] 
+# seconds, for processes that only read directions.
+direction_cache = {}
+
+
+def load_direction(direction_id):
+	"""Load all versions of a direction and its stops from the DB."""
 	c = cursor()
 	c.execute(
 		"""
-			SELECT uid 
+			SELECT uid, report_time, stops, route_geom
 			FROM {directions}
-			WHERE 
-				direction_id = %(direction_id)s AND 
-				report_time <= %(trip_time)s
-			ORDER BY report_time DESC
-			LIMIT 1
+			WHERE direction_id = %(direction_id)s
+			ORDER BY report_time
 		""".format(**conf['db']['tables']),
-		{ 'direction_id':direction_id, 'trip_time':trip_time }
+		{ 'direction_id':direction_id }
 	)
-	uid, = c.fetchone()
-	return uid
+	versions = [ {
+			'uid':uid,
+			'report_time':report_time,
+			'stop_ids':stop_ids or [],
+			'route_geom':loadWKB(geom,hex=True) if geom else None,
+			'route':None # LinearReference, built on first use
+		} for uid, report_time, stop_ids, geom in c.fetchall() ]
+	# all versions of all stops of any version, in order of report time
+	stop_versions = {}
+	stop_ids = list( set( s for v in versions for s in v['stop_ids'] ) )
+	if stop_ids:
+		c.execute(
+			"""
+				SELECT stop_id, uid, the_geom, report_time
+				FROM {stops}
+				WHERE stop_id = ANY(%(stop_ids)s)
+				ORDER BY report_time
+			""".format(**conf['db']['tables']),
+			{ 'stop_ids':stop_ids }
+		)
+		for stop_id, uid, geom, report_time in c.fetchall():
+			stop_versions.setdefault(stop_id,[]).append( 
+				( report_time, Stop.fromDB(uid,geom) )
+			)
+	return {
+		'loaded':time.time(),
+		'report_times':[ v['report_time'] for v in versions ],
+		'versions':versions,
+		'stop_versions':stop_versions
+	}
+
+
+def get_direction(direction_id,trip_time):
+	"""Return the cache entry for a direction and the version of it in effect 
+		at trip_time, or None for the version if there wasn't one. The 
+		direction is (re)loaded if it isn't cached or the entry has expired."""
+	entry = direction_cache.get(direction_id)
+	if entry is None or time.time() - entry['loaded'] > conf['direction_cache_ttl']:
+		entry = direction_cache[direction_id] = load_direction(direction_id)
+	i = bisect_right(entry['report_times'],trip_time)
+	return entry, entry['versions'][i-1] if i > 0 else None
+
+
+def get_direction_uid(direction_id,trip_time):
+	"""Find the correct direction entry based on the direction_id and the time
+		of the trip. Trip_time is an epoch value, direction_id is a string."""
+	entry, version = get_direction(direction_id,trip_time)
+	return version['uid'] if version else None
 
 
 def get_stops(direction_id, trip_time):
-	"""Get an ordered list of Stop objects from the schedule data."""
-	c = cursor()
-	# get the uid of the relevant direction entry
-	direction_uid = get_direction_uid(direction_id,trip_time)
-	if not direction_uid: return None
-	c.execute(	
-		"""
-			SELECT uid, the_geom FROM (
-				SELECT 
-					DISTINCT ON (a.stop) a.stop AS stop_id,
-					s.uid,
-					a.seq,
-					s.the_geom
-				FROM {directions} AS d, unnest(d.stops) WITH ORDINALITY a(stop, seq)
-				JOIN {stops} AS s ON s.stop_id = a.stop
-				WHERE d.uid = %(direction_uid)s AND s.report_time <= %(trip_time)s
-				-- get uniques stops with the earliest report time and order by sequence
-				ORDER BY a.stop, s.report_time
-			) AS whatever ORDER BY seq
-		""".format(**conf['db']['tables']),
-		{ 'direction_uid':direction_uid, 'trip_time':trip_time }
-	)
+	"""Get an ordered list of Stop objects from the schedule data. Each stop 
+		is the earliest version reported before the trip. The Stop objects are 
+		shared with the cache and shouldn't be modified."""
+	entry, version = get_direction(direction_id,trip_time)
+	if not version: return None
+	stops = []
+	seen = set()
+	for stop_id in version['stop_ids']:
+		if stop_id in seen: continue
+		seen.add(stop_id)
+		stop_versions = entry['stop_versions'].get(stop_id)
+		if stop_versions and stop_versions[0][0] <= trip_time:
+			stops.append( stop_versions[0][1] )
 	# return a schedule-ordered list of stop objects
-	return [ Stop( stop_uid, geom ) for stop_uid, geom in c.fetchall() ]
+	return stops
 
 
 def get_route_geom(direction_id, trip_time):
@@ -282,23 +538,21 @@ def get_route_geom(direction_id, trip_time):
 		backup in case map-matching is going badly. Direction geometries must be 
 		supplied manually. If all goes well this returns a shapely geometry in
 		the local projection. Else, None."""
-	c = cursor()
-	# get the uid of the relevant direction entry
-	uid = get_direction_uid(direction_id,trip_time)
-	if not uid: return None
-	# now find the geometry
-	c.execute(
-		"""
-			SELECT 
-				route_geom
-			FROM {directions} 
-			WHERE uid = %(uid)s;
-		""".format(**conf['db']['tables']),
-		{ 'uid':uid }
-	)
-	geom, = c.fetchone()
-	if geom: return loadWKB(geom,hex=True)
-	else: return None
+	entry, version = get_direction(direction_id,trip_time)
+	return version['route_geom'] if version else None
+
+
+def get_default_route(direction_id, trip_time):
+	"""As get_route_geom, but return the geometry as a MultiLineString along 
+		with a LinearReference of it, which is built once per direction 
+		version. Returns None if there's no default geometry."""
+	entry, version = get_direction(direction_id,trip_time)
+	if not version or not version['route_geom']: 
+		return None
+	if not version['route']:
+		geometry = MultiLineString([version['route_geom']])
+		version['route'] = ( geometry, LinearReference(geometry) )
+	return version['route']
 
 
 def set_trip_clean_geom(trip_id,localWKBgeom):
@@ -341,18 +595,57 @@ def store_timepoints(trip_id,timepoints):
  
 	records = []
 	seq = 1
-	for timepoint in timepoints:
+	for timepoint, fake_stop_id in zip(timepoints,fake_stop_ids(timepoints)):
 		# list of tuples
-		records.append( (trip_id,timepoint.stop.id,timepoint.arrival_time,seq) )
+		records.append( (trip_id,timepoint.stop.id,timepoint.arrival_time,seq,fake_stop_id) )
 		seq += 1
 	print ( 'timepoints to store: ' + str(len(timepoints)))
 	execute_values(
 		c,
 		"""
-			INSERT INTO {stop_times} (trip_id, stop_uid, etime, stop_sequence) VALUES %s
+			INSERT INTO {stop_times} (trip_id, stop_uid, etime, stop_sequence, fake_stop_id) 
+			VALUES %s
 		""".format(**conf['db']['tables']),
 		records
 	)
+	set_service_id(trip_id,timepoints[0].arrival_time)
+
+
+def service_id(epoch_time):
+	"""The service_id for a time: the number of days since the epoch of the 
+		local date, which is unique to each day."""
+	local_date = datetime.fromtimestamp(epoch_time,ZoneInfo(conf['timezone'])).date()
+	return (local_date - date(1970,1,1)).days
+
+
+def fake_stop_ids(timepoints):
+	"""Give repeated visits to the same stop on a trip distinct stop_ids for 
+		GTFS, by appending an underscore for each earlier visit."""
+	visits = {}
+	fake_ids = {}
+	for i in sorted( range(len(timepoints)), key=lambda i: timepoints[i].arrival_time ):
+		stop_id = timepoints[i].stop.id
+		fake_ids[i] = str(stop_id) + '_' * visits.get(stop_id,0)
+		visits[stop_id] = visits.get(stop_id,0) + 1
+	return [ fake_ids[i] for i in range(len(timepoints)) ]
+
+
+def set_service_id(trip_id,first_stop_time):
+	"""Set the service_id of a trip from the time of its first stop. This 
+		also marks the trip as modified."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET 
+				service_id = %(service_id)s,
+				modified = EXTRACT(EPOCH FROM NOW())
+			WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{ 
+			'service_id':service_id(first_stop_time),
+			'trip_id':trip_id 
+		}
+	)
 
 def get_timepoints(trip_id):
 	"""Essentially, this should be the inverse of the above function."""
@@ -445,14 +738,21 @@ def try_storing_timepoint(timepoint, trip_id, seq):
 		return
 	# store the stop
 	print ( 'Storing timepoint. Stop: ' + str(timepoint.stop_id) + ', Trip: ' + str(trip_id) + ', Time: ' + str(timepoint.arrival_time) )
+	# repeated visits to a stop get an underscore for each earlier visit
 	c.execute(
 		"""
 			INSERT INTO {stop_times} ( 
-				trip_id, stop_uid, stop_sequence, etime
+				trip_id, stop_uid, stop_sequence, etime, fake_stop_id
 			) 
-			VALUES ( 
-				%(trip_id)s, %(stop_uid)s, %(stop_sequence)s, %(etime)s
-			)""".format(**conf['db']['tables']),
+			SELECT 
+				%(trip_id)s, %(stop_uid)s, %(stop_sequence)s, %(etime)s,
+				%(stop_uid)s::text || repeat( '_', COUNT(*)::int )
+			FROM {stop_times}
+			WHERE 
+				trip_id = %(trip_id)s AND 
+				stop_uid = %(stop_uid)s AND 
+				etime < %(etime)s
+			""".format(**conf['db']['tables']),
 			{ 
 				'trip_id':trip_id,
 				'stop_uid':timepoint.stop_id,
@@ -460,6 +760,10 @@ def try_storing_timepoint(timepoint, trip_id, seq):
 				'etime':timepoint.arrival_time
 			} 
 	)
+	if seq == 1:
+		set_service_id(trip_id,timepoint.arrival_time)
+	else:
+		touch_trip(trip_id)
 
 
 def try_storing_direction(route_id,did,title,name,branch,useforui,stops):
@@ -515,21 +819,30 @@ def try_storing_direction(route_id,did,title,name,branch,useforui,stops):
 				stops
 			)
 		)
+	# the cached versions are now incomplete
+	direction_cache.pop(did,None)
 
 
 def scrub_trip(trip_id):
 	"""Un-mark any flag fields and leave the DB record 
 		as though newly collected and unprocessed"""
+	count_trip_quality(trip_id,-1)
 	c = cursor()
 	c.execute(
 		"""
 			UPDATE {trips} SET 
 				match_confidence = NULL,
+				stops_made = NULL,
+				stops_scheduled = NULL,
 				match_geom = NULL,
 				clean_geom = NULL,
 				problem = '',
 				ignore = FALSE,
-				service_id = NULL
+				service_id = NULL,
+				fingerprint = NULL,
+				shape_id = NULL,
+				map_matched = NULL,
+				modified = EXTRACT(EPOCH FROM NOW())
 			WHERE trip_id = %(trip_id)s;
 
 			DELETE FROM {stop_times} 
@@ -539,6 +852,35 @@ def scrub_trip(trip_id):
 	)
 
 
+def get_trip_fingerprint(trip_id):
+	"""Return the fingerprint of the inputs the trip was last processed with, 
+		or None if it hasn't been (sucessfully) processed."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT fingerprint FROM {trips} WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{ 'trip_id':trip_id }
+	)
+	result = c.fetchone()
+	return result[0] if result else None
+
+
+def set_trip_fingerprint(trip_id,fingerprint):
+	"""Record the fingerprint of the inputs used to process this trip."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET fingerprint = %(fingerprint)s 
+			WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{
+			'fingerprint':fingerprint,
+			'trip_id':trip_id
+		}
+	)
+
+
 def get_trip_ids_by_range(min_id,max_id):
 	"""return a list of all trip ids in the specified range"""
 	c = cursor()
@@ -603,4 +945,127 @@ def trip_exists(trip_id):
 	if c.rowcount > 1:
 		return True
 	else:
-		return False
\ No newline at end of file
+		return False
+
+
+def touch_trip(trip_id):
+	"""Record that the exportable data of a trip has changed."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET modified = EXTRACT(EPOCH FROM NOW())
+			WHERE trip_id = %(trip_id)s;
+		""".format(**conf['db']['tables']),
+		{ 'trip_id':trip_id }
+	)
+
+
+# the service day of a trip or, for trips without one (those that couldn't be 
+# used), the local day of its first report, as in count_trip_quality
+TRIP_DAY = """COALESCE( service_id, 
+	(to_timestamp(times[1]) AT TIME ZONE %(tz)s)::date - '1970-01-01'::date )"""
+
+
+def get_service_ids(include_ignored=False):
+	"""Return a sorted list of service_ids with any useable trips, or with 
+		any trips at all (see TRIP_DAY) if include_ignored."""
+	c = cursor()
+	if include_ignored:
+		c.execute(
+			"""
+				SELECT DISTINCT {day} FROM {trips} 
+				ORDER BY 1;
+			""".format(day=TRIP_DAY,**conf['db']['tables']),
+			{ 'tz':conf['timezone'] }
+		)
+	else:
+		c.execute(
+			"""
+				SELECT DISTINCT service_id FROM {trips} 
+				WHERE NOT ignore AND service_id IS NOT NULL
+				ORDER BY service_id;
+			""".format(**conf['db']['tables'])
+		)
+	return [ service_id for (service_id,) in c.fetchall() ]
+
+
+def get_service_day_signatures(service_ids,include_ignored=False):
+	"""Return a dict of a signature for each service day, which changes 
+		whenever the set of useable trips on that day or any of them changes. 
+		If include_ignored, days are as TRIP_DAY and the signature covers all 
+		of their trips, whether ignored and what problems they had."""
+	c = cursor()
+	if include_ignored:
+		c.execute(
+			"""
+				SELECT 
+					day, 
+					COUNT(*),
+					md5( string_agg(trip_id||':'||ignore||':'||COALESCE(problem,''), ',' ORDER BY trip_id) ),
+					COALESCE( MAX(modified), 0 )
+				FROM ( SELECT *, {day} AS day FROM {trips} ) AS t
+				WHERE day = ANY(%(service_ids)s)
+				GROUP BY day;
+			""".format(day=TRIP_DAY,**conf['db']['tables']),
+			{ 'service_ids':service_ids, 'tz':conf['timezone'] }
+		)
+	else:
+		c.execute(
+			"""
+				SELECT 
+					service_id, 
+					COUNT(*),
+					md5( string_agg(trip_id::text, ',' ORDER BY trip_id) ),
+					COALESCE( MAX(modified), 0 )
+				FROM {trips}
+				WHERE NOT ignore AND service_id = ANY(%(service_ids)s)
+				GROUP BY service_id;
+			""".format(**conf['db']['tables']),
+			{ 'service_ids':service_ids }
+		)
+	return { service_id:list(signature) for service_id, *signature in c.fetchall() }
+
+
+def copy_query(query,params,file):
+	"""Stream the CSV results of a query, with a header, into a writeable 
+		binary file. This uses its own connection so that several queries 
+		can be copied at once from different threads."""
+	connection = psycopg2.connect(conn_string)
+	try:
+		c = connection.cursor()
+		query = c.mogrify(query.format(**conf['db']['tables']),params).decode('utf-8')
+		c.copy_expert( "COPY ({}) TO STDOUT WITH CSV HEADER".format(query), file )
+	finally:
+		connection.close()
+
+
+def stream_query(query,params,size=10000):
+	"""Read the results of a query with a server-side cursor on its own 
+		connection, so that any amount can be read in constant memory. Yields 
+		the column names first, then lists of up to size rows."""
+	connection = psycopg2.connect(conn_string)
+	try:
+		c = connection.cursor(name='stream')
+		c.itersize = size
+		c.execute( query.format(**conf['db']['tables']), params )
+		rows = c.fetchmany(size)
+		yield [ column[0] for column in c.description ]
+		while rows:
+			yield rows
+			rows = c.fetchmany(size)
+	finally:
+		connection.close()
+
+
+def copy_trips(file):
+	"""Bulk load trips from a CSV file with the columns insert_trip() sets, 
+		and orig_geom as hex EWKB in the local projection."""
+	c = cursor()
+	c.copy_expert(
+		"""
+			COPY {trips} 
+				( trip_id, block_id, route_id, direction_id, vehicle_id, times, orig_geom ) 
+			FROM STDIN WITH CSV
+		""".format(**conf['db']['tables']),
+		file
+	)
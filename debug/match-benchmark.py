@@ -0,0 +1,64 @@
+# Measures the throughput of the OSRM matching path, serially and with the
+# concurrent client, against a local stand-in server (see osrm_standin.py).
+# Run from the repository root, e.g.
+#
+#	python debug/match-benchmark.py --trips 200 --latency 0.05 --failure-rate 0.05
+
+import sys, os, time, random, argparse, threading
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from conf import conf
+import osrm, osrm_standin
+from minor_objects import Vehicle
+
+
+class FakeTrip(object):
+	"""Just enough of a trip for the matching client."""
+	def __init__(self,vehicles):
+		self.vehicles = vehicles
+
+
+def random_trip(rng,num_points):
+	"""A random walk of vehicle fixes, roughly 100m apart."""
+	lon, lat = -79.4 + rng.random()/10, 43.65 + rng.random()/10
+	vehicles = []
+	for i in range(num_points):
+		lon += 0.001 + rng.gauss(0,0.0002)
+		lat += rng.gauss(0,0.0002)
+		vehicles.append( Vehicle( 1500000000 + i*20, lon, lat ) )
+	return FakeTrip(vehicles)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--trips',type=int,default=100)
+parser.add_argument('--points',type=int,default=60,help='fixes per trip')
+parser.add_argument('--latency',type=float,default=0.05)
+parser.add_argument('--failure-rate',type=float,default=0)
+parser.add_argument('--port',type=int,default=5055)
+args = parser.parse_args()
+
+server = osrm_standin.serve(args.port,args.latency,args.failure_rate)
+threading.Thread(target=server.serve_forever,daemon=True).start()
+conf['OSRMserver']['url'] = 'http://localhost:'+str(args.port)
+conf['OSRMserver']['cache'] = None
+
+rng = random.Random(1)
+trips = [ random_trip(rng,args.points) for i in range(args.trips) ]
+
+start = time.time()
+failed = 0
+for trip in trips:
+	try:
+		osrm.fetch_match(trip.vehicles,conf['error_radius'])
+	except Exception:
+		failed += 1
+elapsed = time.time() - start
+print( 'serial: {:.1f} trips/s, {} failed'.format(len(trips)/elapsed,failed) )
+
+if osrm.aiohttp:
+	start = time.time()
+	results = osrm.AsyncMatcher().match_trips(trips)
+	elapsed = time.time() - start
+	failed = sum( 1 for r in results if None in r.values() )
+	print( 'concurrent: {:.1f} trips/s, {} failed'.format(len(trips)/elapsed,failed) )
+
+print( server.requests,'requests served,',server.failures,'failures injected' )
@@ -1,56 +1,92 @@
-﻿/*
-	This script measures the quality of trip matches. It uses psql 
-	variables and should be run with psql on a PostgreSQL 9.5+ database. 
-	You'll need to provide a table name prefix or otherwise change the 
+/*
+	This script measures the quality of trip matches. It reads the
+	route_quality table, which is kept up to date as trips are processed,
+	so it doesn't need to look at individual trips. It uses psql
+	variables and should be run with psql on a PostgreSQL 9.5+ database.
+	You'll need to provide a table name prefix or otherwise change the
 	table names to distinguish among agencies within a database.
 */
 
 -- set your table names here
 \set prefix					ttc_
 
-\set directions_table	:prefix'directions'
+\set route_quality_table	:prefix'route_quality'
 \set trips_table			:prefix'trips'
-\set stop_times_table	:prefix'stop_times'
-
-
-WITH stops_made AS (
-	--For each trip, get an array of stop_id's of stops made. 
-	--Can be Null.
-	SELECT 
-		t.trip_id,
-		CASE 
-			WHEN array_agg(stop_uid) = ARRAY[NULL::integer] THEN '{}'
-			ELSE array_agg(stop_uid ORDER BY stop_sequence) 
-		END AS stops,
-		COUNT(stop_uid) AS num_stops 
-	FROM :trips_table AS t 
-	LEFT JOIN :stop_times_table AS st ON t.trip_id = st.trip_id
-	GROUP BY t.trip_id
-), stops_given AS (
-	-- Same as above, but this is the list of scheduled stops.
-	SELECT 
-		DISTINCT ON (t.trip_id) t.trip_id, 
-		d.stops,
-		array_length(d.stops,1) AS num_stops 
-	FROM :trips_table AS t
-	JOIN :directions_table AS d 
-		ON t.direction_id = d.direction_id AND
-		d.report_time <= t.times[array_upper(t.times,1)]
-	ORDER BY t.trip_id, d.report_time ASC
+
+-- limit the service days measured (days since the epoch, see export.py)
+\set first_day				0
+\set last_day				32767
+
+
+\echo 'by route, worst average confidence first'
+WITH days AS (
+	SELECT * FROM :route_quality_table
+	WHERE service_id BETWEEN :first_day AND :last_day
+), buckets AS (
+	-- the coverage histogram for all days
+	SELECT route_id, i, SUM(n) AS n
+	FROM days, unnest(coverage) WITH ORDINALITY AS u(n,i)
+	GROUP BY route_id, i
+), cumulative AS (
+	SELECT
+		route_id, i, n,
+		SUM(n) OVER (PARTITION BY route_id ORDER BY i) /
+			NULLIF( SUM(n) OVER (PARTITION BY route_id), 0 ) AS share
+	FROM buckets
+), quantiles AS (
+	-- share of scheduled stops made, to the tenth below; 1.1 means more
+	-- stops than scheduled
+	SELECT
+		route_id,
+		array_agg(n ORDER BY i) AS coverage,
+		ARRAY[
+			( MIN(i) FILTER (WHERE share >= .05) - 1 ) / 10.0,
+			( MIN(i) FILTER (WHERE share >= .25) - 1 ) / 10.0,
+			( MIN(i) FILTER (WHERE share >= .50) - 1 ) / 10.0,
+			( MIN(i) FILTER (WHERE share >= .75) - 1 ) / 10.0,
+			( MIN(i) FILTER (WHERE share >= .95) - 1 ) / 10.0
+		] AS stop_quintiles
+	FROM cumulative
+	GROUP BY route_id
 )
-SELECT 
+SELECT
 	route_id,
-	COUNT(*) AS num_trips,
-	percentile_disc( array[.05,.25,.5,.75,.95] ) WITHIN GROUP ( ORDER BY ROUND(sm.num_stops::numeric/sg.num_stops,2) ) AS stop_quintiles,
+	SUM(trips) AS num_trips,
+	q.stop_quintiles,
 	-- average confidence of matched trips (including default = 1)
-	round( AVG(match_confidence)::numeric, 4 ) AS avg_confidence,
-	-- trip_id's of trips making less than half of stops
-	( array_agg(t.trip_id ORDER BY match_confidence * random() ASC ) FILTER (WHERE sm.num_stops < sg.num_stops/2) )[1:3] AS too_few_stops,
-	-- trip_id's of trips making more stops than scheduled
-	( array_agg(t.trip_id ORDER BY random()) FILTER (WHERE sm.num_stops > sg.num_stops) )[1:3] AS too_many_stops
-FROM :trips_table AS t 
-JOIN stops_made AS sm ON t.trip_id = sm.trip_id
-JOIN stops_given AS sg ON t.trip_id = sg.trip_id
-WHERE t.problem NOT IN ('too short','too few vehicles') OR t.problem IS NULL
-GROUP by route_id 
+	round( ( SUM(confidence_sum) / NULLIF(SUM(matched_trips),0) )::numeric, 4 ) AS avg_confidence,
+	round( SUM(stops_made)::numeric / SUM(stops_scheduled), 3 ) AS stop_coverage,
+	SUM(too_few_stops) AS too_few_stops,
+	SUM(too_many_stops) AS too_many_stops,
+	q.coverage
+FROM days JOIN quantiles AS q USING (route_id)
+GROUP BY route_id, q.stop_quintiles, q.coverage
 ORDER BY avg_confidence ASC;
+
+
+\echo 'by service day'
+SELECT
+	to_char( 'epoch'::date + service_id, 'YYYY-MM-DD' ) AS day,
+	SUM(trips) AS num_trips,
+	round( ( SUM(confidence_sum) / NULLIF(SUM(matched_trips),0) )::numeric, 4 ) AS avg_confidence,
+	round( SUM(stops_made)::numeric / SUM(stops_scheduled), 3 ) AS stop_coverage,
+	SUM(too_few_stops) AS too_few_stops,
+	SUM(too_many_stops) AS too_many_stops
+FROM :route_quality_table
+WHERE service_id BETWEEN :first_day AND :last_day
+GROUP BY service_id
+ORDER BY service_id;
+
+
+-- examples of trips making too few or too many stops on a route, e.g.
+-- \set route 504
+\if :{?route}
+\echo 'trips on route' :route 'making less than half or more than all scheduled stops'
+SELECT trip_id, stops_made, stops_scheduled, match_confidence
+FROM :trips_table
+WHERE
+	route_id = :'route' AND
+	( stops_made < stops_scheduled / 2.0 OR stops_made > stops_scheduled )
+ORDER BY random()
+LIMIT 6;
+\endif
@@ -0,0 +1,90 @@
+/*
+	Route quality measures are now counted as trips are processed. This
+	script fills them in, once, for trips processed before that, replacing
+	anything in the route_quality table. It uses psql variables and should
+	be run with psql. Set the variables just below to match your own
+	configuration.
+*/
+
+-- set your table name prefix
+\set prefix                'ttc_'
+-- timezone, as conf['timezone']
+\set tz                    'America/Toronto'
+
+\set trips_table           :prefix'trips'
+\set stop_times_table      :prefix'stop_times'
+\set directions_table      :prefix'directions'
+\set route_quality_table   :prefix'route_quality'
+
+
+-- stops made and scheduled, for trips that were long enough to match and
+-- didn't fail for want of a connection
+\echo 'counting stops made and scheduled'
+WITH made AS (
+	SELECT trip_id, COUNT(*) AS n
+	FROM :stop_times_table
+	GROUP BY trip_id
+), scheduled AS (
+	-- the version of the direction in effect at the end of the trip
+	SELECT DISTINCT ON (t.trip_id)
+		t.trip_id,
+		array_length(d.stops,1) AS n
+	FROM :trips_table AS t
+	JOIN :directions_table AS d
+		ON t.direction_id = d.direction_id AND
+		d.report_time <= t.times[array_upper(t.times,1)]
+	ORDER BY t.trip_id, d.report_time DESC
+)
+UPDATE :trips_table AS t SET
+	stops_made = COALESCE(made.n,0),
+	stops_scheduled = scheduled.n
+FROM scheduled LEFT JOIN made USING (trip_id)
+WHERE
+	t.trip_id = scheduled.trip_id AND
+	COALESCE(t.problem,'') NOT LIKE '%too short%' AND
+	COALESCE(t.problem,'') NOT LIKE '%too few vehicles%' AND
+	COALESCE(t.problem,'') NOT LIKE '%connection issue%';
+
+
+\echo 'summarizing by route, direction and day'
+TRUNCATE :route_quality_table;
+WITH counted AS (
+	SELECT
+		*,
+		(to_timestamp(times[1]) AT TIME ZONE :'tz')::date - 'epoch'::date AS day,
+		CASE
+			WHEN stops_made > stops_scheduled THEN 12
+			ELSE LEAST(FLOOR(10.0 * stops_made / stops_scheduled),10)::integer + 1
+		END AS bucket
+	FROM :trips_table
+	WHERE stops_scheduled > 0
+), histograms AS (
+	SELECT k.route_id, k.direction_id, k.day, array_agg(COALESCE(n,0) ORDER BY i) AS coverage
+	FROM (SELECT DISTINCT route_id, direction_id, day FROM counted) AS k
+	CROSS JOIN generate_series(1,12) AS i
+	LEFT JOIN (
+		SELECT route_id, direction_id, day, bucket, COUNT(*) AS n
+		FROM counted
+		GROUP BY route_id, direction_id, day, bucket
+	) AS b ON
+		b.route_id = k.route_id AND
+		b.direction_id = k.direction_id AND
+		b.day = k.day AND
+		b.bucket = i
+	GROUP BY k.route_id, k.direction_id, k.day
+)
+INSERT INTO :route_quality_table
+SELECT
+	route_id,
+	direction_id,
+	day,
+	COUNT(*),
+	COUNT(match_confidence),
+	COALESCE(SUM(match_confidence),0),
+	SUM(stops_made),
+	SUM(stops_scheduled),
+	COUNT(*) FILTER (WHERE stops_made < stops_scheduled / 2.0),
+	COUNT(*) FILTER (WHERE stops_made > stops_scheduled),
+	h.coverage
+FROM counted JOIN histograms AS h USING (route_id, direction_id, day)
+GROUP BY route_id, direction_id, day, h.coverage;
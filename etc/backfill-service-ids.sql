@@ -0,0 +1,54 @@
+/*
+	Stop times now get their service_id and fake_stop_id when they are 
+	stored. This script fills them in, once, for data stored before that. 
+	It uses psql variables and should be run with psql. Set the variables 
+	just below to match your own configuration.
+*/
+
+-- set your table name prefix
+\set prefix            'ttc_'
+-- timezone, as conf['timezone']
+\set tz                'America/Toronto'
+
+\set trips_table       :prefix'trips'
+\set stop_times_table  :prefix'stop_times'
+
+
+-- set the service_id of trips based on the time of their first stop
+-- service_id is the number of days since the local epoch to ensure
+-- unique values per day
+\echo 'setting missing service_ids'
+WITH sub AS (
+	SELECT 
+		t.trip_id, 
+		( to_timestamp(st.etime) AT TIME ZONE :'tz' )::date - 'epoch'::date AS service_id
+	FROM :trips_table AS t 
+	JOIN :stop_times_table AS st
+		ON t.trip_id = st.trip_id AND st.stop_sequence = 1
+	WHERE t.service_id IS NULL
+)
+UPDATE :trips_table AS t SET service_id = sub.service_id
+FROM sub 
+WHERE t.trip_id = sub.trip_id;
+
+
+-- repeated visits to a stop on a trip get an underscore for each earlier visit
+\echo 'setting missing fake_stop_ids'
+WITH sub AS (
+	SELECT 
+		trip_id,
+		stop_sequence,
+		stop_uid || repeat(
+			'_'::text,
+			(row_number() OVER (PARTITION BY trip_id, stop_uid ORDER BY etime ASC))::int - 1
+		) AS fake_id
+	FROM :stop_times_table
+	WHERE trip_id IN (
+		SELECT trip_id FROM :stop_times_table WHERE fake_stop_id IS NULL
+	)
+)
+UPDATE :stop_times_table AS st SET fake_stop_id = sub.fake_id
+FROM sub 
+WHERE 
+	st.trip_id = sub.trip_id AND 
+	st.stop_sequence = sub.stop_sequence;
@@ -63,18 +63,69 @@ CREATE TABLE TRIPS (
 	-- service_id is a local variant on the number of days since the UNIX epoch
 	SERVICE_ID SMALLINT,
 	VEHICLE_ID VARCHAR,
-	BLOCK_ID INTEGER,
+	BLOCK_ID INTEGER, -- the agency's, or negative where trips were linked here
 	MATCH_CONFIDENCE REAL,
 	-- this trip has not been processed or has been processed unsucessfully
 	IGNORE BOOLEAN DEFAULT TRUE,
 	-- debugging fields
 	MATCH_GEOM GEOMETRY (MULTILINESTRING, 26917), -- map-matched route geometry
 	CLEAN_GEOM GEOMETRY (LINESTRING, 26917), -- geometry of points used in map matching
-	PROBLEM VARCHAR DEFAULT '' -- description of any problems that arise
+	PROBLEM VARCHAR DEFAULT '', -- description of any problems that arise
+	-- hash of the inputs and parameters the trip was last processed with
+	FINGERPRINT VARCHAR,
+	-- when the trip's exportable data last changed (epoch time)
+	MODIFIED DOUBLE PRECISION,
+	-- the shared shape most like match_geom; see SHAPES below
+	SHAPE_ID INTEGER,
+	-- match_geom came from map-matching, not a default route or a known 
+	-- shape; only these trips teach shape_library.py new paths
+	MAP_MATCHED BOOLEAN,
+	-- stops located on the match, and in the schedule; see ROUTE_QUALITY
+	STOPS_MADE INTEGER,
+	STOPS_SCHEDULED INTEGER
 );
 
 CREATE INDEX ON TRIPS (TRIP_ID);
 
+/*
+Equivalent to the GTFS shapes table. Trips on the same route and direction 
+whose (simplified) match geometries are nearly identical share a shape.
+*/
+-- DROP TABLE IF EXISTS 'pt_test_shapes';
+CREATE TABLE SHAPES (
+	SHAPE_ID SERIAL PRIMARY KEY,
+	ROUTE_ID VARCHAR,
+	DIRECTION_ID VARCHAR,
+	THE_GEOM GEOMETRY (MULTILINESTRING, 26917)
+);
+
+CREATE INDEX ON SHAPES (ROUTE_ID, DIRECTION_ID);
+CREATE INDEX ON SHAPES USING GIST (THE_GEOM);
+
+/*
+Running measures of match quality by route, direction and service day 
+(the local day of a trip's first report), kept up to date as trips are 
+processed. Only trips that were long enough to match and whose direction 
+has scheduled stops are counted. See debug/route-quality-measures.sql.
+*/
+-- DROP TABLE IF EXISTS 'pt_test_route_quality';
+CREATE TABLE ROUTE_QUALITY (
+	ROUTE_ID VARCHAR,
+	DIRECTION_ID VARCHAR,
+	SERVICE_ID SMALLINT,
+	TRIPS INTEGER,
+	MATCHED_TRIPS INTEGER, -- trips with a match_confidence
+	CONFIDENCE_SUM DOUBLE PRECISION, -- of matched trips
+	STOPS_MADE INTEGER,
+	STOPS_SCHEDULED INTEGER,
+	TOO_FEW_STOPS INTEGER, -- trips making less than half of scheduled stops
+	TOO_MANY_STOPS INTEGER, -- trips making more stops than scheduled
+	-- number of trips making 0-10%, 10-20% ... 90-100%, all, and more 
+	-- than all of the scheduled stops
+	COVERAGE INTEGER[],
+	PRIMARY KEY (ROUTE_ID, DIRECTION_ID, SERVICE_ID)
+);
+
 /*
 Where interpolated stop times are stored for each trip. 
 */
@@ -0,0 +1,66 @@
+/*
+	Brings the tables of an existing agency, created with an earlier
+	version of create-agency-tables.sql, up to date by adding the columns
+	and tables that have since been added to it. Running it again does
+	nothing. It uses psql variables and should be run with psql. Set the
+	variables just below to match your own configuration. Afterwards, run
+	backfill-service-ids.sql and backfill-route-quality.sql to fill in the
+	new columns for trips processed before.
+*/
+
+-- set your table name prefix
+\set prefix                'ttc_'
+-- local projection, as conf['localEPSG']
+\set srid                  26917
+
+\set trips_table           :prefix'trips'
+\set shapes_table          :prefix'shapes'
+\set route_quality_table   :prefix'route_quality'
+\set shapes_route_index    :prefix'shapes_route_id_direction_id_idx'
+\set shapes_geom_index     :prefix'shapes_the_geom_idx'
+
+
+\echo 'adding columns to' :trips_table
+ALTER TABLE :trips_table
+	-- hash of the inputs and parameters the trip was last processed with
+	ADD COLUMN IF NOT EXISTS fingerprint VARCHAR,
+	-- when the trip's exportable data last changed (epoch time)
+	ADD COLUMN IF NOT EXISTS modified DOUBLE PRECISION,
+	-- the shared shape most like match_geom
+	ADD COLUMN IF NOT EXISTS shape_id INTEGER,
+	-- match_geom came from map-matching, not a default route or known shape
+	ADD COLUMN IF NOT EXISTS map_matched BOOLEAN,
+	-- stops located on the match, and in the schedule
+	ADD COLUMN IF NOT EXISTS stops_made INTEGER,
+	ADD COLUMN IF NOT EXISTS stops_scheduled INTEGER;
+
+
+\echo 'creating' :shapes_table
+CREATE TABLE IF NOT EXISTS :shapes_table (
+	shape_id SERIAL PRIMARY KEY,
+	route_id VARCHAR,
+	direction_id VARCHAR,
+	the_geom GEOMETRY (MULTILINESTRING, :srid)
+);
+
+CREATE INDEX IF NOT EXISTS :shapes_route_index
+	ON :shapes_table (route_id, direction_id);
+CREATE INDEX IF NOT EXISTS :shapes_geom_index
+	ON :shapes_table USING GIST (the_geom);
+
+
+\echo 'creating' :route_quality_table
+CREATE TABLE IF NOT EXISTS :route_quality_table (
+	route_id VARCHAR,
+	direction_id VARCHAR,
+	service_id SMALLINT,
+	trips INTEGER,
+	matched_trips INTEGER,
+	confidence_sum DOUBLE PRECISION,
+	stops_made INTEGER,
+	stops_scheduled INTEGER,
+	too_few_stops INTEGER,
+	too_many_stops INTEGER,
+	coverage INTEGER[],
+	PRIMARY KEY (route_id, direction_id, service_id)
+);
@@ -0,0 +1,391 @@
+# call this file to export processed trips as a GTFS feed. e.g.
+#
+#	python export.py --start 2017-11-01 --end 2017-11-30 --output output/ttc.zip
+#
+# Without --start and --end, every service day with useable trips is
+# exported. The tables for each service day are kept as CSV slices in a
+# directory next to the feed (e.g. output/ttc.days/), and only days whose
+# trips have changed since they were last exported are regenerated. Each
+# slice table is streamed out of the database with COPY ... TO STDOUT,
+# several at once, and the feed is assembled by concatenating slices.
+#
+# With --format parquet or arrow, the same tables (and more about each 
+# trip) are written instead as a directory of typed columnar files, 
+# partitioned by service day, for analysis. e.g. with pyarrow:
+#
+#	pyarrow.dataset.dataset('output/ttc.parquet/stop_times',partitioning='hive')
+
+import os, csv, json, shutil, argparse, zipfile
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from conf import conf
+import db
+
+# pyarrow is only needed for Parquet and Arrow export
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+# query for each GTFS table, by file name. %(service_ids)s is the list of
+# service days to export and %(tz)s the local timezone
+TABLES = {
+	'calendar_dates.txt': """
+		SELECT DISTINCT
+			service_id,
+			to_char(TIMESTAMP 'EPOCH' + (service_id * INTERVAL '1 day'),'YYYYMMDD') AS date,
+			1 AS exception_type
+		FROM {trips}
+		WHERE NOT ignore AND service_id = ANY(%(service_ids)s)
+		ORDER BY service_id ASC
+	""",
+	'stops.txt': """
+		SELECT DISTINCT
+			st.fake_stop_id AS stop_id,
+			s.stop_code::varchar,
+			s.stop_name,
+			s.lat AS stop_lat,
+			s.lon AS stop_lon
+		FROM {trips} AS t
+		JOIN {stop_times} AS st ON t.trip_id = st.trip_id
+		JOIN {stops} AS s ON s.uid = st.stop_uid
+		WHERE t.service_id = ANY(%(service_ids)s) AND NOT t.ignore
+	""",
+	'routes.txt': """
+		SELECT DISTINCT
+			route_id,
+			1 AS agency_id, -- all the same agency
+			route_id::varchar AS route_short_name,
+			'' AS route_long_name,
+			3 AS route_type -- LET THEM RIDE BUSES
+		FROM {trips}
+		WHERE service_id = ANY(%(service_ids)s) AND NOT ignore
+	""",
+	'trips.txt': """
+		SELECT
+			t.route_id::varchar,
+			t.service_id,
+			t.trip_id,
+			t.block_id,
+			'shp_'||shape_id AS shape_id
+		FROM {trips} AS t
+		WHERE service_id = ANY(%(service_ids)s) AND NOT ignore
+	""",
+	'stop_times.txt': """
+		SELECT
+			t.trip_id,
+			-- times are relative to the service day, so that they can extend
+			-- beyond midnight
+			EXTRACT( EPOCH FROM
+				to_timestamp(round(st.etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + t.service_id * INTERVAL '1 day')::date
+			) * INTERVAL '1 second' AS arrival_time,
+			EXTRACT( EPOCH FROM
+				to_timestamp(round(st.etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + t.service_id * INTERVAL '1 day')::date
+			) * INTERVAL '1 second' AS departure_time,
+			stop_sequence,
+			fake_stop_id AS stop_id,
+			0 AS pickup_type,
+			0 AS drop_off_type,
+			NULL::int AS timepoint
+		FROM {stop_times} AS st JOIN {trips} AS t ON st.trip_id = t.trip_id
+		WHERE service_id = ANY(%(service_ids)s) AND NOT t.ignore
+		ORDER BY trip_id, stop_sequence ASC
+	""",
+	'shapes.txt': """
+		-- shapes used by any of the trips; this simply fills in the gaps in
+		-- multilines
+		SELECT
+			shape_id,
+			-- path is an array of [line number, point number]
+			row_number() OVER (PARTITION BY shape_id ORDER BY path ASC) AS shape_pt_sequence,
+			ST_X(ST_Transform(geom,4326))::real AS shape_pt_lon,
+			ST_Y(ST_Transform(geom,4326))::real AS shape_pt_lat
+		FROM (
+			SELECT
+				'shp_'||shape_id AS shape_id,
+				(ST_DumpPoints(the_geom)).*
+			FROM {shapes}
+			WHERE shape_id IN (
+				SELECT shape_id FROM {trips}
+				WHERE service_id = ANY(%(service_ids)s) AND NOT ignore
+			)
+		) AS sub
+	"""
+}
+
+
+# the same tables for columnar export, with typed columns and a little more 
+# about each trip. Times are seconds after midnight of the service day. 
+# service_id is the partition key so isn't a column
+COLUMNAR_TABLES = {
+	'calendar_dates': ( """
+		SELECT DISTINCT
+			to_char(TIMESTAMP 'EPOCH' + (service_id * INTERVAL '1 day'),'YYYYMMDD') AS date
+		FROM {trips}
+		WHERE NOT ignore AND service_id = ANY(%(service_ids)s)
+	""", [ ('date','string') ] ),
+	'stops': ( """
+		SELECT DISTINCT
+			st.fake_stop_id AS stop_id,
+			s.uid AS stop_uid,
+			s.stop_code::varchar,
+			s.stop_name::varchar,
+			s.lat::float AS stop_lat,
+			s.lon::float AS stop_lon
+		FROM {trips} AS t
+		JOIN {stop_times} AS st ON t.trip_id = st.trip_id
+		JOIN {stops} AS s ON s.uid = st.stop_uid
+		WHERE t.service_id = ANY(%(service_ids)s) AND NOT t.ignore
+	""", [
+		('stop_id','string'), ('stop_uid','int32'), ('stop_code','string'), 
+		('stop_name','string'), ('stop_lat','double'), ('stop_lon','double')
+	] ),
+	'routes': ( """
+		SELECT DISTINCT route_id::varchar
+		FROM {trips}
+		WHERE service_id = ANY(%(service_ids)s) AND NOT ignore
+	""", [ ('route_id','string') ] ),
+	# all trips, including those that couldn't be used, and why. Those are 
+	# kept under the local day of their first report; see db.TRIP_DAY
+	'trips': ( """
+		SELECT
+			t.trip_id,
+			t.route_id::varchar,
+			t.direction_id::varchar,
+			t.block_id,
+			t.vehicle_id::varchar,
+			'shp_'||t.shape_id AS shape_id,
+			t.match_confidence,
+			t.ignore,
+			t.problem::varchar
+		FROM {trips} AS t
+		WHERE """ + db.TRIP_DAY + """ = ANY(%(service_ids)s)
+	""", [
+		('trip_id','int32'), ('route_id','string'), ('direction_id','string'), 
+		('block_id','int32'), ('vehicle_id','string'), ('shape_id','string'), 
+		('match_confidence','float'), ('ignore','bool'), ('problem','string')
+	] ),
+	'stop_times': ( """
+		SELECT
+			t.trip_id,
+			st.stop_sequence,
+			st.fake_stop_id AS stop_id,
+			st.stop_uid,
+			st.etime,
+			EXTRACT( EPOCH FROM
+				to_timestamp(round(st.etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + t.service_id * INTERVAL '1 day')::date
+			)::integer AS arrival_time
+		FROM {stop_times} AS st JOIN {trips} AS t ON st.trip_id = t.trip_id
+		WHERE service_id = ANY(%(service_ids)s) AND NOT t.ignore
+		ORDER BY trip_id, stop_sequence ASC
+	""", [
+		('trip_id','int32'), ('stop_sequence','int32'), ('stop_id','string'), 
+		('stop_uid','int32'), ('etime','double'), ('arrival_time','int32')
+	] ),
+	'shapes': ( """
+		SELECT
+			'shp_'||shape_id AS shape_id,
+			row_number() OVER (PARTITION BY shape_id ORDER BY path ASC)::integer AS shape_pt_sequence,
+			ST_X(ST_Transform(geom,4326)) AS shape_pt_lon,
+			ST_Y(ST_Transform(geom,4326)) AS shape_pt_lat
+		FROM (
+			SELECT shape_id, (ST_DumpPoints(the_geom)).*
+			FROM {shapes}
+			WHERE shape_id IN (
+				SELECT shape_id FROM {trips}
+				WHERE service_id = ANY(%(service_ids)s) AND NOT ignore
+			)
+		) AS sub
+	""", [
+		('shape_id','string'), ('shape_pt_sequence','int32'), 
+		('shape_pt_lon','double'), ('shape_pt_lat','double')
+	] )
+}
+
+
+def service_id(day):
+	"""The service_id of a date: days since the epoch."""
+	return (day - date(1970,1,1)).days
+
+
+def write_agency(path):
+	"""agency.txt doesn't come from the database."""
+	with open(path,'w',newline='') as f:
+		writer = csv.writer(f,lineterminator='\n')
+		writer.writerow(['agency_id','agency_name','agency_url','agency_timezone'])
+		writer.writerow([1,conf['agency'],conf.get('agency_url',''),conf['timezone']])
+
+
+def export_table(name,service_id,directory):
+	"""Stream one table for one service day into the day's directory."""
+	with open(os.path.join(directory,name),'wb') as f:
+		db.copy_query( TABLES[name], { 'service_ids':[service_id], 'tz':conf['timezone'] }, f )
+
+
+def export_days(service_ids,slices,workers=None):
+	"""Export all tables of the given service days into their slice 
+		directories, several tables at once."""
+	jobs = []
+	for s in service_ids:
+		directory = os.path.join(slices,str(s))
+		shutil.rmtree(directory,ignore_errors=True)
+		os.makedirs(directory)
+		jobs += [ (name,s,directory) for name in TABLES ]
+	with ThreadPoolExecutor(workers or len(TABLES)) as pool:
+		list( pool.map( lambda job: export_table(*job), jobs ) )
+
+
+def concatenate(feed,name,directories):
+	"""Write a table into the zip from its slices, with one header. Stops, 
+		routes and shapes may be in more than one slice and are only written 
+		once."""
+	seen = set()		# stop and route lines
+	seen_shapes = set()	# shape_ids from earlier slices
+	with feed.open(name,'w') as out:
+		for i, directory in enumerate(directories):
+			slice_shapes = set()
+			with open(os.path.join(directory,name),'rb') as f:
+				header = f.readline()
+				if i == 0:
+					out.write(header)
+				for line in f:
+					if name in ('stops.txt','routes.txt'):
+						if line in seen: continue
+						seen.add(line)
+					elif name == 'shapes.txt':
+						shape_id = line.split(b',',1)[0]
+						if shape_id in seen_shapes: continue
+						slice_shapes.add(shape_id)
+					out.write(line)
+			seen_shapes |= slice_shapes
+
+
+def save_manifest(manifest,path):
+	with open(path,'w') as f:
+		json.dump(manifest,f)
+
+
+def update_days(directory,service_ids,all_service_ids,full,export_days,remove_day,include_ignored=False):
+	"""Bring per-day output in a directory up to date. export_days(changed) 
+		is called with the service days that changed since they were last 
+		exported (or all of them if full), and remove_day(s) for days that no 
+		longer have any trips. Each day's signature when exported is kept in 
+		a manifest in the directory. Ignored trips count if include_ignored."""
+	manifest_path = os.path.join(directory,'manifest.json')
+	os.makedirs(directory,exist_ok=True)
+	manifest = {}
+	if os.path.exists(manifest_path) and not full:
+		with open(manifest_path) as f:
+			manifest = { int(s):signature for s, signature in json.load(f).items() }
+	signatures = db.get_service_day_signatures(service_ids,include_ignored)
+	changed = [ s for s in service_ids if manifest.get(s) != signatures[s] ]
+	print( 'exporting',len(changed),'of',len(service_ids),'service days' )
+	# forget days that are changing, in case we don't finish, and days that 
+	# no longer have any trips
+	for s in set(manifest) - set(all_service_ids):
+		remove_day(s)
+	manifest = { s:signature for s, signature in manifest.items() 
+		if s in all_service_ids and s not in changed }
+	save_manifest(manifest,manifest_path)
+	export_days(changed)
+	manifest.update( { s:signatures[s] for s in changed } )
+	save_manifest(manifest,manifest_path)
+
+
+def select_days(start,end,include_ignored=False):
+	"""Return all service days with trips, and those between the start and 
+		end dates (inclusive, either may be None)."""
+	all_service_ids = db.get_service_ids(include_ignored)
+	service_ids = [ s for s in all_service_ids if 
+		( not start or s >= service_id(start) ) and ( not end or s <= service_id(end) )
+	]
+	return service_ids, all_service_ids
+
+
+def export(zip_path,start=None,end=None,workers=None,full=False):
+	"""Export the service days between the start and end dates (inclusive, 
+		either may be None) as a zipped GTFS feed, regenerating only the 
+		slices of days that have changed, or all of them if full."""
+	service_ids, all_service_ids = select_days(start,end)
+	slices = os.path.splitext(zip_path)[0] + '.days'
+	update_days( slices, service_ids, all_service_ids, full,
+		lambda changed: export_days(changed,slices,workers),
+		lambda s: shutil.rmtree( os.path.join(slices,str(s)), ignore_errors=True )
+	)
+	# assemble the feed
+	write_agency( os.path.join(slices,'agency.txt') )
+	directories = [ os.path.join(slices,str(s)) for s in service_ids ]
+	with zipfile.ZipFile(zip_path,'w',zipfile.ZIP_DEFLATED) as feed:
+		feed.write( os.path.join(slices,'agency.txt'), 'agency.txt' )
+		for name in TABLES:
+			concatenate(feed,name,directories)
+	print( 'wrote',zip_path )
+
+
+def columnar_path(directory,name,service_id,file_format):
+	"""Hive-style partition of a columnar table for a service day."""
+	return os.path.join( directory, name, 'service_id={}'.format(service_id), 'part.'+file_format )
+
+
+def export_columnar_table(name,service_id,directory,file_format):
+	"""Stream one table for one service day into a Parquet or Arrow IPC 
+		file, a batch of rows at a time."""
+	query, columns = COLUMNAR_TABLES[name]
+	schema = pa.schema([ (column,pa.type_for_alias(type_name)) for column, type_name in columns ])
+	path = columnar_path(directory,name,service_id,file_format)
+	os.makedirs(os.path.dirname(path),exist_ok=True)
+	stream = db.stream_query( query, { 'service_ids':[service_id], 'tz':conf['timezone'] } )
+	next(stream) # column names, which we already know
+	if file_format == 'parquet':
+		writer = pq.ParquetWriter(path,schema,compression='zstd')
+	else:
+		writer = pa.ipc.new_file(path,schema)
+	with writer:
+		for rows in stream:
+			writer.write_table( pa.Table.from_arrays(
+				[ pa.array(values,type=field.type) for values, field in zip(zip(*rows),schema) ],
+				schema=schema
+			) )
+
+
+def export_columnar(directory,file_format,start=None,end=None,workers=None,full=False):
+	"""Export the service days between the start and end dates as a 
+		directory of Parquet or Arrow IPC files partitioned by service day, 
+		regenerating only days that have changed, or all of them if full."""
+	if pa is None:
+		raise ImportError('pyarrow is required for columnar export')
+	# the trips table has ignored trips too
+	service_ids, all_service_ids = select_days(start,end,include_ignored=True)
+	def remove_day(s):
+		for name in COLUMNAR_TABLES:
+			shutil.rmtree( os.path.dirname(columnar_path(directory,name,s,file_format)), ignore_errors=True )
+	def export_changed(changed):
+		for s in changed:
+			remove_day(s)
+		jobs = [ (name,s,directory,file_format) for s in changed for name in COLUMNAR_TABLES ]
+		with ThreadPoolExecutor(workers or len(COLUMNAR_TABLES)) as pool:
+			list( pool.map( lambda job: export_columnar_table(*job), jobs ) )
+	update_days(directory,service_ids,all_service_ids,full,export_changed,remove_day,True)
+	print( 'wrote',directory )
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Export processed trips as GTFS')
+	parser.add_argument('--start',type=date.fromisoformat,help='first service day, YYYY-MM-DD')
+	parser.add_argument('--end',type=date.fromisoformat,help='last service day, YYYY-MM-DD')
+	parser.add_argument('--format',choices=['gtfs','parquet','arrow'],default='gtfs',
+		help='a GTFS zip, or a directory of Parquet or Arrow IPC files for analysis')
+	parser.add_argument('--output',help='default output/<agency>.zip, .parquet or .arrow')
+	parser.add_argument('--workers',type=int,help='tables exported at once')
+	parser.add_argument('--full',action='store_true',help='regenerate every service day')
+	args = parser.parse_args()
+	extension = { 'gtfs':'.zip', 'parquet':'.parquet', 'arrow':'.arrow' }[args.format]
+	output = args.output or os.path.join('output',conf['agency']+extension)
+	if args.format == 'gtfs':
+		export(output,args.start,args.end,args.workers,args.full)
+	else:
+		export_columnar(output,args.format,args.start,args.end,args.workers,args.full)
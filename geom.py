@@ -1,6 +1,9 @@
 # custom shapely geometry functions
 from shapely.geometry import Point, LineString, MultiLineString
-from math import sqrt
+from math import sqrt, floor
+from bisect import bisect_right
+from collections import defaultdict
+import numpy as np
 
 def cut(lines, distance):
 	"""Cuts a MultiLineString into two MultiLineStrings at a distance from 
@@ -45,6 +48,165 @@ def cut(lines, distance):
 				assert abs((distance + tail_end.length) - lines.length ) < 0.001
 				return (head_end,tail_end)
 	
+class GridIndex(object):
+	"""A uniform grid for finding items near a location without checking 
+		every item. Items are registered in each cell their bounding box 
+		touches."""
+
+	def __init__(self,cell_size):
+		self.cell_size = cell_size
+		self.cells = defaultdict(list)
+		self.size = 0	# number of items
+
+	def cell_range(self,minx,miny,maxx,maxy):
+		cs = self.cell_size
+		for cx in range( floor(minx/cs), floor(maxx/cs)+1 ):
+			for cy in range( floor(miny/cs), floor(maxy/cs)+1 ):
+				yield (cx,cy)
+
+	def insert(self,item,minx,miny,maxx,maxy):
+		for cell in self.cell_range(minx,miny,maxx,maxy):
+			self.cells[cell].append(item)
+		self.size += 1
+
+	def query(self,minx,miny,maxx,maxy):
+		"""Return the set of items whose bounding boxes may intersect this one."""
+		found = set()
+		for cell in self.cell_range(minx,miny,maxx,maxy):
+			found.update( self.cells.get(cell,()) )
+		return found
+
+
+class LinearReference(object):
+	"""Linear referencing along a MultiLineString, measured as shapely does: 
+		as though the parts were joined end to end. Segment coordinates and 
+		cumulative lengths are computed once, so that many points can be 
+		located along the line without re-walking it each time."""
+
+	def __init__(self,lines,cell_size=100):
+		starts, ends = [], []
+		for line in lines.geoms:
+			coords = list(line.coords)
+			starts += coords[:-1]
+			ends += coords[1:]
+		self.x1, self.y1 = np.array(starts).reshape(-1,2).T
+		self.x2, self.y2 = np.array(ends).reshape(-1,2).T
+		self.dx = self.x2 - self.x1
+		self.dy = self.y2 - self.y1
+		self.seg_length = np.hypot(self.dx,self.dy)
+		# measure at the start of each segment, and at the end of the last
+		self.cum_length = np.concatenate( ([0],np.cumsum(self.seg_length)) )
+		self.length = self.cum_length[-1]
+		# spatial index of segments
+		self.index = GridIndex(cell_size)
+		for i in range(len(self.seg_length)):
+			self.index.insert( i,
+				min(self.x1[i],self.x2[i]), min(self.y1[i],self.y2[i]),
+				max(self.x1[i],self.x2[i]), max(self.y1[i],self.y2[i])
+			)
+
+	def segment_distances(self,x,y,segments):
+		"""Return the distance from a point to each of the given segments and 
+			the measure of the closest point on each."""
+		dx, dy = self.dx[segments], self.dy[segments]
+		sq_length = dx**2 + dy**2
+		with np.errstate(invalid='ignore',divide='ignore'):
+			t = ( (x-self.x1[segments])*dx + (y-self.y1[segments])*dy ) / sq_length
+		t = np.clip( np.nan_to_num(t), 0, 1 )
+		distances = np.hypot( self.x1[segments] + t*dx - x, self.y1[segments] + t*dy - y )
+		measures = self.cum_length[segments] + t * self.seg_length[segments]
+		return distances, measures
+
+	def locate(self,points,max_distance=None):
+		"""Return arrays of the measure along the line of the closest point to 
+			each of the given points and the distance from the line. Given a 
+			max_distance, only nearby segments are checked and points further 
+			away than that get NaN for both."""
+		measures = np.full(len(points),np.nan)
+		distances = np.full(len(points),np.nan)
+		all_segments = np.arange(len(self.seg_length))
+		for i, point in enumerate(points):
+			if max_distance is None:
+				segments = all_segments
+			else:
+				segments = self.nearby_segments(point,max_distance)
+				if len(segments) == 0:
+					continue
+			d, m = self.segment_distances(point.x,point.y,segments)
+			closest = np.argmin(d)
+			if max_distance is None or d[closest] <= max_distance:
+				distances[i], measures[i] = d[closest], m[closest]
+		return measures, distances
+
+	def project(self,points,max_distance=None):
+		return self.locate(points,max_distance)[0]
+
+	def distance(self,points,max_distance=None):
+		return self.locate(points,max_distance)[1]
+
+	def nearby_segments(self,point,max_distance):
+		"""Return the sorted indices of segments whose bounding boxes are 
+			within max_distance of the point."""
+		return np.array( sorted( self.index.query(
+			point.x-max_distance, point.y-max_distance,
+			point.x+max_distance, point.y+max_distance
+		) ), dtype=int )
+
+	def nearby_items(self,index,max_distance):
+		"""Return the set of items in a GridIndex which may be within 
+			max_distance of the line, checking each segment's surroundings."""
+		found = set()
+		for i in range(len(self.seg_length)):
+			found.update( index.query(
+				min(self.x1[i],self.x2[i]) - max_distance, 
+				min(self.y1[i],self.y2[i]) - max_distance,
+				max(self.x1[i],self.x2[i]) + max_distance, 
+				max(self.y1[i],self.y2[i]) + max_distance
+			) )
+		return found
+
+	def visits(self,point,max_distance):
+		"""Return a (measure,distance) tuple for each separate time the line 
+			passes within max_distance of the point, i.e. for each run of 
+			consecutive segments within that distance."""
+		segments = self.nearby_segments(point,max_distance)
+		if len(segments) == 0:
+			return []
+		distances, measures = self.segment_distances(point.x,point.y,segments)
+		near = distances <= max_distance
+		segments, distances, measures = segments[near], distances[near], measures[near]
+		visits = []
+		# split where segment numbers are not consecutive
+		for run in np.split( np.arange(len(segments)), np.nonzero(np.diff(segments) > 1)[0] + 1 ):
+			if len(run) == 0:
+				continue
+			closest = run[ np.argmin(distances[run]) ]
+			visits.append( (measures[closest],distances[closest]) )
+		return visits
+
+	def interpolate(self,measure):
+		"""Return the (x,y) location at a measure along the line."""
+		measure = min(max(measure,0),self.length)
+		i = min( bisect_right(self.cum_length,measure) - 1, len(self.seg_length) - 1 )
+		t = (measure - self.cum_length[i]) / self.seg_length[i] if self.seg_length[i] else 0
+		return ( self.x1[i] + t*self.dx[i], self.y1[i] + t*self.dy[i] )
+
+	def substring(self,start,end):
+		"""Return the part of the line between two measures as a LineString. 
+			Gaps between the parts of the original line are joined up."""
+		start, end = max(start,0), min(end,self.length)
+		i = bisect_right(self.cum_length,start)
+		j = bisect_right(self.cum_length,end)
+		coords = [ self.interpolate(start) ]
+		for k in range( i, min(j,len(self.seg_length)) ):
+			# where parts of a multi-line meet, keep the end of the last part too
+			if k > 0 and (self.x2[k-1],self.y2[k-1]) != (self.x1[k],self.y1[k]):
+				coords.append( (self.x2[k-1],self.y2[k-1]) )
+			coords.append( (self.x1[k],self.y1[k]) )
+		coords.append( self.interpolate(end) )
+		return LineString(coords)
+
+
 #def cut2(line,distance1,distance2):
 #	"""cut a line in two places, returning the middle segment"""
 #	if distance1 < distance2:
@@ -0,0 +1,329 @@
+# functions for collecting vehicle locations from a GTFS-Realtime feed, an
+# alternative to nb_api for agencies that publish VehiclePositions (and
+# optionally TripUpdates) as protocol buffers. Trips go through the same
+# lifecycle as there: Trip.new, add_point and add_timepoint while the
+# vehicle is running, then save and process once the trip has ended.
+#
+# Unchanged feeds aren't downloaded again where the server supports HTTP
+# validators (ETag, Last-Modified), and differential feeds are supported.
+# Select this adapter with conf['feed'] = 'gtfs_rt' and run store.py as
+# usual. Recorded feeds can be played back through the same code with e.g.
+#
+#	python gtfsrt_api.py --replay recorded/vehicles-*.pb --trip-updates recorded/trips-*.pb
+#
+# and live polls can be recorded for that purpose by setting
+# conf['gtfs_rt']['record'] to a directory.
+
+import os, io, csv, time, zipfile, argparse, threading, logging
+import requests
+import db
+from conf import conf
+from trip import Trip
+from blocks import link_block
+from minor_objects import Stop
+try:
+	from google.transit import gtfs_realtime_pb2
+except ImportError:
+	gtfs_realtime_pb2 = None
+
+logger = logging.getLogger(__name__)
+
+# should we process trips (or simply store the vehicles)?
+doMatching = True
+
+# GLOBALS
+fleet = {}				# operating vehicles ( vid -> trip_obj )
+feed_trips = {}		# the feed's trip_id for each operating vehicle ( vid -> trip_id )
+entity_vehicles = {}	# vehicle of each entity, for differential deletes ( eid -> vid )
+entity_trips = {}		# trip of each TripUpdate entity, likewise ( eid -> trip_id )
+arrivals = {}			# latest stop time updates ( feed trip_id -> [(stop_id,epoch)] )
+feed_state = {}		# HTTP validators of the last response for each feed URL
+last_timestamp = 0	# header timestamp of the last VehiclePositions feed used
+next_tid = None		# next trip_id to be assigned, see next_trip_id()
+static = None			# stops and trips of the static GTFS, see load_static()
+stored_stops = set()	# stop_ids already passed to db.try_storing_stop
+
+fleet_lock = threading.Lock()
+record_check_lock = threading.Lock()
+
+
+def load_static():
+	"""Read the stops and trips of the agency's static GTFS, if given, for
+		stop names and locations, for trip routes and directions that the
+		realtime feed leaves out, and for block_ids."""
+	global static
+	static = { 'stops':{}, 'trips':{} }
+	path = conf['gtfs_rt']['static_gtfs']
+	if not path:
+		return static
+	with zipfile.ZipFile(path) as feed:
+		with feed.open('stops.txt') as f:
+			for row in csv.DictReader(io.TextIOWrapper(f,'utf-8-sig')):
+				static['stops'][row['stop_id']] = row
+		with feed.open('trips.txt') as f:
+			for row in csv.DictReader(io.TextIOWrapper(f,'utf-8-sig')):
+				static['trips'][row['trip_id']] = ( row['route_id'], row.get('direction_id',''), row.get('block_id','') )
+	return static
+
+
+def next_trip_id():
+	"""Trip IDs in GTFS-rt feeds repeat daily and needn't be integers, so
+		trips are numbered here instead."""
+	global next_tid
+	if next_tid is None:
+		next_tid = db.new_trip_id()
+	next_tid += 1
+	return next_tid - 1
+
+
+def fetch(url):
+	"""Get the body of a feed, or None if it hasn't changed since the last
+		request."""
+	state = feed_state.setdefault(url,{})
+	headers = dict( conf['gtfs_rt']['headers'] )
+	if 'etag' in state:
+		headers['If-None-Match'] = state['etag']
+	if 'last_modified' in state:
+		headers['If-Modified-Since'] = state['last_modified']
+	response = requests.get( url, headers=headers, timeout=conf['gtfs_rt']['timeout'] )
+	if response.status_code == 304:
+		return None
+	response.raise_for_status()
+	if 'ETag' in response.headers:
+		state['etag'] = response.headers['ETag']
+	if 'Last-Modified' in response.headers:
+		state['last_modified'] = response.headers['Last-Modified']
+	return response.content
+
+
+def decode(data):
+	"""Parse a serialized FeedMessage."""
+	if gtfs_realtime_pb2 is None:
+		raise ImportError('gtfs-realtime-bindings is required for GTFS-Realtime feeds')
+	feed = gtfs_realtime_pb2.FeedMessage()
+	feed.ParseFromString(data)
+	return feed
+
+
+def is_differential(feed):
+	return feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+
+
+def read_positions(feed):
+	"""Return the vehicle reports in a VehiclePositions feed, as dicts with
+		times in epoch seconds as nb_api has them, and the vehicle_ids of
+		entities deleted from a differential feed."""
+	reports, deleted = [], []
+	for entity in feed.entity:
+		if entity.is_deleted:
+			if entity.id in entity_vehicles:
+				deleted.append( entity_vehicles.pop(entity.id) )
+			continue
+		if not entity.HasField('vehicle'):
+			continue
+		v = entity.vehicle
+		if not ( v.HasField('position') and v.trip.trip_id ):
+			continue
+		route_id, direction_id, block_id = static['trips'].get( v.trip.trip_id, ('','','') )
+		vehicle_id = v.vehicle.id or entity.id
+		entity_vehicles[entity.id] = vehicle_id
+		reports.append( {
+			'vehicle_id':vehicle_id,
+			'trip_id':v.trip.trip_id,
+			'route_id':v.trip.route_id or route_id,
+			'direction_id':str(v.trip.direction_id) if v.trip.HasField('direction_id') else direction_id,
+			'lon':v.position.longitude,
+			'lat':v.position.latitude,
+			'block_id':int(block_id) if block_id.isdigit() else None,
+			'time':v.timestamp or feed.header.timestamp,
+			'stopped_at':v.stop_id if (
+				v.stop_id and v.current_status == gtfs_realtime_pb2.VehiclePosition.STOPPED_AT
+			) else None
+		} )
+	return reports, deleted
+
+
+def update_arrivals(feed):
+	"""Keep the latest arrival (or departure) time at each stop of each trip
+		from a TripUpdates feed."""
+	if not is_differential(feed):
+		arrivals.clear()
+		entity_trips.clear()
+	for entity in feed.entity:
+		if entity.is_deleted:
+			if entity.id in entity_trips:
+				arrivals.pop( entity_trips.pop(entity.id), None )
+			continue
+		if not entity.HasField('trip_update'):
+			continue
+		update = entity.trip_update
+		entity_trips[entity.id] = update.trip.trip_id
+		arrivals[update.trip.trip_id] = [
+			( u.stop_id, u.arrival.time or u.departure.time )
+			for u in update.stop_time_update
+			if u.stop_id and ( u.arrival.time or u.departure.time )
+		]
+
+
+def add_stop(trip,report):
+	"""Add the stop nearest in time to the report as a timepoint, as nb_api
+		does with OneBusAway's closestStop. That's the stop whose arrival in
+		TripUpdates is closest to the report time, or failing those, the stop
+		the vehicle reports being stopped at. Timepoints are kept by integer
+		stop ID, so stops with other IDs are skipped, as are stops missing
+		from the static feed, whose location we don't know."""
+	stop_times = arrivals.get(report['trip_id'])
+	if stop_times:
+		stop_id, arrival = min( stop_times, key=lambda s: abs( s[1] - report['time'] ) )
+		offset = arrival - report['time']
+	elif report['stopped_at']:
+		stop_id, offset = report['stopped_at'], 0
+	else:
+		return
+	if not stop_id.isdigit() or stop_id not in static['stops']:
+		return
+	stop = static['stops'][stop_id]
+	trip.add_timepoint(
+		Stop.new( int(stop_id), float(stop['stop_lat']), float(stop['stop_lon']), report['time'] ),
+		None,
+		offset
+	)
+
+
+def update_fleet(feed):
+	"""Apply a VehiclePositions feed to the fleet, returning the trips that
+		have ended: those whose vehicle started another trip, was deleted
+		from a differential feed, or hasn't been heard from in 15 minutes."""
+	global last_timestamp
+	if feed.header.timestamp and feed.header.timestamp == last_timestamp:
+		return []
+	last_timestamp = feed.header.timestamp
+	now = feed.header.timestamp
+	reports, deleted = read_positions(feed)
+	ending_trips = []
+	def end(vehicle_id):
+		ending_trips.append( fleet.pop(vehicle_id) )
+		arrivals.pop( feed_trips.pop(vehicle_id), None )
+	with fleet_lock:
+		for vehicle_id in deleted:
+			if vehicle_id in fleet:
+				end(vehicle_id)
+		for vehicle_id in list(fleet.keys()):
+			if now - fleet[vehicle_id].last_seen > 900:
+				end(vehicle_id)
+		for report in reports:
+			vehicle_id = report['vehicle_id']
+			trip = fleet.get(vehicle_id)
+			if trip and report['time'] <= trip.last_seen:
+				continue # nothing new
+			if trip and feed_trips[vehicle_id] != report['trip_id']:
+				end(vehicle_id)
+				trip = None
+			if not trip:
+				trip = fleet[vehicle_id] = Trip.new(
+					next_trip_id(), report['block_id'], report['direction_id'], report['route_id'],
+					vehicle_id, report['time']
+				)
+				feed_trips[vehicle_id] = report['trip_id']
+				logger.info( msg = 'Created new trip ' + str(trip.trip_id) + ' for vehicle ' + vehicle_id )
+			trip.add_point( report['lon'], report['lat'], report['time'] )
+			trip.last_seen = report['time']
+			add_stop(trip,report)
+	logger.info( str(len(fleet)) + ' in fleet and ' + str(len(ending_trips)) + ' ending trips' )
+	return ending_trips
+
+
+def end_trips(ending_trips):
+	"""Store the trips that have ended and send them for processing."""
+	for trip in ending_trips:
+		if len(trip.vehicles) < 2:
+			logger.warning( msg = 'Trip ' + str(trip.trip_id) + ' did not have enough vehicles to save to database' )
+			continue
+		# the last timepoint is otherwise only stored when another follows
+		if trip.timepoints:
+			db.try_storing_timepoint( trip.timepoints[-1], trip.trip_id, trip.stop_num )
+		with record_check_lock:
+			for timepoint in trip.timepoints:
+				stop_id = str(timepoint.stop_id)
+				if stop_id in static['stops'] and stop_id not in stored_stops:
+					stop = static['stops'][stop_id]
+					try:	# some stops don't have a stop_code
+						stop_code = int(stop['stop_code'])
+					except (KeyError,ValueError):
+						stop_code = -1
+					db.try_storing_stop(
+						stop_id, stop.get('stop_name',''), stop_code,
+						stop['stop_lon'], stop['stop_lat']
+					)
+					stored_stops.add(stop_id)
+		link_block(trip)
+		trip.save()
+		logger.info( msg = 'Saving Trip ' + str(trip.trip_id) + ' to the database' )
+		if doMatching:
+			threading.Thread(target=trip.process).start()
+
+
+def record(kind,data):
+	"""Keep a copy of a feed for replay, if conf['gtfs_rt']['record'] is set."""
+	directory = conf['gtfs_rt']['record']
+	if directory:
+		name = '{}-{}.pb'.format( kind, int(time.time()) )
+		with open( os.path.join(directory,name), 'wb' ) as f:
+			f.write(data)
+
+
+def get_new_vehicles():
+	"""Poll the realtime feeds and update the fleet, sending trips for
+		processing when they have ended."""
+	if static is None:
+		load_static()
+	try:
+		positions = fetch( conf['gtfs_rt']['vehicle_positions'] )
+		updates = fetch( conf['gtfs_rt']['trip_updates'] ) if conf['gtfs_rt']['trip_updates'] else None
+	except requests.RequestException:
+		logger.warning( msg = 'connection problem' )
+		return
+	if updates:
+		record('trips',updates)
+		update_arrivals( decode(updates) )
+	if positions:
+		record('vehicles',positions)
+		end_trips( update_fleet( decode(positions) ) )
+
+
+def replay(position_files,update_files=()):
+	"""Feed recorded VehiclePositions (and TripUpdates) files through the
+		collector, in order of file name as record() names them, then end
+		any trips still running."""
+	load_static()
+	def read(path):
+		with open(path,'rb') as f:
+			return decode( f.read() )
+	updates = iter( sorted(update_files) )
+	update = next(updates,None)
+	for path in sorted(position_files):
+		feed = read(path)
+		# apply trip updates as of the vehicle positions
+		while update:
+			if not isinstance(update,gtfs_realtime_pb2.FeedMessage):
+				update = read(update)
+			if update.header.timestamp > feed.header.timestamp:
+				break
+			update_arrivals(update)
+			update = next(updates,None)
+		end_trips( update_fleet(feed) )
+	with fleet_lock:
+		remaining = list( fleet.values() )
+		fleet.clear()
+		feed_trips.clear()
+	end_trips(remaining)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Play recorded GTFS-Realtime feeds through the collector')
+	parser.add_argument('--replay',nargs='+',required=True,help='VehiclePositions .pb files')
+	parser.add_argument('--trip-updates',nargs='*',default=[],help='TripUpdates .pb files')
+	parser.add_argument('--no-matching',action='store_true',help='store trips without processing them')
+	args = parser.parse_args()
+	doMatching = not args.no_matching
+	replay(args.replay,args.trip_updates)
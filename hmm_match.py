@@ -0,0 +1,301 @@
+# An in-process map matcher, an alternative to the OSRM match service for
+# when running an OSRM server is inconvenient. The road network is loaded
+# once per process from a local OSM XML extract, and traces are matched with
+# a hidden Markov model in the manner of Newson & Krumm (2009): candidate
+# positions near each GPS fix are scored by their distance from the fix,
+# and transitions between them by how much the route between them differs
+# from the straight-line distance between the fixes. Responses have the same
+# form as those of osrm.fetch_match, so the rest of map_api is unchanged.
+# Select it with conf['matcher'] = 'hmm'.
+
+import heapq
+import numpy as np
+import xml.etree.ElementTree as ET
+from math import hypot, exp
+from conf import conf
+from geom import GridIndex
+
+# as in etc/transit-simple.lua: ways with any of these tags are used unless
+# one of the access tags forbids transit vehicles. Like that profile, we
+# ignore one-way restrictions
+WAY_TAGS = { 'highway', 'route', 'railway' }
+ACCESS_TAGS = [ 'ttc', 'psv', 'bus', 'motor_vehicle', 'vehicle', 'access' ]
+ACCESS_VALUES = { 'yes', 'designated', 'destination', 'permissive' }
+
+
+class RoadNetwork(object):
+	"""A routable graph of the road network with a spatial index of its
+		segments. Nodes are numbered from 0 and segments are the pieces of
+		ways between consecutive nodes."""
+
+	def __init__(self,osm_file):
+		node_locations = {}		# OSM id -> (lon,lat)
+		ways = []					# lists of OSM node ids
+		for event, element in ET.iterparse(osm_file):
+			if element.tag == 'node':
+				node_locations[element.get('id')] = (
+					float(element.get('lon')), float(element.get('lat'))
+				)
+			elif element.tag == 'way':
+				tags = { t.get('k'):t.get('v') for t in element.iter('tag') }
+				if self.is_routable(tags):
+					ways.append( [ nd.get('ref') for nd in element.iter('nd') ] )
+			# nodes are needed until the end, but their elements aren't
+			if element.tag in ('node','way','relation'):
+				element.clear()
+		# number the nodes that are actually used
+		index = {}
+		for way in ways:
+			for ref in way:
+				if ref in node_locations and ref not in index:
+					index[ref] = len(index)
+		lonlat = np.array( [ node_locations[ref] for ref in index ] ).reshape(-1,2)
+		self.lon, self.lat = lonlat[:,0], lonlat[:,1]
+		self.x, self.y = map( np.asarray, conf['projection'](self.lon,self.lat) )
+		# segments and adjacency
+		starts, ends = [], []
+		for way in ways:
+			refs = [ index[ref] for ref in way if ref in index ]
+			starts += refs[:-1]
+			ends += refs[1:]
+		self.start = np.array(starts,dtype=int)
+		self.end = np.array(ends,dtype=int)
+		self.length = np.hypot(
+			self.x[self.end] - self.x[self.start], self.y[self.end] - self.y[self.start]
+		)
+		self.neighbours = [ [] for i in range(len(index)) ]
+		for a, b, length in zip(self.start,self.end,self.length):
+			self.neighbours[a].append( (b,length) )
+			self.neighbours[b].append( (a,length) )
+		self.index = GridIndex(100)
+		for s in range(len(self.length)):
+			a, b = self.start[s], self.end[s]
+			self.index.insert( s,
+				min(self.x[a],self.x[b]), min(self.y[a],self.y[b]),
+				max(self.x[a],self.x[b]), max(self.y[a],self.y[b])
+			)
+
+	@staticmethod
+	def is_routable(tags):
+		if not WAY_TAGS & set(tags):
+			return False
+		for tag in ACCESS_TAGS:
+			if tag in tags and tags[tag] not in ACCESS_VALUES:
+				return False
+		return True
+
+	def candidates(self,x,y,radius,limit):
+		"""Return up to limit (segment,t,distance) tuples for the closest
+			points on segments within radius of (x,y), where t is the share
+			of the way along the segment."""
+		segments = np.array( sorted(
+			self.index.query(x-radius,y-radius,x+radius,y+radius)
+		), dtype=int )
+		if len(segments) == 0:
+			return []
+		x1, y1 = self.x[self.start[segments]], self.y[self.start[segments]]
+		dx = self.x[self.end[segments]] - x1
+		dy = self.y[self.end[segments]] - y1
+		with np.errstate(invalid='ignore',divide='ignore'):
+			t = ( (x-x1)*dx + (y-y1)*dy ) / (dx**2 + dy**2)
+		t = np.clip( np.nan_to_num(t), 0, 1 )
+		distances = np.hypot( x1 + t*dx - x, y1 + t*dy - y )
+		order = [ i for i in np.argsort(distances) if distances[i] <= radius ]
+		return [ (segments[i],t[i],distances[i]) for i in order[:limit] ]
+
+	def shortest_paths(self,sources,limit):
+		"""Dijkstra's algorithm from several source nodes with initial costs,
+			going no further than limit. Returns the distance to and the
+			predecessor of each node reached."""
+		distance = dict(sources)
+		previous = {}
+		queue = [ (cost,node) for node, cost in sources.items() ]
+		heapq.heapify(queue)
+		while queue:
+			cost, node = heapq.heappop(queue)
+			if cost > distance[node]:
+				continue
+			for neighbour, length in self.neighbours[node]:
+				new_cost = cost + length
+				if new_cost <= limit and new_cost < distance.get(neighbour,float('inf')):
+					distance[neighbour] = new_cost
+					previous[neighbour] = node
+					heapq.heappush(queue,(new_cost,neighbour))
+		return distance, previous
+
+	def lonlat(self,segment,t):
+		"""Location of a point along a segment, interpolated in lon-lat."""
+		a, b = self.start[segment], self.end[segment]
+		return [
+			self.lon[a] + t * (self.lon[b]-self.lon[a]),
+			self.lat[a] + t * (self.lat[b]-self.lat[a])
+		]
+
+
+_network = None
+
+def get_network():
+	"""Return the road network, loading it the first time. Load it before
+		forking worker processes so that they can share it."""
+	global _network
+	if _network is None:
+		print( 'loading road network from',conf['hmm']['osm_file'] )
+		_network = RoadNetwork(conf['hmm']['osm_file'])
+	return _network
+
+
+def search_limit(straight,error_radius):
+	"""How far along the network to look for the route between candidates 
+		for fixes a straight-line distance apart. Longer routes would be 
+		very unlikely transitions anyway."""
+	return 2 * straight + 6 * error_radius
+
+
+class Candidate(object):
+	"""A possible position of a GPS fix on the network."""
+
+	def __init__(self,network,segment,t,distance):
+		self.segment = segment
+		self.t = t
+		self.distance = distance	# from the fix
+		self.length = network.length[segment]
+		self.nodes = { 	# cost of reaching each end of the segment
+			network.start[segment]: t * self.length,
+			network.end[segment]: (1-t) * self.length
+		}
+
+	def route_distance(self,other,distances):
+		"""Distance along the network to another candidate, given the
+			distances from this one to the nodes reached."""
+		if other.segment == self.segment:
+			return abs(other.t - self.t) * self.length
+		return min(
+			distances.get(node,float('inf')) + cost
+			for node, cost in other.nodes.items()
+		)
+
+	def path_to(self,other,network,limit):
+		"""Lon-lat coordinates of the route to another candidate."""
+		coordinates = [ network.lonlat(self.segment,self.t) ]
+		if other.segment != self.segment:
+			distances, previous = network.shortest_paths(self.nodes,limit)
+			entry = min( other.nodes,
+				key=lambda node: distances.get(node,float('inf')) + other.nodes[node]
+			)
+			nodes = [entry]
+			while nodes[-1] in previous:
+				nodes.append( previous[nodes[-1]] )
+			coordinates += [ [network.lon[n],network.lat[n]] for n in reversed(nodes) ]
+		coordinates.append( network.lonlat(other.segment,other.t) )
+		return coordinates
+
+
+def viterbi(network,points,error_radius):
+	"""Find the most likely sequence of candidates for the points. Returns a
+		list with a Candidate (or None where no candidate was chosen) for each
+		point, the route distances between chosen candidates, and a list of
+		indices where the sequence breaks and a new matching should start."""
+	sigma = error_radius
+	beta = conf['hmm']['beta']
+	radius = 3 * error_radius
+	layers = [
+		[ Candidate(network,*c) for c in network.candidates(x,y,radius,conf['hmm']['max_candidates']) ]
+		for x, y in points
+	]
+	score = [ None ] * len(points)		# log probabilities of candidates
+	back = [ None ] * len(points)		# index of best previous candidate
+	steps = [ None ] * len(points)		# route distances from previous
+	prior = [ None ] * len(points)		# the point before, with candidates
+	breaks = []
+	last = None
+	for i, layer in enumerate(layers):
+		if not layer:
+			continue
+		emission = [ -0.5 * (c.distance/sigma)**2 for c in layer ]
+		if last is None:
+			score[i], breaks = emission, breaks + [i]
+			last = i
+			continue
+		straight = hypot( points[i][0]-points[last][0], points[i][1]-points[last][1] )
+		limit = search_limit(straight,error_radius)
+		score[i] = [ -float('inf') ] * len(layer)
+		back[i] = [ None ] * len(layer)
+		steps[i] = [ None ] * len(layer)
+		for j, previous in enumerate(layers[last]):
+			if score[last][j] == -float('inf'):
+				continue
+			distances, _ = network.shortest_paths(previous.nodes,limit)
+			for k, candidate in enumerate(layer):
+				route = previous.route_distance(candidate,distances)
+				if route > limit:
+					continue
+				s = score[last][j] + emission[k] - abs(route-straight)/beta
+				if s > score[i][k]:
+					score[i][k], back[i][k], steps[i][k] = s, j, route
+		if max(score[i]) == -float('inf'):
+			# nothing connects; start over from here
+			score[i], back[i] = emission, None
+			breaks.append(i)
+		prior[i] = last
+		last = i
+	# trace back the best sequence from the end of each matching
+	chosen = [ None ] * len(points)
+	legs = [ None ] * len(points)
+	ends = [ prior[b] for b in breaks[1:] ] + [last]
+	for end in ends:
+		if end is None:
+			continue
+		i, k = end, int(np.argmax(score[end]))
+		while True:
+			chosen[i] = layers[i][k]
+			if back[i] is None:
+				break
+			legs[i] = steps[i][k]
+			i, k = prior[i], back[i][k]
+	return chosen, legs, breaks
+
+
+def fetch_match(vehicles,error_radius):
+	"""Match a list of vehicles to the road network, returning a response
+		in the form of a decoded OSRM match response."""
+	network = get_network()
+	points = [ (v.geom.x,v.geom.y) for v in vehicles ]
+	chosen, legs, breaks = viterbi(network,points,error_radius)
+	beta = conf['hmm']['beta']
+	matchings = []
+	tracepoints = [ None ] * len(points)
+	# each break starts a new matching; single points are left unmatched
+	bounds = breaks + [len(points)]
+	for start, stop in zip(bounds,bounds[1:]):
+		members = [ i for i in range(start,stop) if chosen[i] ]
+		if len(members) < 2:
+			continue
+		matching = { 'coordinates':[], 'legs':[] }
+		detour = straight_total = 0
+		for n, i in enumerate(members):
+			tracepoints[i] = {
+				'location':network.lonlat(chosen[i].segment,chosen[i].t),
+				'distance':float(chosen[i].distance),
+				'name':'',
+				'matchings_index':len(matchings),
+				'waypoint_index':n,
+				'alternatives_count':0
+			}
+			if n == 0:
+				continue
+			j = members[n-1]
+			straight = hypot( points[i][0]-points[j][0], points[i][1]-points[j][1] )
+			path = chosen[j].path_to( chosen[i], network, search_limit(straight,error_radius) )
+			matching['coordinates'] += path if n == 1 else path[1:]
+			matching['legs'].append( { 'distance':float(legs[i]) } )
+			detour += abs(legs[i] - straight)
+			straight_total += straight
+		# like OSRM's, a score from 0 to 1 of how plausible the route is
+		matching['confidence'] = exp( -detour / max(straight_total,beta) )
+		matching['distance'] = sum( leg['distance'] for leg in matching['legs'] )
+		matchings.append(matching)
+	return {
+		'code':'Ok' if matchings else 'NoMatch',
+		'matchings':matchings,
+		'tracepoints':tracepoints
+	}
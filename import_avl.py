@@ -0,0 +1,202 @@
+# call this file to load historical AVL data into the trips table, so that it
+# can be processed like data collected from a live feed. Input is one or more
+# CSV or Parquet files with a row per GPS fix, e.g.
+#
+#	python import_avl.py avl/2019-*.parquet --vehicle vehicle_id --time timestamp --route route --trip trip_id
+#
+# Files are read in name order. The fixes of each file are sorted by vehicle
+# and time and cut into trips wherever the vehicle, the AVL trip id, route or
+# direction (if given) changes, or there is a gap of more than --gap
+# seconds; consecutive trips by a vehicle are linked into blocks as the
+# collector links them. The trip each vehicle was on at the end of a file is
+# carried over into the next one. Trips are written with COPY by a pool of
+# worker processes, in the same form as db.insert_trip stores them.
+# Times are stored in epoch seconds, the unit the live collectors (nb_api,
+# gtfsrt_api) store them in, whatever --time-unit the input uses.
+
+import io, csv, struct, argparse
+import multiprocessing as mp
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from conf import conf
+import db
+
+# trips handed to a worker at once
+CHUNK_SIZE = 2000
+
+
+def read_fixes(path,columns,time_unit):
+	"""Read one AVL file into a dict of numpy arrays, named as the keys of
+		columns, with times in epoch seconds. String timestamps are parsed
+		and, if they have no offset, taken to be in conf['timezone']."""
+	file_format = 'parquet' if path.endswith('.parquet') else 'csv'
+	table = ds.dataset(path,format=file_format).to_table(
+		columns=[ c for c in columns.values() if c ]
+	)
+	fixes = {}
+	for name, column in columns.items():
+		if not column:
+			continue
+		values = table[column]
+		if name == 'time':
+			if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+				values = pc.strptime(values,format='%Y-%m-%d %H:%M:%S',unit='s',error_is_null=True)
+			if pa.types.is_timestamp(values.type):
+				if values.type.tz is None:
+					values = pc.assume_timezone(values,conf['timezone'],ambiguous='earliest',nonexistent='earliest')
+				values = values.cast(pa.timestamp('ms',tz='UTC')).cast(pa.int64())
+				fixes[name] = values.to_numpy().astype(float) / 1000
+			else:
+				fixes[name] = values.to_numpy().astype(float) / ( 1000 if time_unit == 'ms' else 1 )
+		elif name in ('lon','lat'):
+			fixes[name] = values.to_numpy().astype(float)
+		else:
+			fixes[name] = values.cast(pa.string()).to_numpy(zero_copy_only=False).astype(object)
+	# rows missing anything essential can't be used
+	valid = np.isfinite(fixes['time']) & np.isfinite(fixes['lon']) & np.isfinite(fixes['lat'])
+	valid &= table[columns['vehicle']].is_valid().to_numpy(zero_copy_only=False)
+	return { name:values[valid] for name, values in fixes.items() }
+
+
+def segment(fixes,gap):
+	"""Sort fixes by vehicle and time and return them with the index of the
+		first fix of each trip."""
+	order = np.lexsort( (fixes['time'], fixes['vehicle'].astype(str)) )
+	fixes = { name:values[order] for name, values in fixes.items() }
+	breaks = np.diff(fixes['time']) > gap
+	for name in ('vehicle','trip','route','direction'):
+		if name in fixes:
+			breaks |= fixes[name][1:] != fixes[name][:-1]
+	starts = np.concatenate( ([0], np.nonzero(breaks)[0] + 1) )
+	return fixes, starts
+
+
+def link_blocks(vehicles,first_times,last_times,last_blocks,next_bid):
+	"""Assign trips (sorted by vehicle and time) to blocks as blocks.link_block
+		does, continuing the blocks in last_blocks ( vid -> (bid,last time) ),
+		which is updated. Returns the block_ids and the next block_id. Block 
+		ids count down, as db.new_block_id explains."""
+	gap = conf['block_gap']
+	n = len(vehicles)
+	first_of_vehicle = np.ones(n,dtype=bool)
+	first_of_vehicle[1:] = vehicles[1:] != vehicles[:-1]
+	new_block = first_of_vehicle.copy()
+	new_block[1:] |= first_times[1:] - last_times[:-1] > gap
+	# where each block begins, and the id it gets
+	base = np.zeros(n,dtype=int)
+	for i in np.nonzero(first_of_vehicle)[0]:
+		last = last_blocks.get(vehicles[i])
+		if last and first_times[i] - last[1] <= gap:
+			base[i] = last[0]
+			new_block[i] = False
+	new = np.nonzero(new_block)[0]
+	base[new] = np.arange( next_bid, next_bid - len(new), -1 )
+	begins = np.maximum.accumulate( np.where( new_block | first_of_vehicle, np.arange(n), 0 ) )
+	block_ids = base[begins]
+	# the last trip of each vehicle, for the next file
+	last_of_vehicle = np.append( first_of_vehicle[1:], True )
+	for i in np.nonzero(last_of_vehicle)[0]:
+		last_blocks[vehicles[i]] = ( int(block_ids[i]), last_times[i] )
+	return block_ids, next_bid - len(new)
+
+
+def ewkb_linestring(x,y,srid):
+	"""Hex EWKB of a LineString, as PostGIS reads it in COPY."""
+	header = struct.pack( '<BIII', 1, 0x20000002, srid, len(x) )
+	return ( header + np.column_stack((x,y)).astype('<f8').tobytes() ).hex()
+
+
+def copy_chunk(chunk):
+	"""Worker: project the fixes of some trips and COPY them into the trips
+		table."""
+	x, y = map( np.asarray, conf['projection'](chunk['lon'],chunk['lat']) )
+	times = chunk['time']
+	bounds = list(chunk['offsets']) + [len(times)]
+	rows = io.StringIO()
+	writer = csv.writer(rows)
+	for i, trip in enumerate(chunk['trips']):
+		a, b = bounds[i], bounds[i+1]
+		writer.writerow( trip + [
+			'{' + ','.join( map(repr,times[a:b].tolist()) ) + '}',
+			ewkb_linestring( x[a:b], y[a:b], conf['localEPSG'] )
+		] )
+	rows.seek(0)
+	db.copy_trips(rows)
+	return len(chunk['trips'])
+
+
+def chunks(fixes,starts,ends,trip_ids,block_ids):
+	"""Split trips into chunks of data for the workers."""
+	for c in range(0,len(starts),CHUNK_SIZE):
+		s, e = starts[c:c+CHUNK_SIZE], ends[c:c+CHUNK_SIZE]
+		rows = np.concatenate( [ np.arange(a,b) for a, b in zip(s,e) ] )
+		yield {
+			'trips':[ [
+				int(trip_ids[c+i]), int(block_ids[c+i]),
+				fixes['route'][a] if 'route' in fixes else '',
+				fixes['direction'][a] if 'direction' in fixes else '',
+				fixes['vehicle'][a]
+			] for i, a in enumerate(s) ],
+			'offsets':np.cumsum( np.concatenate( ([0], (e-s)[:-1]) ) ),
+			'time':fixes['time'][rows],
+			'lon':fixes['lon'][rows],
+			'lat':fixes['lat'][rows]
+		}
+
+
+def import_files(paths,columns,gap,time_unit='s',workers=None):
+	next_tid = db.new_trip_id()
+	next_bid = db.new_block_id()
+	last_blocks = {}
+	carried = None
+	pool = mp.Pool( workers, initializer=db.reconnect )
+	for n, path in enumerate(sorted(paths)):
+		fixes = read_fixes(path,columns,time_unit)
+		if carried:
+			fixes = { name:np.concatenate((carried[name],values)) for name, values in fixes.items() }
+		if len(fixes['time']) == 0:
+			continue
+		fixes, starts = segment(fixes,gap)
+		ends = np.append( starts[1:], len(fixes['time']) )
+		# hold back the trip each vehicle is on at the end of the file
+		if n < len(paths) - 1:
+			last = np.append( fixes['vehicle'][starts][1:] != fixes['vehicle'][starts][:-1], True )
+			carried = { name:np.concatenate( [ values[a:b] for a, b in zip(starts[last],ends[last]) ] )
+				for name, values in fixes.items() }
+			starts, ends = starts[~last], ends[~last]
+		# a trip needs at least two fixes to have a line
+		keep = ends - starts > 1
+		starts, ends = starts[keep], ends[keep]
+		trip_ids = np.arange( next_tid, next_tid + len(starts) )
+		next_tid += len(starts)
+		block_ids, next_bid = link_blocks(
+			fixes['vehicle'][starts], fixes['time'][starts], fixes['time'][ends-1],
+			last_blocks, next_bid
+		)
+		stored = sum( pool.imap_unordered( copy_chunk, chunks(fixes,starts,ends,trip_ids,block_ids) ) )
+		print( path, len(fixes['time']), 'fixes,', stored, 'trips' )
+	pool.close()
+	pool.join()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Load historical AVL data into the trips table')
+	parser.add_argument('files',nargs='+',help='CSV or Parquet files of GPS fixes')
+	parser.add_argument('--vehicle',default='vehicle_id',help='vehicle id column')
+	parser.add_argument('--time',default='time',help='time column: epoch or YYYY-MM-DD HH:MM:SS')
+	parser.add_argument('--lon',default='lon',help='longitude column')
+	parser.add_argument('--lat',default='lat',help='latitude column')
+	parser.add_argument('--route',help='route_id column, if any')
+	parser.add_argument('--direction',help='direction_id column, if any')
+	parser.add_argument('--trip',help='AVL trip id column, if any')
+	parser.add_argument('--time-unit',choices=['s','ms'],default='s',help='unit of epoch times')
+	parser.add_argument('--gap',type=float,default=900,help='seconds without a fix that end a trip')
+	parser.add_argument('--workers',type=int,help='worker processes; default one per CPU')
+	args = parser.parse_args()
+	columns = {
+		'vehicle':args.vehicle, 'time':args.time, 'lon':args.lon, 'lat':args.lat,
+		'route':args.route, 'direction':args.direction, 'trip':args.trip
+	}
+	import_files(args.files,columns,args.gap,args.time_unit,args.workers)
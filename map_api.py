@@ -1,18 +1,37 @@
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3 import Retry
-import json, db
+import db, osrm, hmm_match, shape_library
 from conf import conf
-from numpy import mean
 from shapely.geometry import MultiLineString
-from shapely.geometry.geo import shape # note: changed asShape to shape
 from shapely.ops import transform as reproject
 from shapely.wkb import loads as loadWKB, dumps as dumpWKB
-from copy import copy
-from geom import cut
+from bisect import bisect_right
+from geom import LinearReference
 from minor_objects import TimePoint
 
 
+def longest_ordered_subsequence(values):
+	"""Return the indices of a longest non-decreasing subsequence of values. 
+		This is the patience sorting algorithm, O(n log n)."""
+	tails = []			# last value of the best subsequence of each length
+	tail_indices = []	# and its index
+	previous = []		# index of the preceding element in its subsequence
+	for i, value in enumerate(values):
+		length = bisect_right(tails,value)
+		if length == len(tails):
+			tails.append(value)
+			tail_indices.append(i)
+		else:
+			tails[length] = value
+			tail_indices[length] = i
+		previous.append( tail_indices[length-1] if length > 0 else None )
+	# walk back from the end of the longest subsequence
+	indices = []
+	i = tail_indices[-1] if tail_indices else None
+	while i is not None:
+		indices.append(i)
+		i = previous[i]
+	return indices[::-1]
+
+
 class match(object):
 	"""This object is responsible for coming up with a more spatially accurate 
 	version of the trip. We do this by first trying to map match the GPS 
@@ -20,20 +39,58 @@ class match(object):
 	for any reason, we try altering some parameters to improve the match. 
 	If it's still not great, we can see if there is a default route_geometry 
 	provided. Ultimately, we judge whether the match is sufficent to proceed.
+	Before any of that, if the trip follows a path that earlier trips in 
+	its direction were matched to, we simply reuse that path.
 
 	If we do use this match, this object also provides methods for associating 
 	points (vehicles, stops) with points along the route gemetry; these will 
-	be used for time interpolation inside the trip object."""
+	be used for time interpolation inside the trip object.
+
+	OSRM responses may be fetched ahead of time, e.g. by an osrm.AsyncMatcher, 
+	and passed in as a dict keyed by error radius. Whoever fetched them will 
+	have looked for a known shape first and passes that in too."""
 	
-	def __init__(self, trip_object):
+	def __init__(self, trip_object, prefetched=None, shape=None):
 		self.geometry = MultiLineString()
+		self.route = None							# LinearReference on the geometry
   		# initialize some variables
 		self.OSRM_response = {}					# python-parsed OSRM response object
+		self.prefetched = prefetched or {}	# OSRM responses by error radius
 		self.trip = trip_object
 		# error radius to use for map matching, same for all points
 		self.error_radius = conf['error_radius']
 		self.default_route_used = False
+		self.fixed_confidence = None			# confidence not from OSRM
+
+		# have we seen trips take this path before? (a known Shape or None)
+		if shape is None and not prefetched:
+			shape = shape_library.library.find(self.trip)
+		self.shape = shape
+		if self.shape:
+			self.confidence = self.shape.confidence
+			self.geometry, self.route = self.shape.geometry, self.shape.route
+			self.locate_vehicles_on_known_route(conf['shape_buffer'])
+		else:
+			self.match_with_OSRM()
+			if not (self.OSRM_match_is_sufficient or self.default_route_used):
+				return # bad match, no default
+
+		# vehicles set aside before matching get measures from their neighbours
+		self.trip.restore_thinned_vehicles()
+
+		if len(self.trip.vehicles) > 2:
+			print ('map_api_debug: locating stops on route')
+			self.locate_stops_on_route()
+		db.add_trip_match(
+			self.trip.trip_id, self.confidence, dumpWKB( self.geometry, hex=True ),
+			not (self.default_route_used or self.shape)
+		)
+		# report on what happened
+		self.print_outcome()
 
+	def match_with_OSRM(self):
+		"""Get a match from OSRM, falling back to a default geometry if it 
+			isn't good enough, and locate the vehicles on whichever we use."""
 		# fire off a query to OSRM with the default parameters
 		print ('map_api_debug: running self.query_OSRM()')
 		self.query_OSRM()
@@ -49,21 +106,12 @@ class match(object):
 		if not self.OSRM_match_is_sufficient:
 			# Try a default geometry
 			if self.get_default_route():
-				self.locate_vehicles_on_default_route()
-			else: 
-				return # bad match, no default
+				self.locate_vehicles_on_known_route(conf['stop_dist'])
 		else: # have a workable OSRM match geometry
 			print ('map_api_debug: parsing OSRM geometry')
 			self.parse_OSRM_geometry()
 			self.locate_vehicles_on_OSRM_route()
 
-		if len(self.trip.vehicles) > 2:
-			print ('map_api_debug: locating stops on route')
-			self.locate_stops_on_route()
-		db.add_trip_match(self.trip.trip_id, self.confidence, dumpWKB( self.geometry, hex=True ))
-		# report on what happened
-		self.print_outcome()
-
 	@property
 	def OSRM_match_is_sufficient(self):
 		"""Is this match good enough actually to be used?"""
@@ -85,54 +133,37 @@ class match(object):
 	
 	@property
 	def confidence(self):
-		if self.OSRM_response['code'] != 'Ok':
-			return self.OSRM_response['matchings']['confidence']
-		else:
-			# Get an average confidence value from the match result.
-			confidence_values = [ m['confidence'] for m in self.OSRM_response['matchings'] ]
-			return mean( confidence_values )
+		if self.fixed_confidence is not None:
+			return self.fixed_confidence
+		return osrm.confidence(self.OSRM_response)
+
+	@confidence.setter
+	def confidence(self,value):
+		"""Set a confidence for a geometry that didn't come from OSRM."""
+		self.fixed_confidence = value
 
 	def query_OSRM(self):
-		"""Construct the request and send it to OSRM, retrying if necessary."""
-		# structure it as API requires, rounding coords to 6 decimals
-		coords = ';'.join( [ 
-			format(v.lon,'.7g')+','+format(v.lat,'.7g') for v in self.trip.vehicles 
-		] )
-		radii = ';'.join( [ str(self.error_radius) ] * len(self.trip.vehicles) )
-		# construct and send the request
-		options = {
-			'radiuses':radii,
-			'steps':'false',
-			'geometries':'geojson',
-			'annotations':'false',
-			'overview':'full',
-			'gaps':'ignore', # don't split based on time gaps - shouldn't be any
-			'tidy':'true',
-			'generate_hints':'false'
-		}
-		# open a connection, configured to retry in case of errors
-		with requests.Session() as session:
-			retries = Retry( total=5, backoff_factor=1 )
-			session.mount( 'http://', HTTPAdapter(max_retries=retries) )
-			# make the request
-			try:
-				raw_response = session.get(
-					conf['OSRMserver']['url']+'/match/v1/transit/'+coords,
-					params=options,
-					timeout=conf['OSRMserver']['timeout']
-					)
-			except:
+		"""Get a match from OSRM at the current error radius, unless one was 
+			already fetched."""
+		if self.error_radius in self.prefetched:
+			response = self.prefetched[self.error_radius]
+			if response is None: # the prefetch couldn't reach OSRM
 				return db.ignore_trip(self.trip.trip_id,'connection issue')
-		# parse the result to a python object
-		self.OSRM_response = json.loads(raw_response.text)
-		# how confident should we be in this response?
+			self.OSRM_response = response
+			return
+		# the embedded matcher gives responses in the same form
+		matcher = hmm_match if conf.get('matcher') == 'hmm' else osrm
+		try:
+			self.OSRM_response = matcher.fetch_match(self.trip.vehicles,self.error_radius)
+		except:
+			return db.ignore_trip(self.trip.trip_id,'connection issue')
 
 
 	def parse_OSRM_geometry(self):
 		"""Parse the OSRM match geometry into a more useable format.
 			Specifically a simplified and projected MultiLineString."""
 		# get a list of lists of lat-lon coords which need to be reprojected
-		lines = [shape(matching['geometry']) for matching in self.OSRM_response['matchings']] # note: changed asShape to shape
+		lines = [ matching['coordinates'] for matching in self.OSRM_response['matchings'] ]
 		multilines = MultiLineString(lines)
 		# reproject to local 
 		local_multilines = reproject( conf['projection'], multilines )
@@ -143,6 +174,7 @@ class match(object):
 		if simple_local_multilines.geom_type == 'LineString':
 			simple_local_multilines = MultiLineString([simple_local_multilines])
 		self.geometry = simple_local_multilines
+		self.route = LinearReference(self.geometry)
 
 
 	def get_default_route(self):
@@ -150,11 +182,11 @@ class match(object):
 			parse things into the same format, just as though this had come from 
 			OSRM."""
 		# get the default if there is one
-		route_geom = db.get_route_geom( self.trip.direction_id, self.trip.last_seen )
-		if route_geom: # default available
+		default_route = db.get_default_route( self.trip.direction_id, self.trip.last_seen )
+		if default_route: # default available
 			self.default_route_used = True
 			self.confidence = 1
-			self.geometry = MultiLineString([route_geom])
+			self.geometry, self.route = default_route
 			return True
 		else: # no default
 			return False
@@ -162,7 +194,9 @@ class match(object):
 
 	def print_outcome(self):
 		"""Print the outcome of this match to stdout."""
-		if self.default_route_used and self.confidence == 1:
+		if self.shape:
+			print( '\tknown shape used, shared with',self.shape.trips,'matches' )
+		elif self.default_route_used and self.confidence == 1:
 			print( '\tdefault route used for direction',self.trip.direction_id )
 		elif self.default_route_used and self.confidence == 0:
 			print( '\tdefault route not found for',self.trip.direction_id )
@@ -186,10 +220,8 @@ class match(object):
 		# null (None) entries indicate an omitted (outlier) point
 		# true where not none
 		drop_list = [ point is None for point in self.OSRM_response['tracepoints'] ]
-		# drop vehicles that did not contribute to the match,
-		# backwards to maintain order
-		for i in reversed( range( 0, len(drop_list) ) ):
-			if drop_list[i]: self.trip.ignore_vehicle( i )
+		# drop vehicles that did not contribute to the match
+		self.trip.ignore_vehicles( i for i, drop in enumerate(drop_list) if drop )
 		# get cumulative distances of each vehicle along the match geom
 		# This is based on the leg distances provided by OSRM. Each leg is just 
 		# the trip between matched points. Each match has one more vehicle record 
@@ -211,80 +243,54 @@ class match(object):
 			v.measure = v.measure * adjust_factor
 
 
-	def locate_vehicles_on_default_route(self):
-		"""Find the measure of vehicles along the default route. First discard 
-		observations too far from the route geometry. Next, find the measure of 
+	def locate_vehicles_on_known_route(self,max_distance):
+		"""Find the measure of vehicles along the default route or a known 
+		shape. First discard observations further than max_distance from the 
+		route geometry. Next, find the measure of 
 		the remaining vehicles in the order they were observed. If the vehicles 
 		progress monotonically down the line then all is good. Otherwise, we 
-		start dropping observations that are most severely out of order until we 
-		are left with an ordered list moving along the route in the correct 
-		direction. Wrong direction travel will generally result in a minimal
-		ordered set: 1 remaining observation."""
-		assert self.default_route_used
-		# match stops within a distance of the route geometry
+		keep the largest set of observations that is in order, leaving an 
+		ordered list moving along the route in the correct direction. Wrong 
+		direction travel will generally result in a minimal ordered set: 1 
+		remaining observation."""
+		assert self.default_route_used or self.shape
+		# match vehicles within a distance of the route geometry
+		measures = self.route.project( 
+			[ v.geom for v in self.trip.vehicles ], max_distance
+		)
 		vehicles_to_ignore = []
-		for vehicle in self.trip.vehicles:
+		for i, (vehicle, m) in enumerate(zip(self.trip.vehicles,measures)):
 			# if the vehicle is close enough
-			distance_from_route = self.geometry.distance( vehicle.geom )
-			if distance_from_route <= conf['stop_dist']:
-				m = self.geometry.project(vehicle.geom)
+			if m == m: # not NaN
 				vehicle.set_measure(m)
 			else:
-				vehicles_to_ignore.append(vehicle)
-		for vehicle in vehicles_to_ignore:
-			self.trip.ignore_vehicle( vehicle )
-		# while the list is not fully sorted
-		while self.trip.vehicles != sorted(self.trip.vehicles,key=lambda v: v.measure):
-			correct_order = sorted(self.trip.vehicles,key=lambda v: v.measure)
-			current_order = self.trip.vehicles
-			transpositions = {}
-			# compare all vehicles in both lists
-			for i,v1 in enumerate(correct_order):
-				for j,v2 in enumerate(current_order):
-					if v1 == v2:
-						if abs(i-j) > 0: # not in the same position
-							# add these vehicles to the list with their distances as keys
-							if abs(i-j) not in transpositions: transpositions[abs(i-j)] = [v1]
-							else: transpositions[abs(i-j)].append(v1)
-						else: # are in the same position
-							continue
-			max_dist = max(transpositions.keys())
-			# ignore vehicles associated with the max of the transposition distances
-			for vehicle in transpositions[max_dist]:
-				self.trip.ignore_vehicle(vehicle)
-		# now we either have a sorted list or an essentially empty list if the 
-		# match happened to be bad
+				vehicles_to_ignore.append(i)
+		self.trip.ignore_vehicles( vehicles_to_ignore )
+		# ignore vehicles that aren't part of the longest ordered sequence
+		keep = set( longest_ordered_subsequence([ v.measure for v in self.trip.vehicles ]) )
+		self.trip.ignore_vehicles( i for i in range(len(self.trip.vehicles)) if i not in keep )
 
 
 	def locate_stops_on_route(self):
 		"""Find the measure of stops along the route geometry for any arbitrary 
 			route. Stops must be within a given distance of the path, but can 
-			repeat if the route passes a stop two or more times. To check for this,
-			the geometry is sliced up into segments and we check just a portion 
-			of the route at a time."""
+			repeat if the route passes a stop two or more times, so we look for 
+			each separate pass of the route near the stop."""
+		# trips loaded from the DB don't have the stops the collector saw, so 
+		# use the scheduled stops of the direction
+		if len(self.trip.stops) == 0:
+			self.trip.stops = list( db.get_stops(self.trip.direction_id,self.trip.last_seen) or [] )
 		assert len(self.trip.stops) > 0
 		assert self.geometry.length > 0
 		# list of timepoints
 		potential_timepoints = []
-		# copy the geometry so we can slice it up it
-		path = copy(self.geometry)
-		traversed = 0
-		# while there is more than 750m of path remaining
-		while path.length > 0:
-			subpath, path = cut(path,750)
-			# check for nearby stops
-			for stop in self.trip.stops:
-				# if the stop is close enough
-				stop_dist = subpath.distance(stop.geom)
-				if stop_dist <= conf['stop_dist']:
-					# measure how far it is along the trip
-					m = traversed + subpath.project(stop.geom)
-					# add it to the list of measures
-					potential_timepoints.append( TimePoint(stop,m,stop_dist) )
-			# note what we have already traversed
-			traversed += 750
-		# Now some of these will be duplicates that are close to the cutpoint
-		# and thus are added twice with similar measures
+		# only stops near some part of the route need a closer look
+		candidates = self.route.nearby_items( self.trip.stop_index, conf['stop_dist'] )
+		for stop in [ s for s in self.trip.stops if s in candidates ]:
+			for m, stop_dist in self.route.visits(stop.geom,conf['stop_dist']):
+				potential_timepoints.append( TimePoint.new(stop,None,m,stop_dist,None) )
+		# Passes that are very close together, e.g. on either side of a short 
+		# loop, can give duplicate timepoints with similar measures
 		# such points need to be removed
 		final_timepoints = []
 		for pt in potential_timepoints:
@@ -305,20 +311,27 @@ class match(object):
 				final_timepoints.append( pt )
 		# add terminal stops if they are anywhere near the GPS data
 		# but not used yet
-		if not self.default_route_used:
+		if not (self.default_route_used or self.shape):
 			# for first and last stops
-			for terminal_stop in [self.trip.stops[0],self.trip.stops[-1]]:
-				if not terminal_stop.id in [ t.stop.id for t in potential_timepoints ]:
-					# if the terminal stop is less than 500m away from the route
-					dist = self.geometry.distance(terminal_stop.geom)
-					if dist < 500:
-						m = self.geometry.project(terminal_stop.geom)
-						final_timepoints.append( TimePoint(
-							terminal_stop,
-							m-dist if m < self.geometry.length/2 else m+dist,
-							dist
-						) )
-		# for default geometries on the other hand, remove stops that are nowhere
+			terminal_stops = [ 
+				stop for stop in [self.trip.stops[0],self.trip.stops[-1]]
+				if not stop.id in [ t.stop.id for t in potential_timepoints ]
+			]
+			# if the terminal stop is less than 500m away from the route
+			measures, distances = self.route.locate( 
+				[ stop.geom for stop in terminal_stops ], 500
+			)
+			for terminal_stop, m, dist in zip(terminal_stops,measures,distances):
+				if dist < 500:
+					final_timepoints.append( TimePoint.new(
+						terminal_stop,
+						None,
+						m-dist if m < self.geometry.length/2 else m+dist,
+						dist,
+						None
+					) )
+		# for default geometries and known shapes on the other hand, which 
+		# may extend well beyond this trip, remove stops that are nowhere
 		# near the actual GPS data
 		else:
 			final_timepoints = [
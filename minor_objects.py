@@ -47,6 +47,7 @@ class Stop(object):
 		self.lat = -1
 		self.lon = -1
 		self.report_time = -1
+		self.local_geom = None	# location in the local projection
 	
 	@classmethod
 	def new(self, stop_id, projected_geom_hex ):
@@ -57,6 +58,14 @@ class Stop(object):
 		Stop.geom = loadWKB( projected_geom_hex, hex=True )
 		return Stop
   
+	@classmethod
+	def fromDB(self, stop_id, projected_geom_hex ):
+		# as above, for stops from the stops table, which are already projected
+		Stop = self()
+		Stop.id = stop_id
+		Stop.local_geom = loadWKB( projected_geom_hex, hex=True )
+		return Stop
+
 	@classmethod
 	def new(self, stop_id, lat, lon, time ):
 		Stop = self()
@@ -79,7 +88,11 @@ class Stop(object):
 
 	@property
 	def geom(self):
-		return Point(self.lon, self.lat)
+		"""Location in the local projection, as for vehicles. This is projected 
+			once, on first use."""
+		if self.local_geom is None:
+			self.local_geom = reproject( conf['projection'], Point(self.lon, self.lat) )
+		return self.local_geom
 
 class TimePoint(object):
 	"""A stop in sequence."""
@@ -7,6 +7,7 @@ import threading, multiprocessing
 import json
 from datetime import datetime
 from trip import Trip
+from blocks import link_block
 from os import remove, path
 from conf import API_KEY, conf # configuration
 from minor_objects import Stop, TimePoint
@@ -23,7 +24,6 @@ doMatching = True
 
 # GLOBALS
 fleet = {} 			# operating vehicles in the ( fleet vid -> trip_obj )
-next_bid = db.new_block_id()		# next block_id to be assigned
 last_update = 0	# last update from server, removed results already reported
 
 fleet_lock = threading.Lock()
@@ -36,7 +36,6 @@ def get_new_vehicles():
 		and send the trips for processing when it is determined that they 
 		have ended"""
 	global fleet
-	global next_bid
 	global last_update
 	# UNIX time the request was sent
 	request_time = time.time()
@@ -65,14 +64,15 @@ def get_new_vehicles():
 	vehicles = JSON['data']['list']
  
 	# get values from the JSONs
-	last_update = JSON['currentTime']
+	# times are kept in epoch seconds; the API gives milliseconds
+	last_update = JSON['currentTime'] / 1000
  
 	# prevent simulataneous editing
 	with fleet_lock:
 		# check to see if there's anything we just haven't heard from at all lately
 		for vehicleID in list(fleet.keys()):
 			# if it's been more than 15 minutes
-			if last_update - fleet[vehicleID].last_seen > 900*1000:
+			if last_update - fleet[vehicleID].last_seen > 900:
 				# it has ended
 				ending_trips.append(fleet[vehicleID])
 				del fleet[vehicleID]
@@ -94,8 +94,9 @@ def get_new_vehicles():
 				if trip['id'] == ('3_' + tripID):
 					routeID = trip['routeId'][2:]
 					blockID = trip['blockId'][2:]
+					blockID = int(blockID) if blockID.isdigit() else None
 					directionID = trip['directionId']
-			report_time = vehicle['lastUpdateTime']
+			report_time = vehicle['lastUpdateTime'] / 1000
 
 			try: # have we seen this vehicle recently?
 				fleet[vehicleID]
@@ -108,7 +109,7 @@ def get_new_vehicles():
 				continue
 			# we have a record for this vehicle, and it's been heard from recently
 			# see if anything else has changed that makes this a new trip
-			if last_update - fleet[vehicleID].last_seen > 900*1000:
+			if last_update - fleet[vehicleID].last_seen > 900:
 				print (' Trip ' + str(fleet[vehicleID].trip_id) + ' is ending')
 				ending_trips.append(fleet[vehicleID])
 				del fleet[vehicleID]
@@ -177,6 +178,8 @@ def get_new_vehicles():
 		logger.info(msg = 'Trip ' + trip.trip_id + ' has ended')
 
 		if len(trip.vehicles) > 1:
+			# if the agency didn't give a block, it's known now
+			link_block(trip)
 			with requests.Session() as session:
 				retries = Retry( total=3, backoff_factor=1 )
 				session.mount( 'http://', HTTPAdapter(max_retries=retries) )
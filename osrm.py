@@ -0,0 +1,472 @@
+# functions involving requests to the OSRM map matching API
+
+import requests, json, time, asyncio, hashlib, sqlite3, zlib, os
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+from concurrent.futures import ThreadPoolExecutor
+from numpy import mean
+from shapely.geometry import Point, LineString
+from shapely.ops import substring
+from conf import conf
+
+# aiohttp is only needed for matching many trips concurrently
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+# orjson parses large responses several times faster, if it's available
+try:
+	from orjson import loads as parse_json
+except ImportError:
+	parse_json = json.loads
+
+
+def match_request(vehicles,error_radius):
+	"""Return the url and query parameters of a match request for the given
+		vehicle records, structured as the OSRM API requires."""
+	# rounding coords to 6 decimals
+	coords = ';'.join( [
+		format(v.lon,'.7g')+','+format(v.lat,'.7g') for v in vehicles
+	] )
+	radii = ';'.join( [ str(error_radius) ] * len(vehicles) )
+	options = {
+		'radiuses':radii,
+		'steps':'false',
+		'geometries':conf['OSRMserver'].get('geometries','polyline6'),
+		'annotations':'false',
+		'overview':'full',
+		'gaps':'ignore', # don't split based on time gaps - shouldn't be any
+		'tidy':'true',
+		'generate_hints':'false'
+	}
+	return ( conf['OSRMserver']['url']+'/match/v1/transit/'+coords, options )
+
+
+def decode_polyline(encoded,precision=6):
+	"""Decode a Google encoded polyline string, as returned by OSRM for the 
+		polyline (precision 5) and polyline6 geometry formats, into a list 
+		of (lon,lat) tuples."""
+	factor = 10**precision
+	coords = []
+	index = lat = lon = 0
+	while index < len(encoded):
+		deltas = []
+		# each point is a latitude delta then a longitude delta
+		for i in range(2):
+			result = shift = 0
+			while True:
+				byte = ord(encoded[index]) - 63
+				index += 1
+				result |= (byte & 0x1f) << shift
+				shift += 5
+				if byte < 0x20:
+					break
+			deltas.append( ~(result >> 1) if result & 1 else result >> 1 )
+		lat += deltas[0]
+		lon += deltas[1]
+		coords.append( (lon/factor,lat/factor) )
+	return coords
+
+
+def decode(response):
+	"""Give each matching in a parsed response a list of (lon,lat) 
+		'coordinates', whatever format its geometry was requested in."""
+	for matching in response.get('matchings',[]):
+		geometry = matching.pop('geometry')
+		if isinstance(geometry,dict): # geojson
+			matching['coordinates'] = geometry['coordinates']
+		else:
+			precision = 5 if conf['OSRMserver'].get('geometries') == 'polyline' else 6
+			matching['coordinates'] = decode_polyline(geometry,precision)
+	return response
+
+
+def confidence(response):
+	"""Get an average confidence value from a parsed match response."""
+	if response.get('code') != 'Ok' or len(response['matchings']) == 0:
+		return 0
+	return mean( [ m['confidence'] for m in response['matchings'] ] )
+
+
+def is_sufficient(response):
+	"""Is this match good enough actually to be used?"""
+	return confidence(response) >= conf['min_OSRM_match_quality']
+
+
+class ResponseCache(object):
+	"""A persistent cache of parsed match responses in a local SQLite file, 
+		keyed by a hash of the request URL (which contains the coordinates) 
+		and options. When the cache grows past max_size megabytes the least 
+		recently used responses are evicted. Hits and misses are counted in 
+		the file so that they add up across processes and runs. Each process 
+		keeps a running total of the size, which is read from the file again 
+		every RESYNC puts to count what other processes have added."""
+
+	RESYNC = 100
+
+	def __init__(self,path,max_size=1024):
+		self.path = path
+		self.max_size = max_size * 1024**2 # bytes
+		self.connection = sqlite3.connect(path,timeout=60,isolation_level=None)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS responses (
+				key TEXT PRIMARY KEY,
+				response BLOB,
+				size INTEGER,
+				last_used REAL
+			);
+			CREATE INDEX IF NOT EXISTS last_used_idx ON responses (last_used);
+			CREATE TABLE IF NOT EXISTS stats ( hits INTEGER, misses INTEGER );
+			INSERT INTO stats SELECT 0, 0 WHERE NOT EXISTS (SELECT * FROM stats);
+		""")
+		self.size = self.total_size()
+		self.puts = 0
+
+	@staticmethod
+	def key(url,options):
+		request = url + '?' + '&'.join( k+'='+str(options[k]) for k in sorted(options) )
+		return hashlib.sha256( request.encode('utf-8') ).hexdigest()
+
+	def get(self,url,options):
+		"""Return the cached response or None."""
+		key = self.key(url,options)
+		row = self.connection.execute(
+			'SELECT response FROM responses WHERE key = ?', (key,)
+		).fetchone()
+		if row is None:
+			self.connection.execute('UPDATE stats SET misses = misses + 1')
+			return None
+		self.connection.execute(
+			'UPDATE responses SET last_used = ? WHERE key = ?', (time.time(),key)
+		)
+		self.connection.execute('UPDATE stats SET hits = hits + 1')
+		return parse_json( zlib.decompress(row[0]) )
+
+	def put(self,url,options,response):
+		"""Store a response, evicting old ones if the cache is too large."""
+		blob = zlib.compress( json.dumps(response).encode('utf-8') )
+		key = self.key(url,options)
+		replaced = self.connection.execute(
+			'SELECT size FROM responses WHERE key = ?', (key,)
+		).fetchone()
+		self.connection.execute(
+			'INSERT OR REPLACE INTO responses VALUES (?,?,?,?)',
+			(key,blob,len(blob),time.time())
+		)
+		self.size += len(blob) - ( replaced[0] if replaced else 0 )
+		self.puts += 1
+		if self.puts % self.RESYNC == 0:
+			self.size = self.total_size()
+		if self.size > self.max_size:
+			self.size -= self.evict(self.size - self.max_size)
+
+	def total_size(self):
+		"""Size in bytes of all stored responses."""
+		(total,) = self.connection.execute(
+			'SELECT COALESCE(SUM(size),0) FROM responses'
+		).fetchone()
+		return total
+
+	def evict(self,num_bytes):
+		"""Remove least recently used responses totalling at least num_bytes, 
+			returning the number of bytes removed."""
+		freed = 0
+		keys = []
+		for key, size in self.connection.execute(
+			'SELECT key, size FROM responses ORDER BY last_used ASC'
+		):
+			if freed >= num_bytes:
+				break
+			keys.append((key,))
+			freed += size
+		self.connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+		return freed
+
+	@property
+	def stats(self):
+		"""Return (hits, misses, number of responses, size in bytes)."""
+		hits, misses = self.connection.execute('SELECT hits, misses FROM stats').fetchone()
+		num, size = self.connection.execute(
+			'SELECT COUNT(*), COALESCE(SUM(size),0) FROM responses'
+		).fetchone()
+		return ( hits, misses, num, size )
+
+
+# one cache connection per process, opened on first use
+_cache = None
+_cache_pid = None
+
+def get_cache():
+	"""Return the response cache for this process, or None if not configured."""
+	global _cache, _cache_pid
+	if not conf['OSRMserver'].get('cache'):
+		return None
+	if _cache is None or _cache_pid != os.getpid():
+		_cache = ResponseCache(
+			conf['OSRMserver']['cache'], conf['OSRMserver'].get('cache_size',1024)
+		)
+		_cache_pid = os.getpid()
+	return _cache
+
+
+def split_trace(num_points):
+	"""Return (start,end) index ranges of overlapping windows covering a trace 
+		of the given length. A trace that fits in one window isn't split."""
+	window = conf['match_window']
+	overlap = conf['match_window_overlap']
+	assert window > overlap + 1
+	windows = [ (0,min(window,num_points)) ]
+	while windows[-1][1] < num_points:
+		start = windows[-1][1] - overlap
+		windows.append( (start,min(start+window,num_points)) )
+	return windows
+
+
+def trim_matching(matching,waypoints):
+	"""Cut a matching geometry down to the part between the first and last of 
+		the given tracepoints. OSRM geometries have the matched locations as 
+		vertices, so look for those first, in order."""
+	coords = matching['coordinates']
+	indices = []
+	i = 0
+	for tp in (waypoints[0],waypoints[-1]):
+		x, y = tp['location']
+		while i < len(coords) and not (
+			abs(coords[i][0]-x) < 2e-6 and abs(coords[i][1]-y) < 2e-6
+		):
+			i += 1
+		indices.append(i)
+	if indices[1] < len(coords):
+		return coords[indices[0]:indices[1]+1]
+	# otherwise fall back on measuring along the line
+	line = LineString(coords)
+	start = line.project(Point(waypoints[0]['location']))
+	end = line.project(Point(waypoints[-1]['location']))
+	return list( substring(line,start,max(start,end)).coords )
+
+
+def stitch(windows,responses,num_points):
+	"""Combine the responses for overlapping windows of a trace into a single 
+		response, as though the whole trace had been matched at once. Each 
+		window keeps the fixes up to the middle of its overlaps with its 
+		neighbours, and matchings that meet at a shared fix are joined."""
+	# the fix at which each window hands over to the next
+	cuts = [ windows[k+1][0] + (windows[k][1]-windows[k+1][0]) // 2 for k in range(len(windows)-1) ]
+	bounds = list( zip( [0]+cuts, cuts+[num_points-1] ) )
+	matchings = []	# each a dict of fixes, tracepoints, coords, legs, confidences
+	for (start,end), (first,last), response in zip(windows,bounds,responses):
+		if response.get('code') != 'Ok':
+			continue
+		for m, matching in enumerate(response['matchings']):
+			# tracepoints of this matching on the fixes owned by this window
+			owned = [
+				(start+i,tp) for i, tp in enumerate(response['tracepoints'])
+				if tp and tp['matchings_index'] == m and first <= start+i <= last
+			]
+			if len(owned) < 2:
+				continue
+			fixes = [ fix for fix, tp in owned ]
+			waypoints = [ tp for fix, tp in owned ]
+			legs = matching['legs'][ waypoints[0]['waypoint_index'] : waypoints[-1]['waypoint_index'] ]
+			coords = trim_matching(matching,waypoints)
+			previous = matchings[-1] if matchings else None
+			if previous and previous['fixes'][-1] == fixes[0]:
+				# continues the last matching from the shared fix
+				previous['fixes'] += fixes[1:]
+				previous['tracepoints'] += waypoints[1:]
+				previous['coords'] += coords[1:]
+				previous['legs'] += legs
+				previous['confidences'].append(matching['confidence'])
+			else:
+				matchings.append( {
+					'fixes':fixes, 'tracepoints':waypoints, 'coords':coords,
+					'legs':legs, 'confidences':[matching['confidence']]
+				} )
+	# put the tracepoints back in input order, renumbered for the new matchings
+	tracepoints = [None] * num_points
+	for m, matching in enumerate(matchings):
+		for w, (fix, tp) in enumerate(zip(matching['fixes'],matching['tracepoints'])):
+			tracepoints[fix] = dict(tp,matchings_index=m,waypoint_index=w)
+	return {
+		'code':'Ok' if matchings else 'NoMatch',
+		'matchings':[ {
+			'confidence':mean(m['confidences']),
+			'coordinates':m['coords'],
+			'legs':m['legs'],
+			'distance':sum( leg['distance'] for leg in m['legs'] )
+		} for m in matchings ],
+		'tracepoints':tracepoints
+	}
+
+
+def fetch_match(vehicles,error_radius):
+	"""Get a match for the given vehicles and return the parsed response. 
+		Long traces are split into overlapping windows which are matched in 
+		parallel and stitched back together. Raises an exception if OSRM 
+		can't be reached."""
+	windows = split_trace(len(vehicles))
+	if len(windows) == 1:
+		return fetch_window(vehicles,error_radius)
+	window_requests = [ match_request(vehicles[start:end],error_radius) for start, end in windows ]
+	# the cache's connection belongs to this thread, so only the requests 
+	# themselves are made in the pool
+	cache = get_cache()
+	responses = [ cache.get(url,options) if cache else None for url, options in window_requests ]
+	missing = [ i for i, response in enumerate(responses) if response is None ]
+	if missing:
+		with ThreadPoolExecutor(len(missing)) as pool:
+			fetched = list( pool.map( lambda i: request_match(*window_requests[i]), missing ) )
+		for i, response in zip(missing,fetched):
+			responses[i] = response
+			if cache:
+				cache.put(*window_requests[i],response)
+	return stitch( windows, [ decode(r) for r in responses ], len(vehicles) )
+
+
+def fetch_window(vehicles,error_radius):
+	"""Send a match request to OSRM and return the parsed response. Retries
+		if necessary and raises an exception if OSRM can't be reached.
+		Responses are taken from and added to the cache if there is one."""
+	url, options = match_request(vehicles,error_radius)
+	cache = get_cache()
+	if cache:
+		response = cache.get(url,options)
+		if response is not None:
+			return decode(response)
+	response = request_match(url,options)
+	if cache:
+		cache.put(url,options,response)
+	return decode(response)
+
+
+def request_match(url,options):
+	"""Send a match request to OSRM and return the parsed, undecoded 
+		response, retrying if necessary."""
+	# open a connection, configured to retry in case of errors
+	with requests.Session() as session:
+		retries = Retry( total=5, backoff_factor=1, status_forcelist=[502,503,504] )
+		session.mount( 'http://', HTTPAdapter(max_retries=retries) )
+		raw_response = session.get(
+			url, params=options, timeout=conf['OSRMserver']['timeout']
+		)
+	# parse the result to a python object
+	return parse_json(raw_response.content)
+
+
+class AsyncMatcher(object):
+	"""Requests matches for many trips at once from a single process. Up to
+		`concurrency` requests are kept in flight, new requests are started no
+		faster than `rate_limit` per second and, after `max_failures` failed
+		requests in a row, the circuit breaker opens: for `cooldown` seconds
+		requests fail immediately rather than piling up on a server that is
+		down. Settings default to those in conf['OSRMserver']."""
+
+	def __init__(self,concurrency=None,rate_limit=None,max_failures=None,cooldown=None):
+		settings = conf['OSRMserver']
+		if aiohttp is None:
+			raise ImportError('aiohttp is required for concurrent matching')
+		self.concurrency = concurrency or settings.get('concurrency',8)
+		self.rate_limit = rate_limit or settings.get('rate_limit')	# per second
+		self.max_failures = max_failures or settings.get('max_failures',5)
+		self.cooldown = cooldown or settings.get('cooldown',30)			# seconds
+		self.timeout = settings['timeout']
+		self.retries = 3
+		# state for rate limiting and the circuit breaker
+		self.next_start = 0
+		self.consecutive_failures = 0
+		self.open_until = 0
+
+	@property
+	def circuit_open(self):
+		return time.monotonic() < self.open_until
+
+	def record_failure(self):
+		self.consecutive_failures += 1
+		if self.consecutive_failures >= self.max_failures:
+			print( 'OSRM failing, pausing requests for',self.cooldown,'seconds' )
+			self.open_until = time.monotonic() + self.cooldown
+			self.consecutive_failures = 0
+
+	async def wait_for_turn(self):
+		"""Space the start of requests to respect the rate limit."""
+		if not self.rate_limit:
+			return
+		now = time.monotonic()
+		start = max(now,self.next_start)
+		self.next_start = start + 1 / self.rate_limit
+		await asyncio.sleep(start-now)
+
+	async def fetch_match(self,session,vehicles,error_radius):
+		"""Return the parsed OSRM response, or None if OSRM can't be reached. 
+			Long traces are matched in windows, as in fetch_match() above."""
+		windows = split_trace(len(vehicles))
+		if len(windows) == 1:
+			return await self.fetch_window(session,vehicles,error_radius)
+		responses = await asyncio.gather( *[
+			self.fetch_window(session,vehicles[start:end],error_radius)
+			for start, end in windows
+		] )
+		if None in responses:
+			return None
+		return stitch(windows,responses,len(vehicles))
+
+	async def fetch_window(self,session,vehicles,error_radius):
+		"""Return the parsed OSRM response, or None if OSRM can't be reached."""
+		url, options = match_request(vehicles,error_radius)
+		cache = get_cache()
+		if cache:
+			response = cache.get(url,options)
+			if response is not None:
+				return decode(response)
+		for attempt in range(self.retries+1):
+			if self.circuit_open:
+				return None
+			async with self.semaphore:
+				await self.wait_for_turn()
+				try:
+					async with session.get(url,params=options) as raw_response:
+						# OSRM answers bad matches with a 400, so only retry 5xx
+						if raw_response.status >= 500:
+							raise aiohttp.ClientResponseError(
+								raw_response.request_info, (), status=raw_response.status
+							)
+						body = await raw_response.read()
+					self.consecutive_failures = 0
+					response = parse_json(body)
+					if cache:
+						cache.put(url,options,response)
+					return decode(response)
+				# a body that isn't JSON, e.g. an error page from a proxy or a 
+				# truncated response, is a failed attempt too
+				except (aiohttp.ClientError,asyncio.TimeoutError,ValueError):
+					self.record_failure()
+			# back off without holding up other requests
+			if attempt < self.retries:
+				await asyncio.sleep(2**attempt)
+		return None
+
+	async def match_trip(self,session,trip):
+		"""Fetch the responses that map_api.match would ask for: one at the
+			default error radius and, if that isn't good enough, a second at
+			twice the radius. Returns a dict keyed by error radius."""
+		radius = conf['error_radius']
+		responses = { radius: await self.fetch_match(session,trip.vehicles,radius) }
+		if responses[radius] is None:
+			# don't let the match fall back on a blocking request
+			responses[2*radius] = None
+		elif not is_sufficient(responses[radius]):
+			responses[2*radius] = await self.fetch_match(session,trip.vehicles,2*radius)
+		return responses
+
+	async def gather_trips(self,trips):
+		self.semaphore = asyncio.Semaphore(self.concurrency)
+		timeout = aiohttp.ClientTimeout(total=self.timeout)
+		async with aiohttp.ClientSession(timeout=timeout) as session:
+			return await asyncio.gather( *[
+				self.match_trip(session,trip) for trip in trips
+			] )
+
+	def match_trips(self,trips):
+		"""Return a list of response dicts for the given trips, in order."""
+		return asyncio.run( self.gather_trips(trips) )
@@ -0,0 +1,175 @@
+# A small stand-in for the OSRM /match/v1/transit/ endpoint, for running and
+# benchmarking the matching code without an OSRM server or road network.
+# It "matches" a trace by smoothing it and answers in the same format as
+# OSRM, optionally with added latency and injected failures. Results are
+# deterministic for a given request and random seed. Run e.g.
+#
+#	python osrm_standin.py --port 5000 --latency 0.05 --failure-rate 0.1
+#
+# and point conf['OSRMserver']['url'] at it.
+
+import json, time, random, threading, argparse
+from math import radians, sin, cos, asin, sqrt, exp
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# assumed speed for leg durations, m/s
+SPEED = 10
+
+
+def haversine(lon1,lat1,lon2,lat2):
+	"""Distance in meters between two lon-lat points."""
+	lon1, lat1, lon2, lat2 = map(radians,(lon1,lat1,lon2,lat2))
+	a = sin((lat2-lat1)/2)**2 + cos(lat1) * cos(lat2) * sin((lon2-lon1)/2)**2
+	return 2 * 6371000 * asin(sqrt(a))
+
+
+def smooth(coords):
+	"""Three point moving average, keeping the end points in place."""
+	if len(coords) < 3:
+		return list(coords)
+	smoothed = [ coords[0] ]
+	for (x1,y1), (x2,y2), (x3,y3) in zip(coords,coords[1:],coords[2:]):
+		smoothed.append( ( (x1+x2+x3)/3, (y1+y2+y3)/3 ) )
+	smoothed.append( coords[-1] )
+	return smoothed
+
+
+def encode_polyline(coords,precision=6):
+	"""Encode lon-lat tuples as a Google polyline string."""
+	factor = 10**precision
+	encoded = []
+	previous = (0,0)
+	for lon, lat in coords:
+		point = ( int(round(lat*factor)), int(round(lon*factor)) )
+		for value, last in zip(point,previous):
+			delta = value - last
+			delta = ~(delta << 1) if delta < 0 else delta << 1
+			while delta >= 0x20:
+				encoded.append( chr((0x20 | (delta & 0x1f)) + 63) )
+				delta >>= 5
+			encoded.append( chr(delta + 63) )
+		previous = point
+	return ''.join(encoded)
+
+
+def match_response(coords,radius,geometries='geojson'):
+	"""Build an OSRM-style match response for a list of lon-lat tuples."""
+	if len(coords) < 2:
+		return { 'code':'InvalidQuery', 'message':'Query string malformed' }
+	matched = smooth(coords)
+	offsets = [ haversine(*c,*m) for c, m in zip(coords,matched) ]
+	legs = []
+	for (x1,y1), (x2,y2) in zip(matched,matched[1:]):
+		d = haversine(x1,y1,x2,y2)
+		legs.append( {
+			'distance':d, 'duration':d/SPEED, 'weight':d/SPEED,
+			'summary':'', 'steps':[]
+		} )
+	distance = sum( leg['distance'] for leg in legs )
+	if geometries == 'geojson':
+		geometry = { 'type':'LineString', 'coordinates':[ list(c) for c in matched ] }
+	else:
+		geometry = encode_polyline(matched,6 if geometries == 'polyline6' else 5)
+	return {
+		'code':'Ok',
+		'matchings':[ {
+			# further from the smoothed line is less confident
+			'confidence':exp( -sum(offsets) / len(offsets) / radius ),
+			'geometry':geometry,
+			'legs':legs,
+			'distance':distance,
+			'duration':distance/SPEED,
+			'weight':distance/SPEED,
+			'weight_name':'duration'
+		} ],
+		'tracepoints':[ {
+			'location':list(m),
+			'distance':offset,
+			'name':'',
+			'matchings_index':0,
+			'waypoint_index':i,
+			'alternatives_count':0
+		} for i, (m, offset) in enumerate(zip(matched,offsets)) ]
+	}
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+	"""Handles match requests; settings are attributes of the server."""
+
+	def do_GET(self):
+		url = urlsplit(self.path)
+		prefix = '/match/v1/transit/'
+		if not url.path.startswith(prefix):
+			return self.respond(400,{ 'code':'InvalidUrl', 'message':'URL string malformed' })
+		server = self.server
+		# decide the fate of this request
+		with server.lock:
+			failure = server.random.random() < server.failure_rate
+			server.requests += 1
+			server.failures += failure
+		time.sleep(server.latency)
+		if failure and server.failure_mode == 'timeout':
+			time.sleep(server.hang)
+		if failure:
+			return self.respond(503,{ 'code':'ServiceUnavailable', 'message':'injected failure' })
+		try:
+			coords = [
+				tuple(float(v) for v in pair.split(','))
+				for pair in unquote(url.path[len(prefix):]).split(';')
+			]
+			query = parse_qs(url.query)
+			radius = float( query.get('radiuses',['20'])[0].split(';')[0] )
+			geometries = query.get('geometries',['polyline'])[0]
+		except ValueError:
+			return self.respond(400,{ 'code':'InvalidQuery', 'message':'Query string malformed' })
+		self.respond(200,match_response(coords,radius,geometries))
+
+	def respond(self,status,body):
+		payload = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def log_message(self,format,*args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+def serve(port=5000,latency=0,failure_rate=0,failure_mode='error',hang=60,seed=0,verbose=False):
+	"""Create the stand-in server. Call serve_forever() on the result, e.g.
+		in a thread."""
+	server = ThreadingHTTPServer(('localhost',port),StandinHandler)
+	server.daemon_threads = True
+	server.latency = latency					# seconds added to every request
+	server.failure_rate = failure_rate		# share of requests that fail
+	server.failure_mode = failure_mode		# 'error' (HTTP 503) or 'timeout'
+	server.hang = hang							# seconds a 'timeout' failure hangs
+	server.random = random.Random(seed)
+	server.lock = threading.Lock()
+	server.requests = 0
+	server.failures = 0
+	server.verbose = verbose
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Local stand-in for the OSRM match service')
+	parser.add_argument('--port',type=int,default=5000)
+	parser.add_argument('--latency',type=float,default=0,help='seconds added to each request')
+	parser.add_argument('--failure-rate',type=float,default=0,help='share of requests that fail')
+	parser.add_argument('--failure-mode',choices=['error','timeout'],default='error')
+	parser.add_argument('--seed',type=int,default=0)
+	parser.add_argument('--verbose',action='store_true')
+	args = parser.parse_args()
+	server = serve(
+		args.port, args.latency, args.failure_rate, args.failure_mode,
+		seed=args.seed, verbose=args.verbose
+	)
+	print( 'OSRM stand-in listening on port',args.port )
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print( server.requests,'requests,',server.failures,'failures' )
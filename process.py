@@ -4,30 +4,70 @@
 # trips or a range of trips given sequential trip_ids 
 
 import multiprocessing as mp
+from functools import partial
 from time import sleep
 from trip import Trip
-import db
+from conf import conf
+import db, osrm, hmm_match, shape_library
 from random import shuffle
 
 # let mode be one of ('single','range?')
 mode = input('Processing mode (single, all, route, or unfinished) --> ')
 
-def process_trip(valid_trip_id):
+def process_trip(valid_trip_id,skip_unchanged=False):
 	"""worker process called when using multiprocessing"""
 	print( 'starting trip:',valid_trip_id )
 	db.reconnect()
 	t = Trip.fromDB(valid_trip_id)
-	t.process()
+	t.process(skip_unchanged)
+
+def process_trip_batch(trip_ids,skip_unchanged=False):
+	"""worker process which overlaps the OSRM requests of many trips"""
+	print( 'starting batch of',len(trip_ids),'trips' )
+	db.reconnect()
+	trips = [ Trip.fromDB(trip_id) for trip_id in trip_ids ]
+	if skip_unchanged:
+		trips = [ t for t in trips if not t.is_unchanged() ]
+	# clean all the trips first so that matching can be done all at once
+	ready = []
+	for t in trips:
+		db.scrub_trip(t.trip_id)
+		if t.prepare_for_matching():
+			ready.append(t)
+	# trips along known shapes won't need OSRM
+	shapes = { t:shape_library.library.find(t) for t in ready }
+	to_match = [ t for t in ready if not shapes[t] ]
+	responses = dict( zip( to_match, osrm.AsyncMatcher().match_trips(to_match) ) )
+	for t in ready:
+		t.map_match_trip( responses.get(t), shapes[t] )
+		t.record_quality()
+	for t in trips:
+		t.record_fingerprint()
 
 def process_trips(trip_ids):
 	shuffle(trip_ids)
 	print( len(trip_ids),'trips in that range' )
+	# only redo trips whose inputs or parameters have changed?
+	skip_unchanged = input('skip unchanged trips? (y/n) --> ') in ['yes','y']
 	# how many parallel processes to use?
 	max_procs = int(input('max processes --> '))
+	if conf.get('matcher') == 'hmm':
+		# load the road network now so the workers share one copy
+		hmm_match.get_network()
 	# create a pool of workers and pass them the data
 	p = mp.Pool(max_procs)
-	p.map(process_trip,trip_ids,chunksize=3)
+	# with concurrent OSRM requests, each worker takes trips in batches
+	concurrency = conf['OSRMserver'].get('concurrency',1)
+	if concurrency > 1 and conf.get('matcher','osrm') == 'osrm':
+		batch_size = concurrency * 4
+		batches = [ trip_ids[i:i+batch_size] for i in range(0,len(trip_ids),batch_size) ]
+		p.map(partial(process_trip_batch,skip_unchanged=skip_unchanged),batches,chunksize=1)
+	else:
+		p.map(partial(process_trip,skip_unchanged=skip_unchanged),trip_ids,chunksize=3)
 	print( 'COMPLETED!' )
+	cache = osrm.get_cache()
+	if cache:
+		print( 'OSRM cache: {} hits, {} misses, {} responses, {} bytes'.format(*cache.stats) )
 
 # single mode enters one trip at a time and stops when 
 # a non-integer is entered
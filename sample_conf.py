@@ -25,16 +25,72 @@ conf = {
 				'trips':'prefix_trips',
 				'stops':'prefix_stops',
 				'stop_times':'prefix_stop_times',
-				'directions':'prefix_directions'
+				'directions':'prefix_directions',
+				'shapes':'prefix_shapes',
+				'route_quality':'prefix_route_quality'
 			}
 		},
 	# agency tag for the Nextbus API, which can be found at
 	# http://webservices.nextbus.com/service/publicXMLFeed?command=agencyList
 	'agency':'ttc',
+	# the agency's website, for agency.txt in the exported GTFS
+	'agency_url':'',
+	# where vehicle locations are collected from: 'onebusaway' (nb_api.py) or 
+	# 'gtfs_rt' (gtfsrt_api.py, see 'gtfs_rt' below)
+	'feed':'onebusaway',
+	# settings for GTFS-Realtime feeds, which require gtfs-realtime-bindings
+	'gtfs_rt':{
+		'vehicle_positions':'',
+		# optional; arrival times at stops, used for stop times
+		'trip_updates':None,
+		# any HTTP headers required, e.g. for an API key
+		'headers':{},
+		'timeout':10, # seconds
+		# optional path of the agency's static GTFS zip, for stop names and 
+		# locations and for routes and directions the realtime feed omits
+		'static_gtfs':None,
+		# optional directory in which to save each poll as a .pb file, which 
+		# can be played back with gtfsrt_api.py --replay
+		'record':None
+	},
+	# consecutive trips by the same vehicle are linked into a block if the 
+	# second begins no more than this many seconds after the first ends
+	'block_gap':30*60,
+	# which map matcher to use: 'osrm' sends requests to the OSRM server 
+	# below, 'hmm' matches in-process on a local OSM extract (see 'hmm')
+	'matcher':'osrm',
+	# settings for the in-process matcher
+	'hmm':{
+		# OSM XML extract covering the service area, e.g. from 
+		# osmium extract --bbox ... -o area.osm
+		'osm_file':'',
+		# meters; larger values tolerate more winding routes between GPS points
+		'beta':10,
+		# road positions considered for each GPS point
+		'max_candidates':8
+	},
 	# Where is the ORSM server? Give the root url
 	'OSRMserver':{
 		'url':'http://localhost:5000',
-		'timeout':10 # seconds
+		'timeout':10, # seconds
+		# format in which OSRM returns match geometries: 'polyline6' is much 
+		# more compact than 'geojson'
+		'geometries':'polyline6',
+		# number of OSRM requests each processing worker may have in flight at 
+		# once. Values over 1 process trips in batches using the asynchronous 
+		# client, which requires aiohttp
+		'concurrency':1,
+		# maximum requests per second per worker, or None for no limit
+		'rate_limit':None,
+		# after this many failed requests in a row, stop sending requests for 
+		# 'cooldown' seconds
+		'max_failures':5,
+		'cooldown':30,
+		# path of a local file in which to cache OSRM responses, so that 
+		# reprocessing identical traces doesn't need to query OSRM again. 
+		# None disables the cache
+		'cache':None,
+		'cache_size':1024 # megabytes
 	},
 	'min_OSRM_match_quality':0.3,
 	# function for projecting from lat-lon for shapely
@@ -53,8 +109,31 @@ conf = {
 	# distance threshold for stop matching in meters; stops more than this far 
 	# away from the matched route will not be included
 	'stop_dist':30,
+	# seconds for which each process keeps the directions, stops and known 
+	# shapes it has read from the DB before reading them again
+	'direction_cache_ttl':10*60,
 	# estimated GPS error radius in meters
 	# this applies to all points and effects map-matching
 	# higher values include more potential matches but take longer to process
-	'error_radius':20
+	'error_radius':20,
+	# traces with more points than this are map-matched in overlapping windows 
+	# of this many points, which are matched in parallel and joined together
+	'match_window':100,
+	'match_window_overlap':10,
+	# before map-matching, runs of GPS points within this many meters of each 
+	# other (e.g. at layovers) are thinned to their first and last points. 
+	# The rest get their measures back after matching. 0 disables thinning
+	'thinning_distance':10,
+	# trips whose GPS points all lie within this many meters of a path that 
+	# earlier trips in the same direction were matched to reuse that path 
+	# instead of being map-matched. 0 disables this
+	'shape_buffer':15,
+	# past matches within this (Hausdorff) distance in meters of each other 
+	# are considered the same path. Trips on the same path also share a 
+	# shape in the exported GTFS
+	'shape_cluster_distance':25,
+	# a path must have been matched this many times before it is reused
+	'shape_min_trips':3,
+	# number of recent map-matched trips per direction to learn paths from
+	'shape_sample':200
 }
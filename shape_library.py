@@ -0,0 +1,71 @@
+# A library of the paths that trips on each route direction have taken,
+# learned from past map-matching results. Most trips on a direction follow
+# one of only a few paths, so a new trace lying entirely along one of them
+# can be located on it directly, without asking OSRM for a match. The paths
+# are the shared shapes of the SHAPES table (see db.assign_shape), counted
+# by the recent trips that were map-matched onto them.
+
+import time
+import db
+import numpy as np
+from conf import conf
+from geom import LinearReference
+
+
+class Shape(object):
+	"""A canonical path for a route direction: a shared shape and the recent
+		map-matched trips along it."""
+
+	def __init__(self,shape_id,geometry,confidence,trips):
+		self.shape_id = shape_id
+		self.geometry = geometry					# projected MultiLineString
+		self.route = LinearReference(geometry)
+		self.confidence = confidence				# average of the matches
+		self.trips = trips							# map-matched trips on it
+
+
+class ShapeLibrary(object):
+	"""Canonical shapes by route and direction. Shapes for a direction are
+		loaded on first use and read again after conf['direction_cache_ttl']
+		seconds, to pick up what has been matched since."""
+
+	def __init__(self):
+		self.shapes = {}	# (route_id,direction_id) -> ( load time, [ Shape ] )
+
+	def get_shapes(self,route_id,direction_id):
+		"""Return the known shapes of a direction, loading them if needed."""
+		key = (route_id,direction_id)
+		if key not in self.shapes or time.time() - self.shapes[key][0] > conf['direction_cache_ttl']:
+			# geometries with gaps in them aren't used
+			self.shapes[key] = ( time.time(), [
+				Shape(shape_id,geometry,confidence,trips)
+				for shape_id, geometry, confidence, trips in db.get_shapes(
+					route_id, direction_id, conf['shape_sample']
+				) if len(geometry.geoms) == 1
+			] )
+		return self.shapes[key][1]
+
+	def find(self,trip):
+		"""Return the most common known shape that every vehicle on the trip
+			lies within the shape buffer of, in order along the shape, or None
+			if no shape fits."""
+		if not conf['shape_buffer']:
+			return None
+		buffer = conf['shape_buffer']
+		points = [ v.geom for v in trip.vehicles ]
+		shapes = self.get_shapes(trip.route_id,trip.direction_id)
+		for shape in sorted( shapes, key=lambda s: s.trips, reverse=True ):
+			if shape.trips < conf['shape_min_trips']:
+				break
+			measures, distances = shape.route.locate(points,buffer)
+			if np.isnan(measures).any():
+				continue
+			# GPS noise may step back a little, but no more
+			if ( np.diff(measures) < -buffer ).any():
+				continue
+			return shape
+		return None
+
+
+# one library per process
+library = ShapeLibrary()
@@ -1,8 +1,13 @@
 # main file, called to start the process of pulling vehicle locations
 
 import threading
-from nb_api import get_new_vehicles, logger
 import db
+from conf import conf
+from blocks import load_last_trips
+if conf.get('feed') == 'gtfs_rt':
+	from gtfsrt_api import get_new_vehicles, logger
+else:
+	from nb_api import get_new_vehicles, logger
 from time import sleep
 import random
 import sys
@@ -25,6 +30,9 @@ if truncateData:
 	db.empty_tables()
 	logger.info( msg='Truncating data')
 
+# let vehicles that were running before a restart continue their blocks
+load_last_trips()
+
 # call the big function. This takes longer to run the first time, 
 get_new_vehicles()
 
@@ -1,9 +1,10 @@
 # documentation on the nextbus feed:
 # http://www.nextbus.com/xmlFeedDocs/NextBusXMLFeed.pdf
 
-import re, db, math, random 
+import db, math, hashlib, json
 import map_api
-from geom import cut
+import numpy as np
+from geom import cut, GridIndex
 from numpy import mean
 from conf import conf
 from shapely.wkb import loads as loadWKB, dumps as dumpWKB
@@ -12,6 +13,50 @@ from shapely.geometry import Point, LineString, MultiLineString
 from shapely.geometry.geo import shape
 from minor_objects import Vehicle, TimePoint, Stop
 
+# configuration values which affect the outcome of processing a trip. 
+# 'projection' is a function and can't be hashed, but it is determined by 
+# 'localEPSG' so we use that instead
+FINGERPRINT_PARAMETERS = [
+	'error_radius',
+	'stop_dist',
+	'min_OSRM_match_quality',
+	'localEPSG',
+	'match_window',
+	'match_window_overlap',
+	'thinning_distance',
+	'shape_buffer',
+	'shape_cluster_distance',
+	'shape_min_trips',
+	'shape_sample',
+	'matcher',
+	'hmm'
+]
+
+def interpolate_times(measures,times,targets):
+	"""Interpolate times for any number of target measures against the 
+		non-decreasing measures and times of a trip's vehicles, all at once. 
+		Targets off either end are extrapolated at the average speed of the 
+		whole trip. A target landing exactly on a vehicle measure gets the 
+		time of the first vehicle there."""
+	measures = np.asarray(measures,dtype=float)
+	times = np.asarray(times,dtype=float)
+	targets = np.asarray(targets,dtype=float)
+	result = np.interp(targets,measures,times)
+	# np.interp is ambiguous where a measure repeats
+	exact = np.searchsorted(measures,targets,side='left')
+	hit = exact < len(measures)
+	hit[hit] = measures[exact[hit]] == targets[hit]
+	result[hit] = times[exact[hit]]
+	# np.interp clamps at the ends; extrapolate instead
+	off_end = (targets < measures[0]) | (targets > measures[-1])
+	if off_end.any():
+		seconds_per_meter = (times[-1]-times[0]) / (measures[-1]-measures[0])
+		before = targets < measures[0]
+		result[before] = times[0] + (targets[before]-measures[0]) * seconds_per_meter
+		after = targets > measures[-1]
+		result[after] = times[-1] + (targets[after]-measures[-1]) * seconds_per_meter
+	return result
+
 
 class Trip(object):
 	"""The trip class provides all the methods needed for dealing
@@ -30,15 +75,18 @@ class Trip(object):
 		self.seq = 1					# sequence which increments at each vehicle report
 		self.stop_num = 0
 		# declare several vars for later in the matching process
-		self.speed_string = ""		# str for error cleaning
 		self.segment_speeds = []	# reported speeds of all segments (error cleaning)
+		self.dropped_vehicles = []	# (vehicle,reason) removed by error cleaning
 		self.length = 0				# length in meters of current GPS trace
 		self.vehicles = []			# ordered vehicle records
 		self.ignored_vehicles = []	# discarded vehicle records
+		self.thinned_vehicles = []	# (vehicle,first,last) set aside during matching
 		self.stops = []				# Stop objects for this route
+		self._stop_index = None		# GridIndex of stops, see stop_index
 		self.timepoints = []			# Timepoint objects for this trip
 		self.waypoints = []			# points on the finallized trip only
 		self.match = None				# match object created during processing
+		self.input_fingerprint = None	# hash of processing inputs
 
 
 	@classmethod
@@ -103,19 +151,37 @@ class Trip(object):
 			
 
 
-	def process(self):
-		"""A trip has just ended. What do we do with it?"""
+	def process(self,skip_unchanged=False):
+		"""A trip has just ended. What do we do with it? If skip_unchanged is 
+			True and neither the trip nor the relevant parameters have changed 
+			since it was last processed, do nothing."""
+		if skip_unchanged and self.is_unchanged():
+			print ('trip',self.trip_id,'is unchanged')
+			return
 		# As this may be being REprocessed we need to clean up any traces of the 
 		# result of earlier processing so that we have a fresh start
 		db.scrub_trip(self.trip_id)
+		if self.prepare_for_matching():
+			self.map_match_trip()
+			self.record_quality()
+		self.record_fingerprint()
+
 
+	def prepare_for_matching(self):
+		"""Check and clean the trip's GPS data. Returns True if it's good 
+			enough to be sent for map matching."""
+		# fingerprint the inputs before we start changing them
+		self.fingerprint()
 		# see if we have enough stuff to bother with
 		if len(self.vehicles) < 3:
 			print ('trip has too few vehicles')
 			return db.ignore_trip(self.trip_id,'too few vehicles')
 
-		# calculate vector of segment speeds
-		self.segment_speeds = self.get_segment_speeds()
+		# remove GPS errors and calculate vector of segment speeds
+		self.segment_speeds = self.clean_vehicles()
+		if len(self.vehicles) < 3:
+			print ('trip has too few vehicles')
+			return db.ignore_trip(self.trip_id,'too few vehicles')
 
 		# check for very short trips
 		if self.length < 0.1: # km
@@ -125,14 +191,75 @@ class Trip(object):
 		# print ( 'Trying to store ' + str(len(self.timepoints)) + ' timepoints in trip '  + str(self.trip_id) )
 		# db.store_timepoints(self.trip_id,self.timepoints)
 
+		# set aside redundant points, e.g. while the vehicle is dwelling
+		self.thin_vehicles()
+
 		# trip is clean, so store the cleaned line 
 		db.set_trip_clean_geom(
    			self.trip_id,
 			dumpWKB( self.get_geom(), hex=True )
 		)
 
-		# and begin matching
-		self.map_match_trip()
+		# ready to begin matching
+		return True
+
+
+	def fingerprint(self):
+		"""Return a hash of everything the outcome of processing this trip 
+			depends on: the vehicle trace, the version of the schedule data and 
+			the matching parameters. This is computed once, before processing 
+			alters the trace."""
+		if self.input_fingerprint:
+			return self.input_fingerprint
+		inputs = {
+			'route_id': self.route_id,
+			'direction_id': self.direction_id,
+			'direction_uid': db.get_direction_uid(self.direction_id,self.last_seen),
+			'vehicles': [ (v.time,v.lon,v.lat) for v in self.vehicles ],
+			'parameters': [ conf[key] for key in FINGERPRINT_PARAMETERS ]
+		}
+		self.input_fingerprint = hashlib.sha1( 
+			json.dumps(inputs,sort_keys=True,default=str).encode('utf-8') 
+		).hexdigest()
+		return self.input_fingerprint
+
+
+	def is_unchanged(self):
+		"""Was this trip last processed with exactly the current inputs?"""
+		return db.get_trip_fingerprint(self.trip_id) == self.fingerprint()
+
+
+	def record_quality(self):
+		"""Count how many of the scheduled stops the match found, for the 
+			route quality measures. Trips that couldn't be matched for want 
+			of a connection aren't counted."""
+		problem = db.get_trip_problem(self.trip_id)
+		if self.match is False or ( problem and 'connection issue' in problem ):
+			return
+		entry, version = db.get_direction(self.direction_id,self.last_seen)
+		scheduled = len(version['stop_ids']) if version else 0
+		made = len(self.timepoints) if self.match.is_useable else 0
+		db.record_trip_quality(self.trip_id,made,scheduled)
+
+
+	def record_fingerprint(self):
+		"""Record what the processing result was based on, unless we couldn't 
+			get one for reasons having nothing to do with the inputs."""
+		problem = db.get_trip_problem(self.trip_id)
+		if self.match is False or ( problem and 'connection issue' in problem ):
+			return
+		db.set_trip_fingerprint(self.trip_id,self.fingerprint())
+
+
+	@property
+	def stop_index(self):
+		"""A spatial index of the (projected) stops of this trip, built on first 
+			use and rebuilt if stops have been added since."""
+		if self._stop_index is None or self._stop_index.size != len(self.stops):
+			self._stop_index = GridIndex( max(conf['stop_dist'],50) )
+			for stop in self.stops:
+				self._stop_index.insert( stop, *stop.geom.bounds )
+		return self._stop_index
 
 
 	def get_geom(self):
@@ -142,48 +269,146 @@ class Trip(object):
 
 
 	def get_segment_speeds(self):
-		"""Return speeds (kmph) on the segments between non-ignored vehicles."""
-		# iterate over segments (i-1)
-		dists = []	# km
-		times = []	# hours
-		i = 1
-		while i < len(self.vehicles):
-			if self.vehicles[i].time == self.vehicles[i-1].time:
-				self.vehicles.remove(self.vehicles[i])
-				continue
+		"""Return speeds (kmph) on the segments between non-ignored vehicles, 
+			and set the trip length (km)."""
+		times = np.array( [ v.time for v in self.vehicles ], dtype=float )
+		xy = np.array( [ (v.geom.x,v.geom.y) for v in self.vehicles ] ).reshape(-1,2)
+		dists = np.hypot( *np.diff(xy,axis=0).T ) / 1000	# km
+		hours = np.diff(times) / 3600
+		self.length = dists.sum() # set the total distance
+		return dists / hours # calculate speeds
+
+
+	def clean_vehicles(self):
+		"""Find and drop GPS errors all in one pass: reports repeating the 
+			previous report's time, stationary reports at the start or end of 
+			the trip, and reports implying impossible speeds. Each segment is 
+			'fast' (over 120kmph) or 'slow' (under 0.1kmph) or neither. Dropped 
+			vehicles are ignored and the reason for each is recorded in 
+			self.dropped_vehicles. Stationary runs in the middle of the trip 
+			are left for thin_vehicles(). Returns the segment speeds of the 
+			remaining vehicles."""
+		reasons = [None] * len(self.vehicles)
+		def drop(indices,reason):
+			for i in indices:
+				reasons[i] = reasons[i] or reason
+		# reports with the same time as the one before
+		times = np.array( [ v.time for v in self.vehicles ], dtype=float )
+		drop( np.nonzero(np.diff(times) == 0)[0] + 1, 'duplicate time' )
+		remaining = [ i for i, r in enumerate(reasons) if r is None ]
+		vehicles = [ self.vehicles[i] for i in remaining ]
+		xy = np.array( [ (v.geom.x,v.geom.y) for v in vehicles ] ).reshape(-1,2)
+		times = times[remaining]
+		dists = np.hypot( *np.diff(xy,axis=0).T ) / 1000	# km
+		speeds = dists / ( np.diff(times) / 3600 )
+		slow, fast = speeds < 0.1, speeds > 120
+		n = len(speeds)
+		# segment i runs from vehicle i to i+1 (in the remaining vehicles)
+		# stationary at the start or end: drop all but the last/first
+		moving = np.nonzero(~slow)[0]
+		first_move = moving[0] if len(moving) else n
+		last_move = moving[-1] if len(moving) else -1
+		drop( [ remaining[i] for i in range(0,first_move) ], 'stationary start' )
+		drop( [ remaining[i] for i in range(last_move+2,n+1) ], 'stationary end' )
+		# a jump in the first or last four segments: drop everything before 
+		# or after it
+		jumps = np.nonzero(fast)[0]
+		if len(jumps) and jumps[ jumps < 4 ].size:
+			drop( [ remaining[i] for i in range(0,jumps[jumps < 4][-1]+1) ], 'jump at start' )
+		if len(jumps) and jumps[ jumps >= n-4 ].size:
+			drop( [ remaining[i] for i in range(jumps[jumps >= n-4][0]+1,n+1) ], 'jump at end' )
+		# a spike out and back: vehicles between consecutive fast segments
+		spikes = np.nonzero( fast[:-1] & fast[1:] )[0] + 1
+		drop( [ remaining[i] for i in spikes ], 'spike' )
+		# a lone fast segment: drop whichever end leaves the slower segment
+		lone = fast & ~np.r_[False,fast[:-1]] & ~np.r_[fast[1:],False]
+		for i in np.nonzero(lone)[0]:
+			if i < 4 or i >= n-4:
+				continue # handled above
+			without_start = np.hypot( *(xy[i+1]-xy[i-1]) ) / (times[i+1]-times[i-1])
+			without_end = np.hypot( *(xy[i+2]-xy[i]) ) / (times[i+2]-times[i])
+			drop( [ remaining[i] if without_start <= without_end else remaining[i+1] ], 'jump' )
+		# now drop them all together
+		kept = []
+		for vehicle, reason in zip(self.vehicles,reasons):
+			if reason:
+				self.dropped_vehicles.append( (vehicle,reason) )
+				self.ignored_vehicles.append(vehicle)
 			else:
-				v1 = self.vehicles[i-1]
-				v2 = self.vehicles[i]
-				dists.append( v1.geom.distance(v2.geom)/1000 ) # distance in km
-				times.append( (v2.time-v1.time)/3600 ) # time in hrs
-				i = i+1
-		self.length = sum(dists) # set the total distance
-		return [ d/t for d,t in zip(dists,times) ] # calculate speeds
-
-	def map_match_trip(self):
+				kept.append(vehicle)
+		self.vehicles = kept
+		return self.get_segment_speeds()
+
+
+	def map_match_trip(self,prefetched=None,shape=None):
 		"""Match the trip GPS points to the road network, ie, improve
 			the spatial accuracy of the trip. Get the location/measure of stops 
-			and vehicles along the path."""
+			and vehicles along the path. OSRM responses fetched in advance, or 
+			the known shape found instead, can be passed along to the match 
+			object."""
 		# create a match object, passing it this trip to get it started
 		try:
-			self.match = map_api.match(self)
+			self.match = map_api.match(self,prefetched,shape)
 			print("Contacting OSRM server")
 		except:
+			self.match = False
 			print("Failed to contact OSRM server")
-  
-		# store the match info and geom in the DB
-		# db.add_trip_match( self.trip_id,self.match.confidence,dumpWKB( self.match.geometry,hex=True ) )
+		# the match info and geom are stored by the match; the stop times 
+		# follow from it if it's good enough
+		if self.match and self.match.is_useable:
+			self.interpolate_stop_times()
 
 	def interpolate_stop_times(self):
 		"""Interpolates stop times after map matching."""
 		# interpolate/extrapolate times for each timepoint
-		# for timepoint in self.timepoints:
-		# 	timepoint.set_time( self.interpolate_time(timepoint.measure) )
+		times = self.interpolate_times([ t.measure for t in self.timepoints ])
+		for timepoint, time in zip(self.timepoints,times):
+			timepoint.set_time( float(time) )
 		# store the stop times
 		print ( ' Interpolating stop times for ' + str(self.trip_id) + ' using ' + str(len(self.timepoints)) + ' timepoints')
 		db.store_timepoints(self.trip_id,self.timepoints)
 
 
+	def thin_vehicles(self):
+		"""Set aside vehicle reports that add nothing to the map matching: all 
+			but the first and last of a run of reports within the thinning 
+			distance of the first, as when a vehicle sits at a layover or in 
+			traffic. Their measures can be recovered after matching by 
+			restore_thinned_vehicles()."""
+		tolerance = conf['thinning_distance']
+		if not tolerance:
+			return
+		kept = []
+		run = []
+		# None marks the end of the last run
+		for vehicle in self.vehicles + [None]:
+			if run and vehicle and vehicle.geom.distance(run[0].geom) <= tolerance:
+				run.append(vehicle)
+				continue
+			# the run has ended; keep its ends and set aside the middle
+			kept += run[:1] + run[1:][-1:]
+			for v in run[1:-1]:
+				self.thinned_vehicles.append( (v,run[0],run[-1]) )
+			run = [vehicle]
+		self.vehicles = kept
+
+
+	def restore_thinned_vehicles(self):
+		"""Put back the vehicles set aside by thin_vehicles(), with measures 
+			interpolated in time between the ends of their run. If either end 
+			was discarded during matching, they are discarded too."""
+		restored = []
+		for vehicle, first, last in self.thinned_vehicles:
+			if first in self.vehicles and last in self.vehicles:
+				share = (vehicle.time - first.time) / (last.time - first.time)
+				vehicle.set_measure( first.measure + share * (last.measure - first.measure) )
+				restored.append(vehicle)
+			else:
+				self.ignored_vehicles.append(vehicle)
+		self.thinned_vehicles = []
+		self.vehicles = sorted( self.vehicles + restored, key=lambda v: v.time )
+
+
 	def ignore_vehicle(self,var):
 		"""Ignore a vehicle specified by either the index in the current list
 			or by giving the vehicle object itself."""
@@ -201,117 +426,31 @@ class Trip(object):
 			print( 'ERROR' )
 
 
-	def has_errors(self):
-		"""Each segment between GPS points is classified based on it's speed. 
-			See if the speed segments indicate that there are any fixable errors 
-			by making the speed string and checking for fixeable patterns."""
-		# convert the segment speeds into a string with three possible characters
-		# 'x' indicates very high speed
-		# 'o' indicates very low speed (essentially no motion)
-		# '-' indicates moderate speed
-		# e.g. 'oo---o----xx----------' and so pn
-		self.speed_string = ''.join([ 
-			'x' if seg > 120 else 'o' if seg < 0.1 else '-'
-			for seg in self.segment_speeds ])
-		# check for slow segments that can be fixed
-		match_oo = re.search('oo|^o|o$',self.speed_string)
-		# check for any very fast segments (all will be fixed)
-		match_x = re.search('x',self.speed_string)
-		if match_oo or match_x:
-			return True
-		else:
-			return False
+	def ignore_vehicles(self,indices):
+		"""Ignore the vehicles at any number of indices in the current list, 
+			rebuilding the list once."""
+		indices = set(indices)
+		if not indices: return
+		self.ignored_vehicles += [ v for i, v in enumerate(self.vehicles) if i in indices ]
+		self.vehicles = [ v for i, v in enumerate(self.vehicles) if i not in indices ]
 
 
-	def fix_error(self):
-		"""remove redundant points and fix obvious positional 
-			errors using RegEx. Fixes one error each time it's 
-			called: the first it finds"""
-		# check for leading o's (stationary start)
-		m = re.search('^oo*',self.speed_string)
-		if m: # remove the first vehicle
-			self.ignore_vehicle(0)
-			return
-		# check for trailing o's (stationary end)
-		m = re.search('oo*$',self.speed_string)
-		if m: # remove the last vehicle
-			self.ignore_vehicle( len(self.speed_string) )
-			return
-		# check for x near beginning, in first four segs
-		m = re.search('^.{0,3}x',self.speed_string)
-		if m: # remove the first vehicle
-			self.ignore_vehicle(0)
-			return
-		# check for x near the end, in last four segs
-		m = re.search('x.{0,3}$',self.speed_string)
-		if m: # remove the last vehicle
-			self.ignore_vehicle(len(self.speed_string))
-			return
-		# check for two or more o's in the middle and take from after the first o
-		m = re.search('.ooo*.',self.speed_string)
-		if m:
-			# remove the vehicle after the first o. This matches like '-oo-'
-			# so we need to add 2 to the start position to remove the vehicle 
-			# report from between the o's ('-o|o-')
-			self.ignore_vehicle(m.span()[0]+1)
-			return
-		# 'xx' in the middle, delete the point after the first x
-		m = re.search('.xxx*',self.speed_string)
-		if m:
-			# same strategy as above
-			self.ignore_vehicle(m.span()[0]+1)
-			return
-		# lone middle x
-		m = re.search('.x.',self.speed_string)
-		if m:
-			# delete a point either before or after a lone x
-			i = m.span()[0]+1+random.randint(0,1)
-			self.ignore_vehicle(i-1)
-			return
+	def interpolate_times(self,distances_along_trip):
+		"""Get times for any number of stops by interpolating on the trip 
+			times and locations. We already know the m of the stops and of the 
+			points on the trip/track."""
+		return interpolate_times(
+			[ v.measure for v in self.vehicles ],
+			[ v.time for v in self.vehicles ],
+			distances_along_trip
+		)
 
 
 	def interpolate_time(self,distance_along_trip):
-		"""Get the time for a stop by doing an interpolation on the trip times
-			and locations. We already know the m of the stop and of the points on 
-			the trip/track."""
-		vfirst = self.vehicles[0]
-		vlast = self.vehicles[-1]
-		# if the stop is before the vehicle records
-		if distance_along_trip < vfirst.measure:
-			trip_speed = (vlast.time-vfirst.time)/(vlast.measure-vfirst.measure)
-			gap = distance_along_trip - vfirst.measure
-			# negative gap projects time forward
-			return vfirst.time + gap * trip_speed
-		# trip is off the back
-		elif distance_along_trip > vlast.measure:
-			trip_speed = (vlast.time-vfirst.time)/(vlast.measure-vfirst.measure)
-			gap = distance_along_trip - vlast.measure
-			# positive gap projects time backwards
-			return vlast.time + gap * trip_speed
-		# the stop is among vehicle records
-		else:
-			# iterate over the segments of the trip, looking for the segment
-			# which holds the stop of interest
-			first = True
-			for point in self.vehicles:
-				if first:
-					first = False
-					m1 = point.measure
-					t1 = point.time
-					continue
-				m2 = point.measure
-				t2 = point.time
-				if m1 <= distance_along_trip <= m2:	# intersection is at or between these points
-					# interpolate the time
-					if distance_along_trip == m1:
-						return t1
-					percent_of_segment = (distance_along_trip - m1) / (m2 - m1)
-					additional_time = percent_of_segment * (t2 - t1) 
-					return t1 + additional_time
-				# create the segment for the next iteration
-				m1,t1 = m2,t2
-    
-    
+		"""Get the time for a single stop; see interpolate_times()."""
+		return self.interpolate_times([distance_along_trip])[0]
+
+
 	def add_timepoint(self,stop,measure,offset):
 		status = 0
 		self.seq += 1
@@ -320,9 +459,9 @@ class Trip(object):
 			if int(stop.id) == int(timepoint.stop_id):
 				status = 1
 				if timepoint.smallestOffset > abs(offset):
-					timepoint.arrival_time = stop.report_time + offset*1000
+					timepoint.arrival_time = stop.report_time + offset
 					timepoint.smallestOffset = abs(offset)
-					self.stops[len(self.stops)-1].report_time += offset*1000
+					self.stops[len(self.stops)-1].report_time += offset
 					return 1
 				else: continue
 